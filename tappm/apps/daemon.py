@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+A local prediction daemon for tappm_cli.
+
+The server loads the TA and MP models once, keeps the pool of decoding
+workers running and listens on a Unix domain socket. A client streams a
+FASTA file to it and receives the rendered report, which is identical to
+the one written by a standalone run.
+
+Protocol (one request per connection):
+    client -> server: a JSON line with the options, then the FASTA text
+                      until the client shuts down its writing side.
+    server -> client: the report text, written as its items are rendered,
+                      then a NUL byte and a JSON line with the status.
+
+The records are parsed as they arrive and the items are sent as they are
+scored, so neither side holds the whole input or report in memory. The
+client sends from a thread of its own while it reads the report.
+"""
+import os
+import json
+import codecs
+import socket
+import threading
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from io import TextIOWrapper
+
+from tappm import FastaReader, FastaBuilder
+from tappm.io import render_report_parts, pathtools
+from tappm.apps.pipeline import Pipeline
+
+__all__ = ['PredictionServer', 'request_prediction']
+
+BUFSIZE = 1 << 16
+
+# A peer that has gone raises EPIPE instead of killing the process, even
+# where SIGPIPE has its default action (as in tappm_cli).
+NOSIGNAL = getattr(socket, 'MSG_NOSIGNAL', 0)
+
+# Ends the report; it never occurs in a rendered report.
+END_MARK = b'\x00'
+
+
+class PredictionHandler(socketserver.StreamRequestHandler):
+    """Handle one prediction request."""
+
+    def handle(self):
+        server = self.server
+        lines = stream = None
+        try:
+            options = json.loads(self.rfile.readline().decode('utf-8'))
+            lines = TextIOWrapper(self.rfile, encoding='utf-8')
+            stream = TextIOWrapper(self.wfile, encoding='utf-8')
+            total = server.predict(lines, stream, **options)
+            status = {'status': 'ok', 'totalSeq': total}
+        except Exception as e:
+            if server.logger:
+                server.logger.warning("Request failed: {}".format(e))
+            status = {'status': 'error', 'message': str(e)}
+        try:
+            if stream is not None:
+                stream.flush()
+            self.wfile.write(END_MARK + json.dumps(status).encode('utf-8') +
+                             b'\n')
+        except (IOError, OSError) as e:
+            if server.logger:
+                server.logger.warning("Client gone: {}".format(e))
+        finally:
+            # The socket files are closed by finish().
+            for wrapper in (lines, stream):
+                if wrapper is not None:
+                    try:
+                        wrapper.detach()
+                    except (IOError, OSError, ValueError):
+                        pass
+
+
+class PredictionServer(socketserver.ThreadingMixIn,
+                       socketserver.UnixStreamServer):
+    """A Unix domain socket server with preloaded predictors.
+
+    :arg path: the path of the socket file
+    :arg predictors: a tuple of the TA and MP predictors
+    :arg formats: a map of format names to Fasta classes
+    :arg chunksize: the number of records passed between the stages of
+        the pipeline at a time
+    """
+    daemon_threads = True
+
+    def __init__(self, path, predictors, formats, chunksize=64,
+                 logger=None):
+        if os.path.exists(path):
+            if is_listening(path):
+                raise IOError("A server is already listening on " + path)
+            os.unlink(path)
+        socketserver.UnixStreamServer.__init__(self, path, PredictionHandler)
+        self.path = path
+        self.predictors = predictors
+        self.formats = formats
+        self.chunksize = chunksize
+        self.logger = logger
+        # The predictors share one pool of workers; score one request
+        # at a time and let parsing and rendering overlap.
+        self._lock = threading.Lock()
+        for predictor in predictors:
+            predictor.start()
+
+    def predict(self, lines, stream, name='', dbformat='free',
+                threshold=None, outfmt='tabular', totalSeq=None):
+        """Score the FASTA text of the iterable lines and write the report
+        into stream. Return the number of sequences.
+
+        The records go through the same Pipeline as a standalone run, so
+        every record is reported in input order, also when identifiers
+        repeat. totalSeq is shown in the head of the report ('NA' if it is
+        None), as the input is not read ahead."""
+        reader = FastaReader(FastaBuilder(self.formats[dbformat]))
+        head, tail = render_report_parts(
+            fmt=outfmt, threshold=threshold,
+            totalSeq='NA' if totalSeq is None else totalSeq)
+        pipeline = Pipeline(self.predictors, threshold, outfmt,
+                            chunksize=self.chunksize, flush=True)
+        with self._lock:
+            # Forget the characters counted by a request that failed.
+            for predictor in self.predictors:
+                predictor.encoder.reset()
+            count = pipeline.run(reader.iter_lines(lines), stream, head, tail)
+        if self.logger:
+            self.logger.info("Request {}: {} sequences".format(name, count))
+        return count
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        for predictor in self.predictors:
+            predictor.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def is_listening(path):
+    """Return True if a server accepts connections on the socket path."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+def request_prediction(path, inputfile, stream, threaded=False,
+                       **options):
+    """Stream the text of inputfile ('-' is the standard input) to the
+    server on path and write the report into stream as it arrives. A
+    compressed input is decompressed here (see pathtools.open_text), in a
+    thread of its own if threaded.
+
+    options are passed to PredictionServer.predict and must be JSON
+    serializable. Return the number of sequences. Raise RuntimeError if
+    the server failed, IOError (OSError) if it cannot be reached and
+    ValueError if the input cannot be opened."""
+    source = pathtools.open_text(inputfile, threaded=threaded)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(options).encode('utf-8') + b'\n', NOSIGNAL)
+        sender = Sender(sock, source)
+        sender.start()
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        trailer = None
+        while True:
+            chunk = sock.recv(BUFSIZE)
+            if not chunk:
+                break
+            if trailer is None:
+                end = chunk.find(END_MARK)
+                if end < 0:
+                    stream.write(decoder.decode(chunk))
+                    continue
+                stream.write(decoder.decode(chunk[:end], True))
+                trailer = chunk[end + 1:]
+            else:
+                trailer += chunk
+        sender.join()
+    finally:
+        sock.close()
+        source.close()
+    if trailer is None:
+        raise IOError("The server closed the connection before the end of "
+                      "the report.")
+    status = json.loads(trailer.decode('utf-8'))
+    if status['status'] != 'ok':
+        raise RuntimeError(status['message'])
+    if sender.error is not None:
+        raise sender.error
+    return status['totalSeq']
+
+
+class Sender(threading.Thread):
+    """Send the text of source (an open text file) to a socket as UTF-8
+    and shut down its writing side, while the report is read in the
+    calling thread."""
+
+    def __init__(self, sock, source):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sock = sock
+        self.source = source
+        self.error = None
+
+    def run(self):
+        try:
+            while True:
+                chunk = self.source.read(BUFSIZE)
+                if not chunk:
+                    break
+                self.sock.sendall(chunk.encode('utf-8'), NOSIGNAL)
+        except (IOError, OSError, ValueError) as e:
+            self.error = e
+        finally:
+            try:
+                self.sock.shutdown(socket.SHUT_WR)
+            except (IOError, OSError):
+                pass
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""
+An asyncio-based HTTP prediction service.
+
+Sequences posted by concurrent clients are coalesced into micro-batches,
+which are decoded by MyHmmPredictor in one call (and thus by the pool of
+workers when more than one CPU is used). Results are streamed back to each
+client as JSON lines while its batches complete.
+
+Endpoints:
+    POST /predict   the body is a FASTA text. Optional query parameters:
+                    threshold (float) and fmt (the header format, see
+                    tappm_cli --fmt).
+    GET  /health    returns {"status": "ok"}.
+
+Usage:
+    python -m tappm.apps.http_service --port 8080 --mcpu 4
+"""
+import sys
+import json
+import signal
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
+from optparse import OptionParser, OptionGroup
+
+try:
+    from urllib.parse import parse_qs
+except ImportError:
+    from urlparse import parse_qs
+
+from tappm import FastaReader, FastaBuilder
+from tappm.utils import Console, IndentedHelpFormatterWithNL, \
+                        make_result_item
+from tappm.apps.tappm_cli import FORMAT, load_predictors
+
+__all__ = ['MicroBatcher', 'PredictionService']
+
+REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    411: 'Length Required',
+    500: 'Internal Server Error',
+}
+
+
+class MicroBatcher(object):
+    """Coalesce concurrent scoring requests into batches.
+
+    :arg score: a function which takes a list of records and returns a
+        list of results in the same order. It is called in a single
+        background thread, one batch at a time.
+    :arg max_batch: the maximum number of records in a batch
+    :arg max_wait: the maximum time in seconds to wait for more records
+        once the first record of a batch has arrived
+    """
+
+    def __init__(self, score, max_batch=32, max_wait=0.01):
+        self.score = score
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = None
+        self._held = None
+        self._task = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def start(self):
+        """Start batching in the running event loop."""
+        self._queue = asyncio.Queue()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Stop batching and wait for the scoring thread."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._executor.shutdown(wait=True)
+
+    def submit(self, records):
+        """Queue records for scoring.
+
+        Return a list of futures, each of which resolves to the results of
+        a consecutive piece of at most max_batch records."""
+        loop = asyncio.get_event_loop()
+        futures = []
+        for start in range(0, len(records), self.max_batch):
+            future = loop.create_future()
+            self._queue.put_nowait(
+                (records[start:start + self.max_batch], future))
+            futures.append(future)
+        return futures
+
+    async def _next_piece(self, timeout=None):
+        if self._held is not None:
+            piece, self._held = self._held, None
+            return piece
+        if timeout is None:
+            return await self._queue.get()
+        return await asyncio.wait_for(self._queue.get(), timeout)
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            pending = [await self._next_piece()]
+            size = len(pending[0][0])
+            deadline = loop.time() + self.max_wait
+            while size < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    piece = await self._next_piece(timeout)
+                except asyncio.TimeoutError:
+                    break
+                if size + len(piece[0]) > self.max_batch:
+                    self._held = piece
+                    break
+                pending.append(piece)
+                size += len(piece[0])
+            records = [r for piece, future in pending for r in piece]
+            try:
+                results = await loop.run_in_executor(
+                    self._executor, self.score, records)
+            except Exception as e:
+                for piece, future in pending:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            start = 0
+            for piece, future in pending:
+                if not future.done():
+                    future.set_result(results[start:start + len(piece)])
+                start += len(piece)
+
+
+class PredictionService(object):
+    """A HTTP front end of the TA and MP predictors.
+
+    :arg predictors: a tuple of the TA and MP predictors
+    :arg threshold: the default threshold of the TA score
+    :arg max_batch: see MicroBatcher
+    :arg max_wait: see MicroBatcher
+    """
+
+    def __init__(self, predictors, threshold=-0.0167222981, max_batch=32,
+                 max_wait=0.01, logger=None):
+        self.predictors = predictors
+        self.threshold = threshold
+        self.logger = logger
+        self.batcher = MicroBatcher(self.score, max_batch, max_wait)
+
+    def score(self, records):
+        """Decode records with both models; return (TA, MP) pairs."""
+        ta_predictor, mp_predictor = self.predictors
+        prediction_ta = ta_predictor.predict_sequences(records, reverse=True)
+        prediction_mp = mp_predictor.predict_sequences(records)
+        if self.logger:
+            self.logger.debug("Scored a batch of {} sequences".format(
+                len(records)))
+        return list(zip(prediction_ta, prediction_mp))
+
+    async def start(self, host, port):
+        """Start the batcher and the HTTP server."""
+        for predictor in self.predictors:
+            predictor.start()
+        self.batcher.start()
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def stop(self):
+        """Stop the batcher and the decoding workers."""
+        await self.batcher.stop()
+        for predictor in self.predictors:
+            predictor.close()
+
+    async def handle(self, reader, writer):
+        """Serve one HTTP request, then close the connection."""
+        try:
+            request_line = await reader.readline()
+            method, target, version = request_line.decode('latin-1').split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                key, value = line.decode('latin-1').split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+            path, _, query = target.partition('?')
+            params = parse_qs(query)
+            if method == 'GET' and path == '/health':
+                self.respond(writer, 200, {'status': 'ok'})
+            elif method == 'POST' and path == '/predict':
+                if 'content-length' not in headers:
+                    self.respond(writer, 411, {'error': 'No Content-Length'})
+                else:
+                    body = await reader.readexactly(
+                        int(headers['content-length']))
+                    await self.predict(writer, body, params)
+            else:
+                self.respond(writer, 404, {'error': 'Unknown ' + path})
+            await writer.drain()
+        except (ValueError, KeyError, UnicodeDecodeError,
+                asyncio.IncompleteReadError) as e:
+            self.respond(writer, 400, {'error': str(e)})
+        except Exception as e:
+            if self.logger:
+                self.logger.warning("Request failed: {}".format(e))
+            self.respond(writer, 500, {'error': str(e)})
+        finally:
+            writer.close()
+
+    async def predict(self, writer, body, params):
+        """Score the FASTA text in body and stream the results."""
+        threshold = float(params.get('threshold', [self.threshold])[0])
+        dbformat = FORMAT[params.get('fmt', ['free'])[0]]
+        reader = FastaReader(FastaBuilder(dbformat))
+        loop = asyncio.get_event_loop()
+        records = await loop.run_in_executor(
+            None, reader.parse_string, body.decode('utf-8'))
+        futures = self.batcher.submit(records)
+        writer.write(b'HTTP/1.1 200 OK\r\n'
+                     b'Content-Type: application/x-ndjson\r\n'
+                     b'Transfer-Encoding: chunked\r\n'
+                     b'Connection: close\r\n\r\n')
+        start = 0
+        try:
+            for future in futures:
+                results = await future
+                lines = []
+                for seq, (ta, mp) in zip(records[start:], results):
+                    item = make_result_item(seq.identifier, ta, mp,
+                                            seq.sequence, threshold,
+                                            'tabular')
+                    lines.append(json.dumps(item.as_dict()) + '\n')
+                start += len(results)
+                write_chunk(writer, ''.join(lines).encode('utf-8'))
+                await writer.drain()
+        except Exception as e:
+            line = json.dumps({'error': str(e)}) + '\n'
+            write_chunk(writer, line.encode('utf-8'))
+        finally:
+            for future in futures:
+                future.cancel()
+        writer.write(b'0\r\n\r\n')
+
+    def respond(self, writer, status, obj):
+        """Write a complete JSON response."""
+        body = (json.dumps(obj) + '\n').encode('utf-8')
+        writer.write(
+            'HTTP/1.1 {} {}\r\nContent-Type: application/json\r\n'
+            'Content-Length: {}\r\nConnection: close\r\n\r\n'.format(
+                status, REASONS[status], len(body)).encode('latin-1'))
+        writer.write(body)
+
+
+def write_chunk(writer, data):
+    """Write data as a chunk of a chunked transfer encoding."""
+    if data:
+        writer.write('{:x}\r\n'.format(len(data)).encode('latin-1'))
+        writer.write(data + b'\r\n')
+
+
+def parse_cmd(argv):
+    """
+        Parse command line arguments
+    """
+    usage = 'usage: %prog [options]'
+    parser = OptionParser(
+                formatter=IndentedHelpFormatterWithNL(),
+                add_help_option=True, usage=usage)
+    general_opts = OptionGroup(parser, "General options")
+    general_opts.add_option(
+        "--log", dest='logfilename', default='tappm_http',
+        type='string',
+        help="The name of a log file, default is tappm_http.log"
+    )
+    general_opts.add_option(
+        "--log-level", dest='log_level', default='info', type='choice',
+        choices=['debug', 'info', 'warnings', 'error', 'critical', 'none'],
+        help="The log level of the console, default is info."
+    )
+    server_opts = OptionGroup(parser, "Server options")
+    server_opts.add_option(
+        "--host", dest="host", type='string', default='127.0.0.1',
+        help="The address to listen on, default is 127.0.0.1."
+    )
+    server_opts.add_option(
+        "--port", dest="port", type='int', default=8080,
+        help="The port to listen on, default is 8080."
+    )
+    server_opts.add_option(
+        "-t", "--threshold", dest="threshold", type='float',
+        default=-0.0167222981,
+        help="The default threshold value used for final decision to "
+             "predict TA or not. default is -0.0167222981."
+    )
+    server_opts.add_option(
+        "--mcpu", dest="mcpu", type='int', default=None,
+        help="The number of processes, default is the number of cores."
+    )
+    server_opts.add_option(
+        "--backend", dest="backend", type='choice',
+        choices=['process', 'thread'], default='process',
+        help="The kind of decoding workers, see tappm_cli --backend."
+    )
+    server_opts.add_option(
+        "--max-batch", dest="max_batch", type='int', default=32,
+        help="The maximum number of sequences in a batch, default is 32."
+    )
+    server_opts.add_option(
+        "--max-wait", dest="max_wait", type='float', default=10.0,
+        help="The maximum time in milliseconds to wait for a batch to "
+             "fill up, default is 10."
+    )
+    parser.add_option_group(general_opts)
+    parser.add_option_group(server_opts)
+    options, arguments = parser.parse_args(argv)
+    return options
+
+
+def main(argv):
+    opt = parse_cmd(argv)
+    mcpu = opt.mcpu if opt.mcpu else cpu_count()
+    logger = Console('tappm_http', prefix='@>', console=opt.log_level)
+    logger.start(opt.logfilename)
+    logger.info("Loading models.")
+    service = PredictionService(
+        load_predictors(mcpu, opt.backend), threshold=opt.threshold,
+        max_batch=opt.max_batch, max_wait=opt.max_wait / 1000.0,
+        logger=logger)
+
+    async def run():
+        stopped = asyncio.Event()
+        loop = asyncio.get_event_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stopped.set)
+        server = await service.start(opt.host, opt.port)
+        logger.info("Listening on {}:{}".format(opt.host, opt.port))
+        try:
+            await stopped.wait()
+        finally:
+            server.close()
+            await service.stop()
+
+    asyncio.run(run())
+    logger.info("Service stopped.")
+
+
+if __name__ == '__main__':
+    main(sys.argv)
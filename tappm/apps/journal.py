@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+A checkpoint journal of tappm_cli.
+
+While a report is written, the rendered item of every scored record is
+appended to the journal as a line of JSON, and the journal is fsync'd in
+batches. If the run dies, tappm_cli --resume reads the journal back, scores
+only the records missing from it and writes the whole report. The first
+line of the journal describes the run, so that it is not resumed with
+another input or other settings. The journal is removed when the report
+is complete.
+"""
+import os
+import json
+import time
+
+__all__ = ['Journal']
+
+
+class Journal(object):
+    """An append-only journal of the rendered items of a run.
+
+    :arg path: the journal file
+    :arg run: a dictionary describing the input and the settings
+    :arg sync_every: fsync after this number of items at most
+    :arg sync_seconds: fsync after this time (in seconds) at most
+    """
+
+    def __init__(self, path, run, sync_every=256, sync_seconds=5.0):
+        self.path = path
+        self.run = run
+        self.sync_every = sync_every
+        self.sync_seconds = sync_seconds
+        self.items = {}
+        self._file = None
+        self._pending = 0
+        self._synced = time.time()
+
+    def open(self, resume=False):
+        """Open the journal for appending. If resume, the items of a
+        journal of the same run are loaded; otherwise it is started anew.
+        Return the number of items loaded."""
+        end = 0
+        if resume and os.path.exists(self.path):
+            end = self.load()
+        self._file = open(self.path, 'a' if end else 'w')
+        if end:
+            # Drop a line torn by the end of the previous run.
+            self._file.truncate(end)
+        else:
+            self._file.write(json.dumps({'run': self.run}) + '\n')
+            self.sync()
+        return len(self.items)
+
+    def load(self):
+        """Read the items of the journal. Return the offset after the last
+        complete line. Raise ValueError if the journal is of another run.
+        """
+        self.items = {}
+        end = 0
+        with open(self.path, 'rb') as f:
+            first = True
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    entry = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    break
+                if first:
+                    if entry.get('run') != self.run:
+                        raise ValueError(
+                            "The journal {} is of another run".format(
+                                self.path))
+                    first = False
+                else:
+                    self.items[entry['i']] = (entry['id'], entry['item'])
+                end += len(line)
+        return end
+
+    def has(self, index, identifier):
+        """Return True if the item of the index-th record is journaled."""
+        item = self.items.get(index)
+        return item is not None and item[0] == identifier
+
+    def item(self, index):
+        """Return the journaled item of the index-th record."""
+        return self.items[index][1]
+
+    def append(self, entries):
+        """Append [(index, identifier, item), ...]; fsync if a batch is full
+        or the last fsync is old enough."""
+        for index, identifier, item in entries:
+            self._file.write(json.dumps(
+                {'i': index, 'id': identifier, 'item': item}) + '\n')
+        self._pending += len(entries)
+        if self._pending >= self.sync_every or \
+           time.time() - self._synced >= self.sync_seconds:
+            self.sync()
+
+    def sync(self):
+        """Write the appended items through to the disk."""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = 0
+        self._synced = time.time()
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        """Close and delete the journal, once the report is complete."""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+A staged prediction pipeline for tappm_cli.
+
+    reader -> encoder -> scorers -> renderer -> writer
+
+Every stage runs in its own thread and passes chunks of records to the next
+one through a bounded queue, so reading and rendering overlap with scoring
+and no more than a few chunks are held in memory at once. Scorers may finish
+chunks out of order; the renderer puts them back in input order before the
+writer sees them.
+"""
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from tappm.utils import make_result_item
+
+__all__ = ['Pipeline']
+
+# Marks the end of the stream in the queues.
+END = None
+
+
+class Aborted(Exception):
+    """Raised in a stage when another stage has failed."""
+    pass
+
+
+class Pipeline(object):
+    """Score records with the TA and MP predictors and write the report.
+
+    :arg predictors: a tuple of the TA and MP predictors
+    :arg threshold: the threshold of the TA score
+    :arg outfmt: the format of the report, see report.TPL_ITEM_MAP
+    :arg chunksize: the number of records passed between stages at a time
+    :arg depth: the capacity (in chunks) of each queue
+    :arg scorers: the number of scoring threads. By default two threads
+        feed the pool of decoding workers, and one is used otherwise.
+    :arg max_memory: the bytes the records in flight may use. Half of it
+        bounds the chunks held by the stages, which are cut short when
+        their estimated size reaches their share; the other half is shared
+        by the scorers for decoding (see MyHmmPredictor.decode_encoded).
+    :arg journal: an open journal.Journal. Records with an item in it are
+        not scored again, and the items written are appended to it.
+    :arg flush: flush the stream after each chunk, so that a reader of a
+        pipe gets the items as soon as they are scored
+    """
+
+    def __init__(self, predictors, threshold, outfmt, chunksize=64, depth=4,
+                 scorers=None, max_memory=None, journal=None, flush=False):
+        self.predictors = predictors
+        self.threshold = threshold
+        self.outfmt = outfmt
+        self.chunksize = chunksize
+        self.depth = depth
+        if scorers is None:
+            pooled = any(getattr(p.method, 'worker_num', 1) > 1
+                         for p in predictors)
+            scorers = 2 if pooled else 1
+        self.scorers = scorers
+        self.max_memory = max_memory
+        self.journal = journal
+        self.flush = flush
+        self.chunk_memory = self.decode_memory = None
+        if max_memory is not None:
+            # Chunks in the queues, in the stages and in the reorder buffer
+            in_flight = 4 * depth + 2 * scorers + 3
+            self.chunk_memory = max_memory // 2 // in_flight
+            self.decode_memory = max_memory // 2 // scorers
+        self._abort = threading.Event()
+        self._errors = []
+
+    def run(self, records, stream, head='', tail=''):
+        """Score records and write head, the items and tail into stream.
+
+        records may be any iterable of Fasta objects; it is consumed
+        lazily. Return the number of records written."""
+        for predictor in self.predictors:
+            predictor.start()
+        self._abort.clear()
+        self._errors = []
+        self.count = 0
+        parsed = queue.Queue(self.depth)
+        encoded = queue.Queue(self.depth)
+        scored = queue.Queue(self.depth)
+        rendered = queue.Queue(self.depth)
+        stages = [(self.read, (records, parsed)),
+                  (self.encode, (parsed, encoded))]
+        stages += [(self.score, (encoded, scored))] * self.scorers
+        stages += [(self.render, (scored, rendered)),
+                   (self.write, (rendered, stream, head, tail))]
+        threads = [threading.Thread(target=self.guard, args=stage)
+                   for stage in stages]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self._errors:
+            raise self._errors[0]
+        return self.count
+
+    def guard(self, stage, args):
+        """Run a stage; on failure, record the error and stop the others."""
+        try:
+            stage(*args)
+        except Aborted:
+            pass
+        except Exception as e:
+            self._errors.append(e)
+            self._abort.set()
+
+    def put(self, q, item):
+        while True:
+            if self._abort.is_set():
+                raise Aborted()
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def get(self, q):
+        while True:
+            if self._abort.is_set():
+                raise Aborted()
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+    def read(self, records, out):
+        """Group records into numbered chunks."""
+        chunk = []
+        number = 0
+        size = 0
+        try:
+            for index, record in enumerate(records):
+                chunk.append((index, record))
+                if self.chunk_memory is not None:
+                    size += self.record_memory(record)
+                if len(chunk) == self.chunksize or \
+                   (self.chunk_memory is not None and
+                        size >= self.chunk_memory):
+                    self.put(out, (number, chunk))
+                    number += 1
+                    chunk = []
+                    size = 0
+        finally:
+            # Close the input file of a generator (e.g. FastaReader.iter_file)
+            # also when another stage has failed.
+            if hasattr(records, 'close'):
+                records.close()
+        if chunk:
+            self.put(out, (number, chunk))
+        self.put(out, END)
+
+    def encode(self, inq, out):
+        """Convert the sequences of a chunk for both models. The invalid
+        characters dropped are logged in one summary at the end."""
+        ta_predictor, mp_predictor = self.predictors
+        while True:
+            item = self.get(inq)
+            if item is END:
+                # Both encoders have seen the same characters.
+                ta_predictor.encoder.report()
+                mp_predictor.encoder.reset()
+                break
+            number, chunk = item
+            todo = chunk
+            if self.journal is not None:
+                todo = [(i, seq) for i, seq in chunk
+                        if not self.journal.has(i, seq.identifier)]
+            ta = [ta_predictor.encode_record(seq, reverse=True)
+                  for i, seq in todo]
+            mp = [mp_predictor.encode_record(seq) for i, seq in todo]
+            self.put(out, (number, chunk, todo, ta, mp))
+        for i in range(self.scorers):
+            self.put(out, END)
+
+    def record_memory(self, record):
+        """Estimate the bytes held for a record while it is in flight."""
+        length = len(record.sequence)
+        return length + sum(p.sequence_memory(length)
+                            for p in self.predictors)
+
+    def score(self, inq, out):
+        """Decode a chunk with both models."""
+        ta_predictor, mp_predictor = self.predictors
+        while True:
+            item = self.get(inq)
+            if item is END:
+                break
+            number, chunk, todo, ta, mp = item
+            ta = ta_predictor.decode_encoded(
+                ta, reverse=True, max_memory=self.decode_memory)
+            mp = mp_predictor.decode_encoded(
+                mp, max_memory=self.decode_memory)
+            self.put(out, (number, chunk, todo, ta, mp))
+        self.put(out, END)
+
+    def render(self, inq, out):
+        """Render chunks in input order."""
+        pending = {}
+        expected = 0
+        running = self.scorers
+        while running:
+            item = self.get(inq)
+            if item is END:
+                running -= 1
+                continue
+            pending[item[0]] = item
+            while expected in pending:
+                number, chunk, todo, ta, mp = pending.pop(expected)
+                expected += 1
+                done = [(i, seq.identifier,
+                         make_result_item(seq.identifier, t, m, seq.sequence,
+                                          self.threshold,
+                                          self.outfmt).render())
+                        for (i, seq), t, m in zip(todo, ta, mp)]
+                if len(done) == len(chunk):
+                    text = ''.join(item for i, name, item in done)
+                else:
+                    # Fill in the items from the journal
+                    items = dict((i, item) for i, name, item in done)
+                    text = ''.join(items[i] if i in items
+                                   else self.journal.item(i)
+                                   for i, seq in chunk)
+                self.put(out, (len(chunk), text, done))
+        self.put(out, END)
+
+    def write(self, inq, stream, head, tail):
+        """Write the report into stream."""
+        stream.write(head)
+        while True:
+            item = self.get(inq)
+            if item is END:
+                break
+            count, text, done = item
+            stream.write(text)
+            if self.flush:
+                stream.flush()
+            if self.journal is not None:
+                self.journal.append(done)
+            self.count += count
+        stream.write(tail)
+        stream.flush()
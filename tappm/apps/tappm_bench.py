@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+"""
+Benchmarks of tappm.
+
+Each benchmark runs its trials in a fresh child process, so that timings
+and peak memory usage of one trial do not affect the others.
+
+Usage:
+    python -m "tappm.apps.tappm_bench" BENCHMARK [options] -i xx.fasta
+
+Benchmarks:
+    backends   Decode the input with the serial model and with the process
+               and thread backends of MyHmmPredictor.
+    latency    Run tappm_cli end to end on the first 1, 4 and 16 sequences
+               of the input, decoding in-process (the default for small
+               inputs) and with the workers (--serial-work 0).
+    parse      Parse the input repeated --scale times with
+               FastaReader.parse_file and with BulkFastaReader, into a
+               buffer of residues and into Fasta objects.
+"""
+import os
+import sys
+import time
+import shutil
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+
+from optparse import OptionParser, OptionGroup
+
+from tappm import FastaReader, FastaBuilder
+from tappm.fasta import BasicProteinFasta
+from tappm.bulk_reader import BulkFastaReader
+from tappm.utils import IndentedHelpFormatterWithNL
+from tappm.apps.tappm_cli import load_predictors
+from tappm.hmm.hmm import SERIAL_WORK
+
+__all__ = ['BENCHMARKS', 'run_trial']
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """Register a function (opt) -> list of result rows as a benchmark."""
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def _trial_main(func, args, results):
+    start = time.time()
+    row = func(*args)
+    row['seconds'] = row.get('seconds', time.time() - start)
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux.
+    row['maxrss_mb'] = (usage + children) / 1024.0
+    results.put(row)
+
+
+def run_trial(func, *args):
+    """Run func(*args) in a child process and return its result row.
+
+    func returns a dictionary; 'seconds' (if missing) and 'maxrss_mb' are
+    added. The latter is the peak resident memory of the child plus that of
+    the largest process it has started (e.g. one worker of a pool)."""
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=_trial_main, args=(func, args, results))
+    process.start()
+    row = results.get()
+    process.join()
+    return row
+
+
+def read_records(filename):
+    """Read the sequences of a benchmark input."""
+    reader = FastaReader(FastaBuilder(BasicProteinFasta))
+    return reader.parse_file(filename)
+
+
+def decode_trial(filename, mcpu, backend, repeat):
+    """Decode the input repeat times; return the best time."""
+    records = read_records(filename)
+    predictors = load_predictors(mcpu, backend)
+    for predictor in predictors:
+        predictor.start()
+    best = float('inf')
+    try:
+        for i in range(repeat):
+            start = time.time()
+            predictors[0].predict_sequences(records, reverse=True)
+            predictors[1].predict_sequences(records)
+            best = min(best, time.time() - start)
+    finally:
+        for predictor in predictors:
+            predictor.close()
+    residues = sum(len(seq) for seq in records)
+    return {'backend': backend if mcpu > 1 else 'serial',
+            'workers': mcpu,
+            'seconds': best,
+            'seq/s': len(records) / best,
+            'residues/s': residues / best}
+
+
+@benchmark('backends')
+def bench_backends(opt):
+    """Compare the serial, process and thread decoding backends."""
+    rows = [run_trial(decode_trial, opt.fastafile, 1, 'process', opt.repeat)]
+    for backend in ('process', 'thread'):
+        rows.append(run_trial(decode_trial, opt.fastafile, opt.mcpu,
+                              backend, opt.repeat))
+    return rows
+
+
+def write_records(records, filename):
+    """Write records into a fasta file."""
+    with open(filename, 'w') as f:
+        for seq in records:
+            f.write('>{}\n{}\n'.format(seq.identifier, seq.sequence))
+
+
+def latency_trial(filename, mcpu, serial_work, repeat, workdir):
+    """Run tappm_cli on filename repeat times; return the best wall time of
+    the whole command, from the start of Python to its exit."""
+    command = [sys.executable, '-m', 'tappm.apps.tappm_cli',
+               '-i', filename, '--outdir', workdir, '--out', 'latency',
+               '--log', os.path.join(workdir, 'latency'),
+               '--log-level', 'none', '--no-tuning', '--no-checkpoint',
+               '--mcpu', str(mcpu), '--serial-work', str(serial_work)]
+    best = float('inf')
+    with open(os.devnull, 'w') as null:
+        for i in range(repeat):
+            start = time.time()
+            subprocess.check_call(command, stdout=null, stderr=null)
+            best = min(best, time.time() - start)
+    return best
+
+
+@benchmark('latency')
+def bench_latency(opt):
+    """Time tappm_cli on a few sequences, in-process and with workers."""
+    records = read_records(opt.fastafile)
+    workdir = tempfile.mkdtemp(prefix='tappm_bench')
+    rows = []
+    try:
+        for count in (1, 4, 16):
+            filename = os.path.join(workdir, 'input{}.fasta'.format(count))
+            write_records(records[:count], filename)
+            residues = sum(len(seq) for seq in records[:count])
+            for mode, serial_work in (('in-process', SERIAL_WORK),
+                                      ('workers', 0)):
+                seconds = latency_trial(filename, opt.mcpu, serial_work,
+                                        opt.repeat, workdir)
+                rows.append({'sequences': count, 'residues': residues,
+                             'mode': mode, 'workers': opt.mcpu,
+                             'seconds': seconds})
+    finally:
+        shutil.rmtree(workdir)
+    return rows
+
+
+def parse_trial(filename, parser, repeat):
+    """Parse filename repeat times with parser; return the best time."""
+    builder = FastaBuilder(BasicProteinFasta)
+    best = float('inf')
+    for i in range(repeat):
+        start = time.time()
+        if parser == 'parse_file':
+            count = len(FastaReader(builder).parse_file(filename))
+        elif parser == 'bulk':
+            count = len(BulkFastaReader(builder).parse_file(filename))
+        else:
+            count = sum(1 for seq in BulkFastaReader(builder)
+                        .iter_file(filename))
+        best = min(best, time.time() - start)
+    megabytes = os.path.getsize(filename) / float(1 << 20)
+    return {'parser': parser, 'records': count, 'MB': megabytes,
+            'seconds': best, 'MB/s': megabytes / best}
+
+
+@benchmark('parse')
+def bench_parse(opt):
+    """Compare FastaReader and BulkFastaReader on a scaled-up input."""
+    workdir = tempfile.mkdtemp(prefix='tappm_bench')
+    filename = os.path.join(workdir, 'scaled.fasta')
+    try:
+        with open(opt.fastafile, 'rb') as f:
+            data = f.read()
+        if not data.endswith(b'\n'):
+            data += b'\n'
+        with open(filename, 'wb') as f:
+            for i in range(opt.scale):
+                f.write(data)
+        return [run_trial(parse_trial, filename, parser, opt.repeat)
+                for parser in ('parse_file', 'bulk', 'bulk+records')]
+    finally:
+        shutil.rmtree(workdir)
+
+
+def print_rows(rows, stream=sys.stdout):
+    """Print result rows as a table."""
+    if not rows:
+        return
+    columns = list(rows[0].keys())
+    widths = [max(len(c), 10) for c in columns]
+    stream.write('  '.join(c.rjust(w) for c, w in zip(columns, widths)))
+    stream.write('\n')
+    for row in rows:
+        cells = []
+        for c, w in zip(columns, widths):
+            value = row.get(c, '')
+            if isinstance(value, float):
+                value = '{:.3f}'.format(value)
+            cells.append(str(value).rjust(w))
+        stream.write('  '.join(cells) + '\n')
+
+
+def parse_cmd(argv):
+    """
+        Parse command line arguments
+    """
+    usage = 'usage: %prog BENCHMARK [options] -i xx.fasta\n\nBENCHMARK: ' + \
+            ', '.join(sorted(BENCHMARKS))
+    parser = OptionParser(
+                formatter=IndentedHelpFormatterWithNL(),
+                add_help_option=True, usage=usage)
+    bench_opts = OptionGroup(parser, "Benchmark options")
+    bench_opts.add_option(
+        "-i", "--inputfile", dest="fastafile",
+        help="The input file in fasta format[REQUIRED]."
+    )
+    bench_opts.add_option(
+        "--mcpu", dest="mcpu", type='int',
+        default=multiprocessing.cpu_count(),
+        help="The number of workers, default is the number of cores."
+    )
+    bench_opts.add_option(
+        "--repeat", dest="repeat", type='int', default=3,
+        help="The number of repetitions of each trial, default is 3."
+    )
+    bench_opts.add_option(
+        "--scale", dest="scale", type='int', default=20,
+        help="The times the input is repeated by the parse benchmark, "
+             "default is 20."
+    )
+    parser.add_option_group(bench_opts)
+    options, arguments = parser.parse_args(argv)
+    if len(arguments) < 2 or arguments[1] not in BENCHMARKS:
+        print ("Error: specify one of the benchmarks")
+        parser.print_help()
+        sys.exit(1)
+    if not options.fastafile:
+        print ("Error: do not specify an input file")
+        parser.print_help()
+        sys.exit(1)
+    return arguments[1], options
+
+
+def main(argv):
+    name, opt = parse_cmd(argv)
+    print_rows(BENCHMARKS[name](opt))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
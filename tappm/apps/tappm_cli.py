@@ -33,18 +33,34 @@ davecao@bi.a.u-tokyo.ac.jp
 """
 import os
 import sys
+import time
+import glob
 # import json
 # import numpy as np
 
-from signal import signal, SIGPIPE, SIG_DFL
+from io import StringIO
+from signal import signal, SIGPIPE, SIGTERM, SIG_DFL, SIG_IGN
 from multiprocessing import cpu_count
 from optparse import OptionParser, OptionGroup
 
 from tappm import FastaReader, FastaBuilder, MyHmmPredictor, MODELPATH
 from tappm.fasta import SwissProt, TrEMBLE, GenBank_refseq, BasicProteinFasta
-from tappm.utils import Console, IndentedHelpFormatterWithNL,\
-                        convert_numpy_types
-from tappm.io import report
+from tappm.utils import Console, IndentedHelpFormatterWithNL
+from tappm.io import render_report_parts, \
+                     merge_reports, open_report, pathtools
+from tappm.bulk_reader import ParallelFastaReader
+from tappm.tappmdb import TappmDB, TappmDBWriter, is_database, DB_SUFFIX
+from tappm.apps.daemon import PredictionServer, request_prediction
+from tappm.apps.pipeline import Pipeline
+from tappm.apps.workqueue import WorkQueue, LeaseKeeper, LeaseLost, \
+                                 worker_name
+from tappm.apps.journal import Journal
+from tappm.apps.watcher import DirectoryWatcher
+from tappm.hmm.affinity import plan as plan_affinity
+from tappm.hmm.hmm_mp import WORKER_BYTES
+from tappm.hmm.hmm import SERIAL_WORK
+from tappm.apps.tuning import calibrate, load_profile, save_profile, \
+                              profile_path
 
 __date__ = "2016/01/16"
 __version__ = "1.0.0"
@@ -69,6 +85,133 @@ MODELS = {
               'LLLLLLLLLLLLLLLLLLLLCCCCCHHHHHHHHHHHHHHHHHHHHHHHHH'
 }
 
+BACKENDS = ['process', 'thread']
+
+# Estimated memory (bytes) of this process and the fork server with the
+# models loaded, before any sequence is read.
+BASE_MEMORY = 64 << 20
+
+SIZE_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+# Suffixes dropped from the name of an input file to name its report.
+INPUT_SUFFIXES = ('.gz', '.bz2', '.zip', '.fasta', '.fas', '.fa', '.faa',
+                  '.fsa', DB_SUFFIX)
+
+
+def parse_size(text):
+    """
+        Parse a size such as 4G, 512M or 1000000 into bytes
+    """
+    text = text.strip().upper()
+    if text.endswith('B'):
+        text = text[:-1]
+    unit = text[-1:] if text[-1:] in SIZE_UNITS else ''
+    number = text[:len(text) - len(unit)]
+    try:
+        return int(float(number) * SIZE_UNITS[unit])
+    except ValueError:
+        raise ValueError("Invalid size: {}".format(text))
+
+
+def parse_shard(text):
+    """
+        Parse a shard such as 2/8 into (2, 8)
+    """
+    try:
+        index, total = [int(n) for n in text.split('/')]
+    except ValueError:
+        raise ValueError("Invalid shard: {}, expected i/N".format(text))
+    if not 1 <= index <= total:
+        raise ValueError("Invalid shard: {}, i must be in 1..N".format(text))
+    return index, total
+
+
+def expand_inputs(patterns):
+    """
+        Expand the wildcards of the input files, keeping the given order
+    """
+    inputs = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                raise ValueError("no file matches {}".format(pattern))
+            inputs.extend(matches)
+        else:
+            inputs.append(pattern)
+    return inputs
+
+
+def read_manifest(filename):
+    """
+        Read the (input file, report name) pairs of a manifest
+
+    Each line holds an input file and, optionally, the name of its report
+    (without suffix, in --outdir); blank lines and lines starting with '#'
+    are skipped. Relative input files are relative to the manifest.
+    """
+    base = os.path.dirname(os.path.abspath(filename))
+    jobs = []
+    with open(filename) as f:
+        for number, line in enumerate(f, 1):
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            if len(fields) > 2:
+                raise ValueError("line {}: expected INPUT [OUTPUT]".format(
+                    number))
+            inputfile = os.path.join(base, fields[0])
+            name = fields[1] if len(fields) == 2 else report_name(inputfile)
+            jobs.append((inputfile, name))
+    return jobs
+
+
+def report_name(inputfile):
+    """
+        Name the report of an input file after it, e.g. xx.fasta.gz -> xx
+    """
+    name = os.path.basename(inputfile)
+    while True:
+        stem, suffix = os.path.splitext(name)
+        if not stem or suffix.lower() not in INPUT_SUFFIXES:
+            return name
+        name = stem
+
+
+def plan_jobs(options):
+    """
+        Return the (input file, report name) pairs of a run
+    """
+    inputs = expand_inputs(options.fastafiles or [])
+    if len(inputs) == 1 and not options.manifest:
+        return [(inputs[0], options.outfile)]
+    jobs = [(inputfile, report_name(inputfile)) for inputfile in inputs]
+    if options.manifest:
+        jobs.extend(read_manifest(options.manifest))
+    names = [name for inputfile, name in jobs]
+    for name in names:
+        if names.count(name) > 1:
+            raise ValueError("two reports would be named {}".format(name))
+    return jobs
+
+
+def plan_memory(max_memory, mcpu, backend='process'):
+    """
+        Fit the workers into max_memory bytes.
+        Return the number of workers and the bytes left for the sequences
+    """
+    left = max_memory - BASE_MEMORY
+    if backend == 'process' and mcpu > 1:
+        # The TA and MP pools may take half of the rest.
+        fit = int(left // 2 // (2 * WORKER_BYTES))
+        mcpu = max(1, min(mcpu, fit))
+        if mcpu > 1:
+            left -= 2 * mcpu * WORKER_BYTES
+    if left <= 0:
+        raise ValueError("{} bytes are too few, at least {} are needed"
+                         .format(max_memory, BASE_MEMORY))
+    return mcpu, left
+
 
 def parse_cmd(argv):
     """
@@ -89,8 +232,9 @@ def parse_cmd(argv):
     general_opts.add_option(
         "--log-level", dest='log_level', default='info', type='choice',
         choices=['debug', 'info', 'warnings', 'error', 'critical', 'none'],
-        help="The name of a log file. If not specified, the name will" +
-             " be tappm_cli.log"
+        help="The level of the messages logged, including those of the HMM "
+             "core and its worker processes ('debug' logs every decoded "
+             "sequence), default is 'info'."
     )
     general_opts.add_option(
         "-v", "--verbose",
@@ -100,14 +244,31 @@ def parse_cmd(argv):
     # --- 1. input and output ---
     inout_opts = OptionGroup(parser, "Input/output settings")
     inout_opts.add_option(
-        "-i", "--inputfile", dest="fastafile",
-        help="The input file in fasta format[REQUIRED]."
+        "-i", "--inputfile", dest="fastafiles", action="append",
+        help="The input file in fasta format[REQUIRED]. It may be given "
+             "several times or be a pattern such as 'data/*.fasta'; the "
+             "report of each file is then named after it (xx.fasta -> "
+             "OUTDIR/xx.OUTFMT). '-' reads the standard input."
+    )
+    inout_opts.add_option(
+        "--manifest", dest="manifest", type='string', default=None,
+        metavar="FILE",
+        help="Process the input files listed in FILE, one per line with "
+             "the name of its report optionally after it. The models and "
+             "workers are loaded once for all files."
     )
     inout_opts.add_option(
         "--fmt", dest="dbformat", default="free", type='choice',
         choices=['swissprot', 'tremble', 'genebank', 'free'],
         help="The format of the input file, default 'free'."
     )
+    inout_opts.add_option(
+        "--decompress-thread", dest="decompress_thread",
+        action="store_true", default=False,
+        help="Decompress a gzip, bzip2 or zip input file in a thread of "
+             "its own, ahead of the parsing. Compressed files are found by "
+             "their content, whatever their names."
+    )
     # inout_opts.add_option(
     #     "-m", "--modelfile", dest="modelfile",
     #     help="The HMM model file[REQUIRED]."
@@ -129,6 +290,8 @@ def parse_cmd(argv):
         "--out", dest="outfile", type='string',
         default='tappm_report',
         help="Specify the output file name, default is 'tappm_report.tabular'."
+             " '-' writes the report to the standard output as the "
+             "sequences are scored."
     )
 
     inout_opts.add_option(
@@ -137,6 +300,31 @@ def parse_cmd(argv):
         help="The threshold value used for"
              "final decision to predict TA or not. default is -0.0167222981."
     )
+    inout_opts.add_option(
+        "--shard", dest="shard", type='string', default=None,
+        metavar="i/N",
+        help="Process only the i-th of N shards of the input file (i from "
+             "1 to N): the records whose headers start in the i-th of N "
+             "equal byte ranges. Merge the reports of all shards with "
+             "'tappm_cli merge'."
+    )
+    inout_opts.add_option(
+        "--resume", dest="resume", action="store_true", default=False,
+        help="Continue an interrupted run: the records in the journal of "
+             "the report (OUTFILE.journal) are not scored again."
+    )
+    inout_opts.add_option(
+        "--checkpoint", dest="checkpoint", action="store_true",
+        default=None,
+        help="Keep the journal of the scored records that --resume needs "
+             "(OUTFILE.journal). It is the default unless the input or the "
+             "output is a pipe (-i - or --out -), where it is an error."
+    )
+    inout_opts.add_option(
+        "--no-checkpoint", dest="checkpoint", action="store_false",
+        help="Do not keep the journal of the scored records that --resume "
+             "needs."
+    )
     # --- 2. Multithreads options ---
     multihtreads_opts = OptionGroup(
          parser,
@@ -148,9 +336,158 @@ def parse_cmd(argv):
         "--mcpu", dest="mcpu", type='int', default=None,
         help="The number of threads, default is the number of cores."
     )
+    multihtreads_opts.add_option(
+        "--backend", dest="backend", type='choice',
+        choices=BACKENDS, default=None,
+        help="The kind of workers used for decoding: 'process' (a pool of "
+             "processes, each with a copy of the models) or 'thread' (a "
+             "pool of threads sharing one copy), default is 'process'."
+    )
+    multihtreads_opts.add_option(
+        "--chunksize", dest="chunksize", type='int', default=None,
+        help="The number of sequences passed between the stages of the "
+             "prediction at a time, default is 64."
+    )
+    multihtreads_opts.add_option(
+        "--max-memory", dest="max_memory", type='string', default=None,
+        metavar="SIZE",
+        help="The memory the prediction may use, e.g. 4G or 500M. The "
+             "number of workers and the sequences in flight are limited to "
+             "fit, and long sequences are decoded by a slower engine that "
+             "needs little memory. By default there is no limit."
+    )
+    multihtreads_opts.add_option(
+        "--serial-work", dest="serial_work", type='float',
+        default=SERIAL_WORK, metavar="WORK",
+        help="Inputs needing less decoding work than WORK (the sum of "
+             "N*K*K over sequences of N residues and models of K states) "
+             "are decoded in this process without starting workers, "
+             "default is {:g}. 0 always starts them.".format(SERIAL_WORK)
+    )
+    multihtreads_opts.add_option(
+        "--affinity", dest="affinity", type='string', default=None,
+        metavar="POLICY",
+        help="Bind each worker process to a CPU: 'compact' (the CPUs of "
+             "one NUMA node after another), 'spread' (NUMA nodes in turn) "
+             "or a list of CPUs such as 0-3,8. By default workers are not "
+             "bound. Only for the process backend."
+    )
+    multihtreads_opts.add_option(
+        "--parse-workers", dest="parse_workers", type='int', default=0,
+        metavar="N",
+        help="Parse the input file in N worker processes, a byte range "
+             "each, while the parsed records are scored. For large "
+             "uncompressed inputs; by default it is parsed as it is read."
+    )
+    # --- 3. Daemon options ---
+    daemon_opts = OptionGroup(
+         parser,
+         "Daemon options",
+         "Keep the models loaded in a background server and send inputs "
+         "to it through a Unix domain socket."
+    )
+    daemon_opts.add_option(
+        "--serve", dest="serve", type='string', default=None,
+        metavar="SOCKET",
+        help="Run as a daemon listening on the Unix domain socket SOCKET."
+    )
+    daemon_opts.add_option(
+        "--connect", dest="connect", type='string', default=None,
+        metavar="SOCKET",
+        help="Send the input file to the daemon listening on SOCKET "
+             "instead of loading the models."
+    )
+    # --- 4. Work queue options ---
+    queue_opts = OptionGroup(
+         parser,
+         "Work queue options",
+         "Share the work of one input among worker processes on any number "
+         "of hosts through a queue in a SQLite file."
+    )
+    queue_opts.add_option(
+        "--coordinator", dest="coordinator", type='string', default=None,
+        metavar="QUEUE",
+        help="Cut the input file into work units in the queue file QUEUE, "
+             "wait until the workers have scored all of them and write the "
+             "report. Restarting it with the same QUEUE keeps the work done."
+    )
+    queue_opts.add_option(
+        "--worker", dest="worker", type='string', default=None,
+        metavar="QUEUE",
+        help="Score the work units of the queue file QUEUE until all of "
+             "them are done."
+    )
+    queue_opts.add_option(
+        "--units", dest="units", type='int', default=16,
+        help="The number of work units of the input, default is 16."
+    )
+    queue_opts.add_option(
+        "--lease", dest="lease", type='float', default=300.0,
+        metavar="SECONDS",
+        help="A unit whose worker has not been heard of for SECONDS goes "
+             "back to the queue, default is 300."
+    )
+    queue_opts.add_option(
+        "--poll", dest="poll", type='float', default=2.0,
+        metavar="SECONDS",
+        help="The interval of checking the queue or the watched directory, "
+             "default is 2."
+    )
+    # --- 5. Watch options ---
+    watch_opts = OptionGroup(
+         parser,
+         "Watch options",
+         "Keep the models loaded and score the fasta files (xx.fasta, "
+         "xx.fa.gz, ...) put into a directory as they arrive. A file is "
+         "taken once it has not changed for a poll."
+    )
+    watch_opts.add_option(
+        "--watch", dest="watch", type='string', default=None,
+        metavar="DIR",
+        help="Watch the directory DIR and write the report of each new "
+             "file into OUTDIR, named after the file."
+    )
+    watch_opts.add_option(
+        "--watch-record", dest="watch_record", type='string', default=None,
+        metavar="FILE",
+        help="The file recording the processed files, which are never "
+             "processed again, default is OUTDIR/.tappm_processed."
+    )
+    watch_opts.add_option(
+        "--once", dest="once", action="store_true", default=False,
+        help="Stop when no new file is left in DIR instead of watching it."
+    )
+    # --- 6. Tuning options ---
+    tuning_opts = OptionGroup(
+         parser,
+         "Tuning options",
+         "The tuning profile of a host holds the fastest settings found by "
+         "--calibrate. It is loaded automatically; options given on the "
+         "command line take precedence."
+    )
+    tuning_opts.add_option(
+        "--calibrate", dest="calibrate", action="store_true", default=False,
+        help="Time short runs on synthetic sequences with various numbers "
+             "of workers, backends and chunk sizes, and write the fastest "
+             "into the tuning profile."
+    )
+    tuning_opts.add_option(
+        "--tuning", dest="tuning", type='string', default=None,
+        metavar="FILE",
+        help="The tuning profile, default is "
+             "~/.tappm/tuning-HOSTNAME.json."
+    )
+    tuning_opts.add_option(
+        "--no-tuning", dest="no_tuning", action="store_true", default=False,
+        help="Do not load the tuning profile."
+    )
     parser.add_option_group(general_opts)
     parser.add_option_group(inout_opts)
     parser.add_option_group(multihtreads_opts)
+    parser.add_option_group(daemon_opts)
+    parser.add_option_group(queue_opts)
+    parser.add_option_group(watch_opts)
+    parser.add_option_group(tuning_opts)
 
     options, arguments = parser.parse_args(argv)
     if arguments == 0:
@@ -158,84 +495,853 @@ def parse_cmd(argv):
         parser.print_help()
         sys.exit(1)
 
+    if options.affinity:
+        if options.backend not in (None, 'process'):
+            print ("Error: --affinity needs the process backend")
+            parser.print_help()
+            sys.exit(1)
+        try:
+            plan_affinity(options.affinity)
+        except ValueError as e:
+            print ("Error: --affinity: {}".format(e))
+            sys.exit(1)
+
+    modes = [name for name in ('serve', 'connect', 'coordinator', 'worker',
+                               'watch')
+             if getattr(options, name)]
+    if len(modes) > 1:
+        print ("Error: --{} are exclusive".format(' and --'.join(modes)))
+        parser.print_help()
+        sys.exit(1)
+
+    if options.shard:
+        if modes:
+            print ("Error: --shard cannot be used with --{}".format(modes[0]))
+            sys.exit(1)
+        try:
+            options.shard = parse_shard(options.shard)
+        except ValueError as e:
+            print ("Error: --shard: {}".format(e))
+            sys.exit(1)
+
+    if options.max_memory:
+        try:
+            options.max_memory = parse_size(options.max_memory)
+        except ValueError as e:
+            print ("Error: --max-memory: {}".format(e))
+            sys.exit(1)
+
     # check input fasta files
-    if not options.fastafile:
+    try:
+        options.jobs = plan_jobs(options)
+    except (IOError, OSError, ValueError) as e:
+        print ("Error: input files: {}".format(e))
+        sys.exit(1)
+    if not options.jobs and not options.serve and \
+       not options.calibrate and not options.worker and not options.watch:
         print ("Error: do not specify an input file")
         parser.print_help()
         sys.exit(1)
+    options.fastafile = None
+    if len(options.jobs) == 1:
+        options.fastafile = options.jobs[0][0]
+    if options.watch and options.jobs:
+        print ("Error: --watch takes no input file")
+        sys.exit(1)
+    if len(options.jobs) > 1:
+        for name in modes + ['shard']:
+            if getattr(options, name):
+                print ("Error: --{} takes a single input file".format(name))
+                sys.exit(1)
+    if any(inputfile == pathtools.STDIO for inputfile, name in options.jobs):
+        if len(options.jobs) > 1:
+            print ("Error: the standard input (-i -) must be the only input")
+            sys.exit(1)
+        for name in ('shard', 'coordinator', 'resume', 'checkpoint'):
+            if getattr(options, name):
+                print ("Error: --{} cannot read the standard input".format(
+                    name))
+                sys.exit(1)
+    if options.outfile == pathtools.STDIO:
+        for name in ('resume', 'checkpoint'):
+            if getattr(options, name):
+                print ("Error: --{} cannot write the standard output".format(
+                    name))
+                sys.exit(1)
+        if len(options.jobs) > 1 or options.watch or options.serve or \
+           options.worker:
+            print ("Error: --out - takes a single input file")
+            sys.exit(1)
+        if options.verbose:
+            print ("Error: --verbose cannot be used with --out -")
+            sys.exit(1)
 
     return options
 
 
+def start_console(label, opt):
+    """
+        Start the console and the log file, which also take the records of
+        the HMM core and of its worker processes
+    """
+    console = Console(label, prefix='@>', console=opt.log_level)
+    console.start(opt.logfilename)
+    console.capture('tappm', opt.log_level)
+    return console
+
+
+def apply_tuning(opt):
+    """
+        Take the settings not given on the command line from the tuning
+        profile, if any. Return the profile used or None
+    """
+    profile = None if opt.no_tuning else load_profile(opt.tuning)
+    if profile is not None:
+        mcpu = profile.get('mcpu')
+        backend = profile.get('backend')
+        chunksize = profile.get('chunksize')
+        if opt.mcpu is None and isinstance(mcpu, int) and mcpu > 0:
+            opt.mcpu = mcpu
+        # Workers are bound to CPUs by the process backend only.
+        if opt.backend is None and backend in BACKENDS and not opt.affinity:
+            opt.backend = backend
+        if opt.chunksize is None and isinstance(chunksize, int) and \
+           chunksize > 0:
+            opt.chunksize = chunksize
+    opt.backend = opt.backend or 'process'
+    opt.chunksize = opt.chunksize or 64
+    return profile
+
+
+def run_calibration(opt):
+    """
+        Find the fastest settings and write them into the tuning profile
+    """
+    LOGGER.info("Calibrating on synthetic sequences.")
+    LOGGER.timeit(label='calibration')
+    profile = calibrate(load_predictors, max_workers=opt.mcpu,
+                        logger=LOGGER)
+    path = save_profile(profile, opt.tuning)
+    LOGGER.report(msg='Calibrated in %.2fs', label='calibration')
+    LOGGER.info("Best: mcpu={mcpu} backend={backend} chunksize={chunksize}"
+                .format(**profile))
+    LOGGER.info("Tuning profile written into {}".format(path))
+
+
+def load_predictors(mcpu, backend='process', affinity=None,
+                    serial_work=SERIAL_WORK):
+    """
+        Load the TA and MP predictors
+    """
+    # TA prediction
+    ta_predictor = MyHmmPredictor(filename=MODELS['TA'], cpus=mcpu,
+                                  backend=backend, affinity=affinity,
+                                  serial_work=serial_work)
+    ta_predictor.set_decoder(MODELS['TACODE'])
+    # MP prediction
+    mp_predictor = MyHmmPredictor(filename=MODELS['MP'], cpus=mcpu,
+                                  backend=backend, affinity=affinity,
+                                  serial_work=serial_work)
+    mp_predictor.set_decoder(MODELS['MPCODE'])
+    return ta_predictor, mp_predictor
+
+
+def is_small_input(opt, reader, predictors):
+    """
+        Return True if the input files need less decoding work than
+        --serial-work, so that starting workers does not pay off
+    """
+    if not opt.serial_work:
+        return False
+    unit = sum(predictor.decoding_work(1) for predictor in predictors)
+    limit = opt.serial_work / unit
+    residues = 0
+    for inputfile, name in opt.jobs:
+        if inputfile == pathtools.STDIO:
+            # It cannot be read twice.
+            return False
+        try:
+            residues += reader.count_residues(inputfile, limit - residues)
+        except (IOError, OSError):
+            # Reported when the file is read for scoring
+            continue
+        if residues > limit:
+            return False
+    return residues * unit < opt.serial_work
+
+
+def log_worker_stats(predictors):
+    """
+        Log the throughput of each decoding worker
+    """
+    for name, predictor in zip(('TA', 'MP'), predictors):
+        for stats in predictor.worker_stats():
+            cpu = 'CPU {}'.format(stats['cpu']) \
+                if stats['cpu'] is not None else 'unbound'
+            LOGGER.info(
+                "  {} worker {pid} ({}): {sequences} sequences, "
+                "{residues/s:.0f} residues/s".format(name, cpu, **stats))
+
+
+def serve(opt, mcpu):
+    """
+        Run the prediction daemon until it is interrupted
+    """
+    LOGGER.info("Loading models.")
+    predictors = load_predictors(mcpu, opt.backend, opt.affinity,
+                                 opt.serial_work)
+    server = PredictionServer(opt.serve, predictors, FORMAT,
+                              chunksize=opt.chunksize, logger=LOGGER)
+    signal(SIGTERM, lambda signum, frame: sys.exit(0))
+    # A client that goes away fails its request, not the daemon.
+    signal(SIGPIPE, SIG_IGN)
+    LOGGER.info("Listening on {}".format(opt.serve))
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        LOGGER.info("Daemon stopped.")
+
+
+def open_journal(opt, inputfile, outputfile, shard=None):
+    """
+        Open the checkpoint journal of the report, loading it if --resume
+    """
+    stat = os.stat(inputfile)
+    run = {'input': os.path.abspath(inputfile), 'size': stat.st_size,
+           'mtime': stat.st_mtime, 'dbformat': opt.dbformat,
+           'threshold': opt.threshold, 'outfmt': opt.outfmt, 'shard': shard}
+    journal = Journal(outputfile + '.journal', run)
+    try:
+        loaded = journal.open(resume=opt.resume)
+    except ValueError as e:
+        LOGGER.error("{}; run without --resume to start anew".format(e))
+        sys.exit(1)
+    if opt.resume:
+        LOGGER.info("Resuming with {} records from {}".format(
+            loaded, journal.path))
+    return journal
+
+
+def coordinate(opt, inputfile, outputfile):
+    """
+        Fill the work queue with the units of the input, wait until they
+        are done and write the report
+    """
+    queue = WorkQueue(opt.coordinator)
+    inputpath = os.path.abspath(inputfile)
+    reader = FastaReader(FastaBuilder(FORMAT[opt.dbformat]), protein=True)
+    units = []
+    for i in range(1, opt.units + 1):
+        try:
+            start, end = reader.shard_range(inputfile, i, opt.units)
+        except ValueError as e:
+            LOGGER.error("{}".format(e))
+        if start < end:
+            units.append((inputpath, start, end))
+    if not units:
+        LOGGER.warning("The input {} has no records".format(inputfile))
+    settings = {'input': inputpath, 'dbformat': opt.dbformat,
+                'threshold': repr(opt.threshold), 'outfmt': opt.outfmt}
+    if queue.setup(units, **settings):
+        LOGGER.info("Queued {} work units in {}".format(
+            len(units), opt.coordinator))
+    else:
+        meta = queue.get_meta()
+        changed = [k for k, v in settings.items() if meta.get(k) != v]
+        if changed:
+            LOGGER.error("The queue {} was made with another {}".format(
+                opt.coordinator, ', '.join(sorted(changed))))
+            sys.exit(1)
+        LOGGER.info("Resuming the queue {}".format(opt.coordinator))
+    last = None
+    while True:
+        expired = queue.requeue_expired()
+        if expired:
+            LOGGER.warning("Re-queued {} units with expired leases".format(
+                expired))
+        counts = queue.counts()
+        if counts != last:
+            LOGGER.info("Units: {pending} pending, {leased} leased, "
+                        "{done} done".format(**counts))
+            last = counts
+        if queue.finished():
+            break
+        time.sleep(opt.poll)
+    totalSeq = queue.total_records()
+    head, tail = render_report_parts(fmt=opt.outfmt, threshold=opt.threshold,
+                                     totalSeq=totalSeq)
+    with open_report(outputfile, backupCount=5) as fout:
+        fout.write(head)
+        for text in queue.iter_results():
+            fout.write(text)
+        fout.write(tail)
+    queue.close()
+    LOGGER.info("Wrote {} sequences into {}".format(totalSeq, outputfile))
+
+
+def work(opt, mcpu):
+    """
+        Score the units of the work queue until all of them are done
+    """
+    queue = WorkQueue(opt.worker)
+    name = worker_name()
+    predictors = None
+    done = 0
+    try:
+        while True:
+            unit = queue.lease(name, opt.lease)
+            if unit is None:
+                if queue.finished():
+                    break
+                time.sleep(opt.poll)
+                continue
+            unit_id, inputfile, start, end = unit
+            meta = queue.get_meta()
+            if predictors is None:
+                LOGGER.info("Loading models.")
+                predictors = load_predictors(mcpu, opt.backend, opt.affinity,
+                                             opt.serial_work)
+            reader = FastaReader(FastaBuilder(FORMAT[meta['dbformat']]),
+                                 protein=True)
+            pipeline = Pipeline(predictors, float(meta['threshold']),
+                                meta['outfmt'], chunksize=opt.chunksize)
+            keeper = LeaseKeeper(opt.worker, unit_id, name, opt.lease)
+            keeper.start()
+            out = StringIO()
+            try:
+                # Stop scoring as soon as the lease is lost.
+                count = pipeline.run(keeper.guard(
+                    reader.iter_file(inputfile, byte_range=(start, end))),
+                    out)
+            except LeaseLost:
+                pass
+            finally:
+                keeper.stop()
+            if keeper.lost:
+                # Another worker may own the unit now.
+                LOGGER.warning("Unit {}: the lease was lost; its result is "
+                               "dropped".format(unit_id))
+                continue
+            if queue.complete(unit_id, name, count, out.getvalue()):
+                done += 1
+                LOGGER.info("Unit {}: {} sequences".format(unit_id, count))
+            else:
+                LOGGER.warning("Unit {} was done by another worker".format(
+                    unit_id))
+    finally:
+        if predictors is not None:
+            for predictor in predictors:
+                predictor.close()
+        queue.close()
+    LOGGER.info("No more work units; {} done by this worker.".format(done))
+
+
+def watch(opt, mcpu):
+    """
+        Score the fasta files arriving in a directory until interrupted
+    """
+    data_memory = None
+    if opt.max_memory:
+        try:
+            mcpu, data_memory = plan_memory(opt.max_memory, mcpu,
+                                            opt.backend)
+        except ValueError as e:
+            LOGGER.error("--max-memory: {}".format(e))
+    record = opt.watch_record or os.path.join(opt.outdir, '.tappm_processed')
+    watcher = DirectoryWatcher(opt.watch, record)
+    reader = FastaReader(FastaBuilder(FORMAT[opt.dbformat]), protein=True,
+                         threaded=opt.decompress_thread)
+    LOGGER.info("Loading models.")
+    predictors = load_predictors(mcpu, opt.backend, opt.affinity,
+                                 opt.serial_work)
+    for predictor in predictors:
+        predictor.start()
+    signal(SIGTERM, lambda signum, frame: sys.exit(0))
+    LOGGER.info("Watching {} ({} files processed before)".format(
+        opt.watch, len(watcher.processed)))
+    try:
+        while True:
+            ready = watcher.poll()
+            for path in ready:
+                outputfile = opt.outdir + os.sep + report_name(path) + \
+                    '.' + opt.outfmt
+                try:
+                    count = predict_file(opt, predictors, reader, path,
+                                         outputfile, data_memory)
+                except Exception as e:
+                    # A broken file must not stop the watcher.
+                    LOGGER.warning("{}: {}".format(path, e))
+                    watcher.done(path, error=str(e))
+                    continue
+                watcher.done(path, outputfile, count)
+            if opt.once and not ready and not watcher.waiting:
+                break
+            if not ready:
+                time.sleep(opt.poll)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        for predictor in predictors:
+            predictor.close()
+    log_worker_stats(predictors)
+    LOGGER.info("Stopped watching {}".format(opt.watch))
+
+
+def parse_merge_cmd(argv):
+    """
+        Parse command line arguments of the merge subcommand
+    """
+    usage = 'usage: %prog merge [options] --out OUTFILE SHARD_REPORT...'
+    parser = OptionParser(
+                formatter=IndentedHelpFormatterWithNL(),
+                add_help_option=True, usage=usage)
+    parser.add_option(
+        "--outfmt", dest="outfmt", type='choice',
+        choices=['tabular', 'text', 'xml'], default='tabular',
+        help="The format of the shard reports and of the merged report, "
+             "default is tabular."
+    )
+    parser.add_option(
+        "--out", dest="outfile", type='string', default=None,
+        help="The merged report[REQUIRED]."
+    )
+    parser.add_option(
+        "--log", dest='logfilename', default='tappm_cli',
+        help="The name of a log file. default is tappm_cli.log."
+    )
+    parser.add_option(
+        "--log-level", dest='log_level', default='info', type='choice',
+        choices=['debug', 'info', 'warnings', 'error', 'critical', 'none'],
+        help="The level of logging information displayed in the console."
+    )
+    options, arguments = parser.parse_args(argv[2:])
+    if not options.outfile or not arguments:
+        print ("Error: specify the merged report and the shard reports")
+        parser.print_help()
+        sys.exit(1)
+    return options, arguments
+
+
+def merge(argv):
+    """
+        Merge the reports of the shards of an input
+    """
+    global LOGGER
+    opt, filenames = parse_merge_cmd(argv)
+    LOGGER = Console('merge', prefix='@>', console=opt.log_level)
+    LOGGER.start(opt.logfilename)
+    LOGGER.info("cmd: {}".format(' '.join(argv)))
+    try:
+        totalSeq = merge_reports(filenames, opt.outfile, fmt=opt.outfmt)
+    except (IOError, OSError, ValueError) as e:
+        LOGGER.error("merge: {}".format(e))
+        sys.exit(1)
+    LOGGER.info("Merged {} shard reports into {}".format(
+        len(filenames), opt.outfile))
+    if totalSeq is not None:
+        LOGGER.info("Total input sequences: {}".format(totalSeq))
+
+
+def parse_index_cmd(argv):
+    """
+        Parse command line arguments of the index subcommand
+    """
+    usage = 'usage: %prog index [options] FASTAFILE...'
+    parser = OptionParser(
+                formatter=IndentedHelpFormatterWithNL(),
+                add_help_option=True, usage=usage)
+    parser.add_option(
+        "--fetch", dest="fetch", action="append", default=[],
+        metavar="NAME[:START-END]",
+        help="Write the record NAME (the first word of its header) of the "
+             "fasta file, or its residues START to END (from 1, END "
+             "included), to the standard output in fasta format. It may be "
+             "given several times."
+    )
+    parser.add_option(
+        "--log", dest='logfilename', default='tappm_cli',
+        help="The name of a log file. default is tappm_cli.log."
+    )
+    parser.add_option(
+        "--log-level", dest='log_level', default='info', type='choice',
+        choices=['debug', 'info', 'warnings', 'error', 'critical', 'none'],
+        help="The level of logging information displayed in the console."
+    )
+    options, arguments = parser.parse_args(argv[2:])
+    if not arguments or (options.fetch and len(arguments) != 1):
+        print ("Error: specify the fasta files, or one fasta file with "
+               "--fetch")
+        parser.print_help()
+        sys.exit(1)
+    return options, arguments
+
+
+def parse_region(text):
+    """Parse NAME[:START-END] into (NAME, start, end) with start from 0 and
+    end excluded (None for the whole record)."""
+    name, sep, region = text.rpartition(':')
+    if not sep or '-' not in region:
+        return text, 0, None
+    start, end = region.split('-', 1)
+    try:
+        start, end = int(start), int(end)
+    except ValueError:
+        return text, 0, None
+    if start < 1 or end < start:
+        raise ValueError("Invalid region {}".format(text))
+    return name, start - 1, end
+
+
+def index(argv):
+    """
+        Build the indexes of fasta files and fetch records by name
+    """
+    global LOGGER
+    opt, filenames = parse_index_cmd(argv)
+    LOGGER = Console('index', prefix='@>', console=opt.log_level)
+    LOGGER.start(opt.logfilename)
+    LOGGER.info("cmd: {}".format(' '.join(argv)))
+    reader = FastaReader(FastaBuilder(BasicProteinFasta), protein=True)
+    for filename in filenames:
+        try:
+            fasta_index = reader.index(filename)
+        except (IOError, OSError, ValueError) as e:
+            LOGGER.error("index: {}".format(e))
+        LOGGER.info("{}: {} records, {} residues".format(
+            filename, len(fasta_index), int(fasta_index.length.sum())))
+    for text in opt.fetch:
+        try:
+            name, start, end = parse_region(text)
+            i = fasta_index.lookup(name)
+        except (KeyError, ValueError) as e:
+            LOGGER.error("--fetch: {}".format(e.args[0]))
+        header = fasta_index.header(i)
+        if end is not None:
+            header = '>{}:{}-{}'.format(name, start + 1, end)
+        sequence = fasta_index.sequence(i, start, end)
+        sys.stdout.write(header + '\n')
+        for k in range(0, len(sequence), 60):
+            sys.stdout.write(sequence[k:k + 60] + '\n')
+    fasta_index.close()
+
+
+def parse_convert_cmd(argv):
+    """
+        Parse command line arguments of the convert subcommand
+    """
+    usage = 'usage: %prog convert [options] FASTAFILE...\n' \
+            '       %prog convert --verify TAPPMDBFILE...'
+    parser = OptionParser(
+                formatter=IndentedHelpFormatterWithNL(),
+                add_help_option=True, usage=usage)
+    parser.add_option(
+        "--fmt", dest="dbformat", default="free", type='choice',
+        choices=['swissprot', 'tremble', 'genebank', 'free'],
+        help="The format of the headers of the fasta files, default 'free'."
+    )
+    parser.add_option(
+        "--out", dest="outfile", type='string', default=None,
+        help="The file written, with a single fasta file. By default "
+             "xx.fasta is converted into xx" + DB_SUFFIX + " next to it."
+    )
+    parser.add_option(
+        "--verify", dest="verify", action="store_true", default=False,
+        help="Check the checksums of " + DB_SUFFIX + " files instead."
+    )
+    parser.add_option(
+        "--log", dest='logfilename', default='tappm_cli',
+        help="The name of a log file. default is tappm_cli.log."
+    )
+    parser.add_option(
+        "--log-level", dest='log_level', default='info', type='choice',
+        choices=['debug', 'info', 'warnings', 'error', 'critical', 'none'],
+        help="The level of logging information displayed in the console."
+    )
+    options, arguments = parser.parse_args(argv[2:])
+    if not arguments or (options.outfile and len(arguments) != 1):
+        print ("Error: specify the fasta files, or one fasta file with "
+               "--out")
+        parser.print_help()
+        sys.exit(1)
+    return options, arguments
+
+
+def convert(argv):
+    """
+        Convert fasta files into tappmdb files, or verify tappmdb files
+    """
+    global LOGGER
+    opt, filenames = parse_convert_cmd(argv)
+    LOGGER = Console('convert', prefix='@>', console=opt.log_level)
+    LOGGER.start(opt.logfilename)
+    LOGGER.info("cmd: {}".format(' '.join(argv)))
+    if opt.verify:
+        for filename in filenames:
+            try:
+                with TappmDB(filename) as db:
+                    ok = db.verify()
+            except (IOError, OSError, ValueError) as e:
+                LOGGER.error("convert: {}".format(e))
+            if not ok:
+                LOGGER.error("{}: the checksum does not match".format(
+                    filename))
+            LOGGER.info("{}: {} records, {} residues, OK".format(
+                filename, len(db), db.residues))
+        return
+    reader = FastaReader(FastaBuilder(FORMAT[opt.dbformat]), protein=True)
+    for filename in filenames:
+        outfile = opt.outfile or os.path.join(
+            os.path.dirname(filename), report_name(filename) + DB_SUFFIX)
+        LOGGER.timeit(label='convert')
+        try:
+            with TappmDBWriter(outfile, source=os.path.basename(filename),
+                               dbformat=opt.dbformat) as writer:
+                for record in reader.iter_file(filename):
+                    writer.add(record)
+        except (IOError, OSError, ValueError) as e:
+            LOGGER.error("convert: {}".format(e))
+        LOGGER.report(msg='{}: {} records, {} residues in %.2fs'.format(
+            outfile, len(writer.lengths), sum(writer.lengths)),
+            label='convert')
+
+
 def main(argv):
 
     global LOGGER
+    if len(argv) > 1 and argv[1] == 'merge':
+        merge(argv)
+        return
+    if len(argv) > 1 and argv[1] == 'index':
+        index(argv)
+        return
+    if len(argv) > 1 and argv[1] == 'convert':
+        convert(argv)
+        return
     # parse command line arguments
     cmds = ' '.join(argv)
     opt = parse_cmd(argv)
     # general opts
     verbose = opt.verbose
+    if opt.calibrate:
+        LOGGER = start_console('calibrate', opt)
+        LOGGER.info("cmd: {}".format(cmds))
+        run_calibration(opt)
+        return
+    profile = apply_tuning(opt)
+    mcpu = opt.mcpu if opt.mcpu else cpu_count()
+    if opt.worker:
+        LOGGER = start_console(worker_name(), opt)
+        LOGGER.info("cmd: {}".format(cmds))
+        work(opt, mcpu)
+        return
+    if opt.serve:
+        LOGGER = start_console(os.path.basename(opt.serve), opt)
+        LOGGER.info("cmd: {}".format(cmds))
+        serve(opt, mcpu)
+        return
+    if opt.watch:
+        LOGGER = start_console(os.path.basename(os.path.normpath(opt.watch)),
+                               opt)
+        LOGGER.info("cmd: {}".format(cmds))
+        watch(opt, mcpu)
+        return
     # input and output
     inputfile = opt.fastafile
     dbformat = FORMAT[opt.dbformat]
     threshold = opt.threshold
     outfmt = opt.outfmt
-    outputfile = opt.outdir + os.sep + opt.outfile + '.' + outfmt
+    outputfile = report_path(opt, opt.outfile)
 
-    # input file path, name, and ext
-    inputfilename = os.path.basename(inputfile)
-    mcpu = opt.mcpu if opt.mcpu else cpu_count()
     # Logger settings
-    logfile = opt.logfilename
-    log_label = inputfilename
-    LOGGER = Console(log_label, prefix='@>', console=opt.log_level)
-    # LOGGER = Console(log_label, prefix='@>')
-    LOGGER.start(logfile)
-
-    # Load fasta file
-    reader = FastaReader(FastaBuilder(dbformat), protein=True)
-    fasta_list = reader.parse_file(inputfile)
+    log_label = os.path.basename(inputfile) if inputfile else 'tappm_cli'
+    LOGGER = start_console(log_label, opt)
+
+    if opt.coordinator:
+        LOGGER.info("cmd: {}".format(cmds))
+        LOGGER.info("Input file: {}".format(inputfile))
+        coordinate(opt, inputfile, outputfile)
+        return
+
+    if opt.connect:
+        if is_database(inputfile):
+            LOGGER.error("--connect: send the fasta file, not {}".format(
+                inputfile))
+        LOGGER.info("cmd: {}".format(cmds))
+        LOGGER.info("Input file: {}".format(inputfile))
+        LOGGER.info("Send to the daemon on {}".format(opt.connect))
+        LOGGER.timeit(label='prediction')
+        # The head of the report shows the count of a standalone run.
+        count = None
+        if inputfile != pathtools.STDIO:
+            count = FastaReader(FastaBuilder(FORMAT[opt.dbformat])) \
+                .count_records(inputfile, scan=False)
+        try:
+            with open_report(outputfile, backupCount=5) as fout:
+                totalSeq = request_prediction(
+                    opt.connect, inputfile, fout,
+                    threaded=opt.decompress_thread,
+                    name=os.path.basename(inputfile), dbformat=opt.dbformat,
+                    threshold=threshold, outfmt=outfmt, totalSeq=count)
+        except (IOError, OSError, RuntimeError, ValueError) as e:
+            LOGGER.error("--connect {}: {}".format(opt.connect, e))
+        LOGGER.info("Read {} sequences".format(totalSeq))
+        LOGGER.report(msg='Completed in %.2fs', label='prediction')
+        if verbose:
+            print("Finished")
+        return
+
+    data_memory = None
+    if opt.max_memory:
+        try:
+            mcpu, data_memory = plan_memory(opt.max_memory, mcpu,
+                                            opt.backend)
+        except ValueError as e:
+            LOGGER.error("--max-memory: {}".format(e))
+            sys.exit(1)
+
     if verbose:
-        print("Input file: {}".format(inputfile))
-        print("Read {} sequences".format(len(fasta_list)))
         print("Paramters:")
         print("  threshold:{:10.6f}".format(threshold))
         print("  nCPU: {}".format(mcpu))
         print("  Model:{}".format(MODELPATH))
     LOGGER.info("cmd: {}".format(cmds))
-    LOGGER.info("Input file: {}".format(inputfile))
-    LOGGER.info("Read {} sequences".format(len(fasta_list)))
     LOGGER.info("Paramters:")
     LOGGER.info("  threshold:{:10.6f}".format(threshold))
     LOGGER.info("  nCPU: {}".format(mcpu))
-    # MyHmmPredictor
-    # TA prediction
-    ta_predictor = MyHmmPredictor(filename=MODELS['TA'], cpus=mcpu)
-    ta_predictor.set_decoder(MODELS['TACODE'])
-    # MP prediction
-    mp_predictor = MyHmmPredictor(filename=MODELS['MP'], cpus=mcpu)
-    mp_predictor.set_decoder(MODELS['MPCODE'])
-    # print MODELS['MPCODE']
+    LOGGER.info("  backend: {}".format(opt.backend))
+    LOGGER.info("  chunksize: {}".format(opt.chunksize))
+    if profile is not None:
+        LOGGER.info("  tuning profile: {}".format(opt.tuning or
+                                                  profile_path()))
+    if opt.affinity:
+        LOGGER.info("  affinity: {}".format(opt.affinity))
+    if opt.max_memory:
+        LOGGER.info("  max memory: {} bytes".format(opt.max_memory))
+    # The models, the workers and the templates are loaded once and used
+    # for every input file.
+    reader = FastaReader(FastaBuilder(dbformat), protein=True,
+                         threaded=opt.decompress_thread)
+    predictors = load_predictors(mcpu, opt.backend, opt.affinity,
+                                 opt.serial_work)
+    if mcpu > 1 and is_small_input(opt, reader, predictors):
+        LOGGER.info("Small input: decoding in this process.")
+        for predictor in predictors:
+            predictor.initialize(1)
+    failed = []
+    try:
+        for inputfile, name in opt.jobs:
+            outputfile = report_path(opt, name)
+            try:
+                predict_file(opt, predictors, reader, inputfile, outputfile,
+                             data_memory)
+            except (IOError, OSError) as e:
+                if len(opt.jobs) == 1:
+                    raise
+                # One unreadable file does not stop the others.
+                LOGGER.warning("{}: {}".format(inputfile, e))
+                failed.append(inputfile)
+    finally:
+        for predictor in predictors:
+            predictor.close()
+    log_worker_stats(predictors)
+    if len(opt.jobs) > 1:
+        LOGGER.info("Processed {} of {} input files".format(
+            len(opt.jobs) - len(failed), len(opt.jobs)))
+    if verbose:
+        print("Finished")
+    if failed:
+        sys.exit(1)
+
+
+def report_path(opt, name):
+    """
+        Return the report file named name; '-' is the standard output
+    """
+    if name == pathtools.STDIO:
+        return name
+    return opt.outdir + os.sep + name + '.' + opt.outfmt
+
+
+def open_records(opt, reader, inputfile, byte_range=None, encoder=None):
+    """
+        Return an iterator of the records of an input file, parsed by
+        --parse-workers processes if given; they also encode the records
+        with encoder if given
+    """
+    if opt.parse_workers > 0 and not is_database(inputfile):
+        if inputfile != pathtools.STDIO and \
+           not pathtools.compression(inputfile):
+            parser = ParallelFastaReader(reader.builder, opt.parse_workers,
+                                         encoder=encoder)
+            return parser.iter_file(inputfile, byte_range)
+        LOGGER.info("{} is compressed or a stream: parsed as it is "
+                    "read".format(inputfile))
+    return reader.iter_file(inputfile, byte_range=byte_range)
+
+
+def predict_file(opt, predictors, reader, inputfile, outputfile,
+                 data_memory=None):
+    """
+        Score an input file with loaded predictors and write its report
+    """
+    byte_range = shard = None
+    if opt.shard:
+        try:
+            byte_range = reader.shard_range(inputfile, *opt.shard)
+        except ValueError as e:
+            LOGGER.error("--shard: {}".format(e))
+        shard = '{}/{}'.format(*opt.shard)
+    # The records are counted ahead only if that needs no reading of the
+    # input (a tappmdb file or a saved index); otherwise the report shows
+    # NA and the count of the run is logged.
+    streamed = pathtools.STDIO in (inputfile, outputfile)
+    totalSeq = None
+    if inputfile != pathtools.STDIO:
+        totalSeq = reader.count_records(inputfile, byte_range, scan=False)
+    if opt.verbose:
+        print("Input file: {}".format(inputfile))
+        if totalSeq is not None:
+            print("Read {} sequences".format(totalSeq))
+    LOGGER.info("Input file: {}".format(inputfile))
+    if shard:
+        unit = 'records' if is_database(inputfile) else 'bytes'
+        LOGGER.info("Shard {}: {} {} to {}".format(shard, unit, *byte_range))
+    if totalSeq is not None:
+        LOGGER.info("Read {} sequences".format(totalSeq))
     LOGGER.info("Start to scan sequences.")
     LOGGER.timeit(label='prediction')
-    prediction_ta = ta_predictor.predict(fasta_list, reverse=True)
-    prediction_mp = mp_predictor.predict(fasta_list)
-    resultList = convert_numpy_types(
-                    prediction_ta,
-                    prediction_mp,
-                    threshold,
-                    outfmt,
-                    fasta_list)
+    # Results are rendered and written while the sequences are scanned.
+    head, tail = render_report_parts(
+        fmt=opt.outfmt, threshold=opt.threshold,
+        totalSeq='NA' if totalSeq is None else totalSeq, shard=shard)
+    journal = None
+    # parse_cmd has rejected --checkpoint and --resume with a pipe.
+    if (opt.checkpoint is not False or opt.resume) and not streamed:
+        journal = open_journal(opt, inputfile, outputfile, shard)
+    pipeline = Pipeline(predictors, opt.threshold, opt.outfmt,
+                        chunksize=opt.chunksize, max_memory=data_memory,
+                        journal=journal,
+                        flush=outputfile == pathtools.STDIO)
+    try:
+        with open_report(outputfile, backupCount=5) as fout:
+            count = pipeline.run(
+                open_records(opt, reader, inputfile, byte_range,
+                             predictors[0].encoder),
+                fout, head, tail)
+    finally:
+        if journal is not None:
+            journal.close()
+    if journal is not None:
+        journal.remove()
     LOGGER.report(msg='Completed in %.2fs', label='prediction')
-    if verbose:
-        print("Prepare output")
-    LOGGER.info("Prepare output")
-    LOGGER.timeit(label='output')
-    report(resultList, outputfile, fmt=outfmt, backupCount=5,
-           threshold=threshold, totalSeq=len(fasta_list))
-    LOGGER.report(msg='Completed in %.2fs', label='output')
-    if verbose:
-        print("Finished")
+    if totalSeq is None:
+        totalSeq = count
+        LOGGER.info("Scored {} sequences".format(totalSeq))
+    LOGGER.info("Report: {}".format(outputfile))
+    return totalSeq
 
 
 if __name__ == '__main__':
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Per-host tuning profiles of tappm_cli.
+
+tappm_cli --calibrate times short runs of the pipeline on synthetic
+sequences with the shipped models and writes the fastest settings (the
+number of workers, the backend and the chunk size) into a JSON profile of
+the host. Later runs on the host load it and use its settings where no
+option is given on the command line.
+"""
+import os
+import json
+import time
+import socket
+import random
+import datetime
+
+from multiprocessing import cpu_count
+
+from tappm import FastaReader, FastaBuilder
+from tappm.fasta import BasicProteinFasta
+from tappm.apps.pipeline import Pipeline
+
+__all__ = ['profile_path', 'load_profile', 'save_profile', 'calibrate']
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+# The relative gain a setting needs to replace a faster-found one.
+MARGIN = 0.03
+
+
+def profile_path(host=None):
+    """Return the path of the tuning profile of a host (default: this one).
+    """
+    host = host or socket.gethostname()
+    return os.path.join(os.path.expanduser('~'), '.tappm',
+                        'tuning-{}.json'.format(host))
+
+
+def load_profile(path=None):
+    """Read a tuning profile; return None if there is none or it is broken.
+    """
+    path = path or profile_path()
+    try:
+        with open(path) as f:
+            profile = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if not isinstance(profile, dict):
+        return None
+    return profile
+
+
+def save_profile(profile, path=None):
+    """Write a tuning profile and return its path."""
+    path = path or profile_path()
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(profile, f, indent=2, sort_keys=True)
+    os.rename(tmp, path)
+    return path
+
+
+def synthetic_records(count=120, seed=0):
+    """Make random protein sequences with lengths typical of a proteome."""
+    rng = random.Random(seed)
+    lines = []
+    for n in range(count):
+        length = int(min(2000, max(50, rng.lognormvariate(5.8, 0.6))))
+        lines.append('>sp|SYN{0}|SYN{0}_CAL Synthetic OS=None'.format(n))
+        lines.append(''.join(rng.choice(AMINO_ACIDS) for i in range(length)))
+    reader = FastaReader(FastaBuilder(BasicProteinFasta), protein=True)
+    return reader.parse_string('\n'.join(lines))
+
+
+def worker_counts(limit=None):
+    """Return the numbers of workers worth trying: 1, 2, 4, ... limit."""
+    limit = limit or cpu_count()
+    counts = [1]
+    while counts[-1] * 2 < limit:
+        counts.append(counts[-1] * 2)
+    if limit > 1:
+        counts.append(limit)
+    return counts
+
+
+def time_trial(load_predictors, records, mcpu, backend, chunksize,
+               threshold=-0.0167222981, outfmt='tabular'):
+    """Run the pipeline once over records; return the sequences per second.
+    """
+    predictors = load_predictors(mcpu, backend)
+    try:
+        for predictor in predictors:
+            predictor.start()
+        pipeline = Pipeline(predictors, threshold, outfmt,
+                            chunksize=chunksize)
+        with open(os.devnull, 'w') as null:
+            start = time.time()
+            pipeline.run(iter(records), null)
+            seconds = time.time() - start
+    finally:
+        for predictor in predictors:
+            predictor.close()
+    return len(records) / seconds
+
+
+def calibrate(load_predictors, max_workers=None, count=120, logger=None):
+    """Time the settings on synthetic sequences and return a profile.
+
+    :arg load_predictors: a function (mcpu, backend) -> the TA and MP
+        predictors, i.e. tappm_cli.load_predictors
+    :arg max_workers: the largest number of workers tried, default is the
+        number of cores
+    :arg count: the number of synthetic sequences of a trial
+    """
+    records = synthetic_records(count)
+    trials = []
+
+    def trial(mcpu, backend, chunksize):
+        rate = time_trial(load_predictors, records, mcpu, backend, chunksize)
+        trials.append({'mcpu': mcpu, 'backend': backend,
+                       'chunksize': chunksize, 'seq/s': rate})
+        if logger is not None:
+            logger.info("  mcpu={} backend={} chunksize={}: {:.1f} seq/s"
+                        .format(mcpu, backend, chunksize, rate))
+        return rate
+
+    # Workers and backend first, then the chunk size with the best of them.
+    # A setting replaces the best one only if it is clearly faster, so that
+    # timing noise does not move away from the defaults.
+    rate, mcpu, backend = trial(1, 'process', 64), 1, 'process'
+    for workers in worker_counts(max_workers)[1:]:
+        for kind in ('process', 'thread'):
+            new_rate = trial(workers, kind, 64)
+            if new_rate > rate * (1 + MARGIN):
+                rate, mcpu, backend = new_rate, workers, kind
+    chunksize = 64
+    for size in (16, 256):
+        new_rate = trial(mcpu, backend, size)
+        if new_rate > rate * (1 + MARGIN):
+            rate, chunksize = new_rate, size
+    return {'host': socket.gethostname(),
+            'cpu_count': cpu_count(),
+            'created': datetime.datetime.now().isoformat(),
+            'mcpu': mcpu,
+            'backend': backend,
+            'chunksize': chunksize,
+            'trials': trials}
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+A watched directory of tappm_cli.
+
+tappm_cli --watch DIR polls DIR for fasta files (xx.fasta, xx.fa.gz, ...)
+and scores each new one with the models and workers it keeps loaded. A
+file is taken once its size and modification time have not changed for a
+poll, so that files still being copied are left alone. The processed files
+are recorded in a file of their own, one line of JSON each, so that a
+restarted watcher does not process them again.
+"""
+import os
+import json
+import time
+
+__all__ = ['DirectoryWatcher', 'FASTA_SUFFIXES']
+
+# The suffixes of the fasta files taken from a watched directory; they may
+# be followed by one of COMPRESSED_SUFFIXES.
+FASTA_SUFFIXES = ('.fasta', '.fas', '.fa', '.faa', '.fsa')
+COMPRESSED_SUFFIXES = ('.gz', '.bz2', '.zip')
+
+
+def is_fasta(name):
+    """Return True if name is the name of a (compressed) fasta file."""
+    if name.startswith('.'):
+        return False
+    name, suffix = os.path.splitext(name.lower())
+    if suffix not in COMPRESSED_SUFFIXES:
+        name += suffix
+    return name.endswith(FASTA_SUFFIXES)
+
+
+class DirectoryWatcher(object):
+    """Find the new fasta files of a directory.
+
+    :arg directory: the watched directory
+    :arg record: the file recording the processed files
+    """
+
+    def __init__(self, directory, record):
+        self.directory = directory
+        self.record = record
+        self.processed = set()
+        # The new files found by the last poll that are not ready yet
+        self.waiting = []
+        self._seen = {}
+        if os.path.exists(record):
+            self.load()
+
+    def load(self):
+        """Read the names of the processed files from the record."""
+        with open(self.record) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line torn by the end of a previous watcher
+                    continue
+                self.processed.add(entry['name'])
+
+    def poll(self):
+        """Return the paths of the new files that are ready, oldest first.
+        """
+        ready = []
+        seen = {}
+        self.waiting = []
+        for name in os.listdir(self.directory):
+            if name in self.processed or not is_fasta(name):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if not os.path.isfile(path):
+                continue
+            state = (stat.st_size, stat.st_mtime)
+            seen[name] = state
+            # Unchanged since the previous poll: it is complete.
+            if self._seen.get(name) == state:
+                ready.append((stat.st_mtime, name, path))
+            else:
+                self.waiting.append(name)
+        self._seen = seen
+        return [path for mtime, name, path in sorted(ready)]
+
+    def done(self, path, report=None, count=None, error=None):
+        """Record a file as processed, with its report or the error."""
+        name = os.path.basename(path)
+        entry = {'name': name, 'time': time.time(), 'report': report,
+                 'count': count}
+        if error is not None:
+            entry['error'] = error
+        with open(self.record, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.processed.add(name)
+        self._seen.pop(name, None)
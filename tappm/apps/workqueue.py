@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+A durable work queue of tappm_cli, kept in a SQLite file.
+
+The coordinator (tappm_cli --coordinator QUEUE -i xx.fasta) cuts the input
+into shards (see FastaReader.shard_range), one work unit each, and waits
+for them to be done. Workers (tappm_cli --worker QUEUE) lease a unit,
+score it and store the rendered items compressed. A lease that is not
+renewed in time expires, and the unit goes back to the queue for another
+worker; so a worker may die at any point. A worker that loses its lease
+drops its work on the unit. When every unit is done, the coordinator
+writes the report from the stored items in the order of the input.
+
+The file uses SQLite's rollback journal, which relies on file locks only;
+workers on other hosts may share it over a network file system whose
+locks work (e.g. NFS with a lock manager). WAL mode is not used, as it
+needs memory shared by all the processes on one host.
+"""
+import os
+import time
+import zlib
+import socket
+import sqlite3
+import threading
+
+__all__ = ['WorkQueue', 'LeaseKeeper', 'LeaseLost', 'worker_name']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS units (
+    id INTEGER PRIMARY KEY,
+    input TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    end INTEGER NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS results (
+    unit INTEGER PRIMARY KEY REFERENCES units(id),
+    count INTEGER NOT NULL,
+    body BLOB NOT NULL
+);
+"""
+
+# Put the units with an expired lease back into the queue.
+REQUEUE = ("UPDATE units SET state = 'pending', worker = NULL, "
+           "expires = NULL WHERE state = 'leased' AND expires < ?")
+
+
+def worker_name():
+    """Return a name identifying this worker process."""
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class WorkQueue(object):
+    """A queue of work units in the SQLite file path.
+
+    Units are rows of the table units; a unit is 'pending', 'leased' (until
+    expires, by worker) or 'done', with its items in the table results.
+    Every change is made in an immediate transaction, so any number of
+    processes may use the same file.
+    """
+
+    def __init__(self, path, timeout=60.0):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=timeout,
+                                  isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=DELETE')
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def transaction(self):
+        """Return a context manager of an immediate transaction."""
+        return Transaction(self.db)
+
+    # --- Set-up by the coordinator ---
+
+    def get_meta(self):
+        """Return the settings of the queue as a dictionary."""
+        return dict(self.db.execute('SELECT key, value FROM meta'))
+
+    def setup(self, units, **meta):
+        """Fill an empty queue with units [(input, start, end), ...] and
+        the settings meta. Return False (and change nothing) if the queue
+        has been set up already."""
+        with self.transaction():
+            if self.db.execute('SELECT COUNT(*) FROM units').fetchone()[0] \
+               or self.db.execute('SELECT COUNT(*) FROM meta').fetchone()[0]:
+                return False
+            self.db.executemany(
+                'INSERT INTO units (input, start, end) VALUES (?, ?, ?)',
+                units)
+            self.db.executemany(
+                'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                [(k, str(v)) for k, v in meta.items()])
+        return True
+
+    # --- Leases, used by the workers ---
+
+    def requeue_expired(self, now=None):
+        """Put the units whose lease has expired back into the queue.
+        Return their number."""
+        now = time.time() if now is None else now
+        with self.transaction():
+            cursor = self.db.execute(REQUEUE, (now,))
+        return cursor.rowcount
+
+    def lease(self, worker, seconds):
+        """Lease the first pending unit to worker for seconds.
+        Return (id, input, start, end) or None if no unit is pending."""
+        now = time.time()
+        with self.transaction():
+            self.db.execute(REQUEUE, (now,))
+            unit = self.db.execute(
+                "SELECT id, input, start, end FROM units "
+                "WHERE state = 'pending' ORDER BY id LIMIT 1").fetchone()
+            if unit is None:
+                return None
+            self.db.execute(
+                "UPDATE units SET state = 'leased', worker = ?, expires = ?, "
+                "attempts = attempts + 1 WHERE id = ?",
+                (worker, now + seconds, unit[0]))
+        return unit
+
+    def renew(self, unit, worker, seconds):
+        """Extend the lease of unit held by worker. Return False if the
+        worker does not hold it any more."""
+        with self.transaction():
+            cursor = self.db.execute(
+                "UPDATE units SET expires = ? "
+                "WHERE id = ? AND state = 'leased' AND worker = ?",
+                (time.time() + seconds, unit, worker))
+        return cursor.rowcount == 1
+
+    def complete(self, unit, worker, count, text):
+        """Store the rendered items (text) of count records of unit.
+
+        The first result of a unit is kept, even if it comes from a worker
+        whose lease has expired. Return False if the unit was done already.
+        """
+        body = zlib.compress(text.encode('utf-8'))
+        with self.transaction():
+            state = self.db.execute(
+                "SELECT state FROM units WHERE id = ?", (unit,)).fetchone()
+            if state is None or state[0] == 'done':
+                return False
+            self.db.execute(
+                "INSERT INTO results (unit, count, body) VALUES (?, ?, ?)",
+                (unit, count, sqlite3.Binary(body)))
+            self.db.execute(
+                "UPDATE units SET state = 'done', worker = ?, expires = NULL "
+                "WHERE id = ?", (worker, unit))
+        return True
+
+    # --- Progress and results ---
+
+    def counts(self):
+        """Return the numbers of units by state."""
+        counts = {'pending': 0, 'leased': 0, 'done': 0}
+        counts.update(self.db.execute(
+            'SELECT state, COUNT(*) FROM units GROUP BY state'))
+        return counts
+
+    def finished(self):
+        """Return True if the queue has been set up and none of its units
+        is pending or leased. A queue set up with no units (an empty
+        input) is finished."""
+        if not self.db.execute('SELECT COUNT(*) FROM meta').fetchone()[0]:
+            return False
+        counts = self.counts()
+        return counts['pending'] == counts['leased'] == 0
+
+    def total_records(self):
+        """Return the number of records in the results."""
+        return self.db.execute(
+            'SELECT COALESCE(SUM(count), 0) FROM results').fetchone()[0]
+
+    def iter_results(self):
+        """Yield the rendered items of the units in the order of the input.
+        """
+        cursor = self.db.execute(
+            'SELECT body FROM results ORDER BY unit')
+        for (body,) in cursor:
+            yield zlib.decompress(bytes(body)).decode('utf-8')
+
+
+class Transaction(object):
+    """An immediate transaction of a SQLite connection in autocommit mode.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.db.execute('COMMIT')
+        else:
+            self.db.execute('ROLLBACK')
+        return False
+
+
+class LeaseLost(Exception):
+    """Raised when a worker has lost the lease of the unit it scores."""
+    pass
+
+
+class LeaseKeeper(threading.Thread):
+    """Renew the lease of a unit in the background while it is scored.
+
+    It uses a connection of its own, as SQLite connections may not be
+    shared between threads."""
+
+    def __init__(self, path, unit, worker, seconds):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.unit = unit
+        self.worker = worker
+        self.seconds = seconds
+        self.lost = False
+        self._stop_event = threading.Event()
+
+    def run(self):
+        queue = WorkQueue(self.path)
+        try:
+            while not self._stop_event.wait(self.seconds / 3.0):
+                if not queue.renew(self.unit, self.worker, self.seconds):
+                    self.lost = True
+                    break
+        finally:
+            queue.close()
+
+    def guard(self, records):
+        """Yield records, raising LeaseLost before the next one once the
+        lease is lost."""
+        try:
+            for record in records:
+                if self.lost:
+                    raise LeaseLost("The lease of unit {} was lost".format(
+                        self.unit))
+                yield record
+        finally:
+            if hasattr(records, 'close'):
+                records.close()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
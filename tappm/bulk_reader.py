@@ -0,0 +1,405 @@
+# -*- coding:utf-8 -*-
+"""bulk_reader  is a module for parsing large fasta files in blocks
+
+FastaReader makes a Fasta object of each record, line by line; once the
+scoring is fast, that loop is the slowest part of a run. BulkFastaReader
+reads a file in large blocks of bytes, finds the header lines and the line
+ends of a block with NumPy and keeps the residues of all its records in one
+buffer, so no Python object is made per line or per residue:
+
+    FastaBlock.headers    the header lines of the records (str, with '>')
+    FastaBlock.residues   the residues of all records, one uint8 each
+    FastaBlock.offsets    the residues of record i are
+                          residues[offsets[i]:offsets[i + 1]]
+
+As with FastaReader, blank lines and lines starting with '#' are skipped;
+unlike it, spaces and control characters inside a sequence line are
+removed too. Residues before the first header are ignored.
+"""
+import os
+import itertools
+import collections
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+from tappm.encoder import INVALID
+from tappm.fasta_index import FastaIndex
+from tappm.tappmdb import StoredSequence
+
+__all__ = ['BulkFastaReader', 'ParallelFastaReader', 'FastaBlock',
+           'BLOCK_SIZE', 'RANGE_SIZE']
+
+# The bytes read from a file at a time. Parsing a block takes about four
+# times its size in memory.
+BLOCK_SIZE = 16 << 20
+
+# The bytes of a file parsed by a task of ParallelFastaReader.
+RANGE_SIZE = 8 << 20
+
+NEWLINE = ord('\n')
+HEADER = ord('>')
+COMMENT = ord('#')
+# Bytes up to the space (line ends, tabs, ...) are not residues.
+SPACE = ord(' ')
+
+
+def line_starts(buf, char):
+    """Return the offsets of the lines of buf starting with char."""
+    found = np.flatnonzero(buf == char)
+    return found[(found == 0) | (buf[found - 1] == NEWLINE)]
+
+
+class FastaBlock(object):
+    """The records of a block of a fasta file.
+
+    :arg headers: the header lines, without line ends
+    :arg residues: a uint8 array of the residues of all records (or of
+        their codes, see BulkFastaReader)
+    :arg offsets: an int64 array of len(headers) + 1 offsets in residues
+    :arg codes: the residues encoded by a SequenceEncoder, in the place of
+        the invalid ones the code INVALID, or None
+    :arg columns: the (identifier, accession, organism) of the records as
+        parsed by a FastaBuilder, or None
+    """
+
+    def __init__(self, headers, residues, offsets, codes=None,
+                 columns=None):
+        self.headers = headers
+        self.residues = residues
+        self.offsets = offsets
+        self.codes = codes
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.headers)
+
+    @property
+    def lengths(self):
+        """The lengths of the sequences."""
+        return np.diff(self.offsets)
+
+    def sequence_bytes(self, i):
+        """Return the residues of the i-th record as a uint8 array (a view
+        of the buffer)."""
+        return self.residues[self.offsets[i]:self.offsets[i + 1]]
+
+    def sequence(self, i):
+        """Return the sequence of the i-th record as a str."""
+        return self.sequence_bytes(i).tobytes().decode()
+
+    def record(self, i, builder):
+        """Return the i-th record as a Fasta object made by builder."""
+        return builder.create(self.headers[i] + '\n' + self.sequence(i))
+
+    def stored_record(self, i, alphabet):
+        """Return the i-th record of a block with codes and columns as a
+        StoredSequence. It carries the codes (encoded with alphabet) if
+        they are all valid, and None otherwise."""
+        codes = self.codes[self.offsets[i]:self.offsets[i + 1]]
+        if len(codes) and codes.max() == INVALID:
+            codes = None
+        identifier, accession, organism = self.columns[i]
+        return StoredSequence(self.headers[i], identifier, accession,
+                              organism, self.sequence(i), codes, alphabet)
+
+    @classmethod
+    def concatenate(cls, blocks):
+        """Join blocks into one, in order."""
+        blocks = list(blocks)
+        headers = []
+        for block in blocks:
+            headers.extend(block.headers)
+        residues = np.concatenate(
+            [block.residues for block in blocks] or [np.zeros(0, np.uint8)])
+        offsets = [np.zeros(1, dtype=np.int64)]
+        base = 0
+        for block in blocks:
+            offsets.append(block.offsets[1:] + base)
+            base += int(block.offsets[-1])
+        return cls(headers, residues, np.concatenate(offsets))
+
+
+class BulkFastaReader(object):
+    """Parse fasta files in blocks of bytes into FastaBlocks.
+
+    :arg builder: the FastaBuilder of the records returned by iter_file
+    :arg block_size: the bytes read at a time
+    :arg table: a 256-entry array mapping the bytes of the residues to the
+        codes kept in FastaBlock.residues (e.g. SequenceEncoder.table);
+        None keeps the bytes
+    """
+
+    def __init__(self, builder=None, block_size=BLOCK_SIZE, table=None):
+        self.builder = builder
+        self.block_size = block_size
+        self.table = table
+
+    def parse_bytes(self, data):
+        """Parse the records of a bytes object into a FastaBlock."""
+        buf = np.frombuffer(data, dtype=np.uint8)
+        size = len(buf)
+        starts = line_starts(buf, HEADER)
+        if not len(starts):
+            return FastaBlock([], np.zeros(0, np.uint8),
+                              np.zeros(1, dtype=np.int64))
+        # The header lines and the (rare) comment lines are skipped.
+        skipped = starts
+        if data[:1] == b'#' or data.find(b'\n#') >= 0:
+            skipped = np.union1d(starts, line_starts(buf, COMMENT))
+        newlines = np.flatnonzero(buf == NEWLINE)
+        k = np.searchsorted(newlines, skipped)
+        ends = np.full(len(skipped), size, dtype=np.int64)
+        inside = k < len(newlines)
+        ends[inside] = newlines[k[inside]] + 1
+        del newlines, k
+        # A residue is a byte above the space outside the skipped lines,
+        # after the first header.
+        keep = buf > SPACE
+        keep[:starts[0]] = False
+        lengths = ends - skipped
+        keep[np.repeat(skipped - (np.cumsum(lengths) - lengths), lengths) +
+             np.arange(lengths.sum())] = False
+        residues = buf[keep]
+        # The residues of a record are its bytes less the dropped ones.
+        dropped = np.flatnonzero(~keep)
+        del keep
+        bounds = np.append(starts, size)
+        counts = np.diff(bounds) - np.diff(np.searchsorted(dropped, bounds))
+        offsets = np.zeros(len(starts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        if self.table is not None:
+            residues = self.table[residues]
+        if skipped is not starts:
+            ends = ends[np.searchsorted(skipped, starts)]
+        headers = [data[start:end].rstrip(b'\r\n').decode()
+                   for start, end in zip(starts.tolist(), ends.tolist())]
+        return FastaBlock(headers, residues, offsets)
+
+    def iter_blocks(self, filename, byte_range=None):
+        """Yield the FastaBlocks of a fasta file (or of its byte_range
+        (start, end), see FastaReader.shard_range) in order. A block ends
+        before the last header read, so no record is split."""
+        if not os.path.exists(filename):
+            raise ValueError(filename + " not found.")
+        from tappm.io import pathtools
+        kind = pathtools.compression(filename)
+        if kind is None:
+            f = open(filename, 'rb')
+        elif byte_range is None:
+            f = pathtools.open_compressed(filename, kind)
+        else:
+            raise ValueError("%s is compressed; byte ranges need a plain "
+                             "file" % filename)
+        try:
+            remaining = None
+            if byte_range is not None:
+                f.seek(byte_range[0])
+                remaining = byte_range[1] - byte_range[0]
+            carry = b''
+            while True:
+                size = self.block_size
+                if remaining is not None:
+                    size = min(size, remaining)
+                    remaining -= size
+                chunk = f.read(size) if size else b''
+                if not chunk:
+                    break
+                data = carry + chunk
+                cut = data.rfind(b'\n>') + 1
+                if cut <= 0:
+                    # One record so far: read on.
+                    carry = data
+                    continue
+                carry = data[cut:]
+                yield self.parse_bytes(data[:cut])
+            if carry:
+                yield self.parse_bytes(carry)
+        finally:
+            f.close()
+
+    def parse_file(self, filename, byte_range=None):
+        """Parse a fasta file (or its byte_range) into one FastaBlock."""
+        return FastaBlock.concatenate(self.iter_blocks(filename, byte_range))
+
+    def iter_file(self, filename, byte_range=None):
+        """Yield the records of a fasta file as Fasta objects made by the
+        builder, like FastaReader.iter_file."""
+        for block in self.iter_blocks(filename, byte_range):
+            for i in range(len(block)):
+                yield block.record(i, self.builder)
+
+
+def parse_range(task):
+    """Parse a byte range of a file in a worker of ParallelFastaReader.
+
+    task is (filename, byte_range, block_size, builder, table). With a
+    table (SequenceEncoder.table) the residues are encoded too, and with a
+    builder the header columns of the records are parsed (see FastaBlock).
+    The residues, followed by their codes, are copied into a new block of
+    shared memory, which the reader unlinks once it has used them. Return
+    (name of the shared memory, the data if there is no shared memory,
+    headers, offsets, columns)."""
+    filename, byte_range, block_size, builder, table = task
+    block = BulkFastaReader(block_size=block_size).parse_file(
+        filename, byte_range)
+    columns = None
+    if builder is not None:
+        columns = []
+        for i in range(len(block)):
+            record = block.record(i, builder)
+            columns.append((record.identifier,
+                            getattr(record, 'accession', ''),
+                            getattr(record, 'organism', '')))
+    data = block.residues
+    if table is not None:
+        data = np.concatenate([data, table.take(data)])
+    if shared_memory is None or not len(data):
+        return None, data, block.headers, block.offsets, columns
+    memory = shared_memory.SharedMemory(create=True, size=len(data))
+    view = np.ndarray(len(data), dtype=np.uint8, buffer=memory.buf)
+    view[:] = data
+    del view
+    memory.close()
+    return memory.name, None, block.headers, block.offsets, columns
+
+
+def split_data(data, offsets, columns, headers):
+    """Make the FastaBlock of the data returned by parse_range."""
+    size = int(offsets[-1])
+    codes = data[size:2 * size] if len(data) > size else None
+    return FastaBlock(headers, data[:size], offsets, codes, columns)
+
+
+def release(memory, block):
+    """Drop the residues of a block and unlink its shared memory."""
+    block.residues = block.codes = None
+    try:
+        memory.close()
+    except BufferError:
+        # A view of the residues is still used: the memory is unmapped
+        # when it goes.
+        pass
+    memory.unlink()
+
+
+class ParallelFastaReader(object):
+    """Parse a fasta file in worker processes, a byte range each.
+
+    The file is cut into ranges of about range_size bytes at record starts
+    (with the saved FastaIndex if there is one). Each range is parsed by
+    BulkFastaReader in a worker, which puts its residues in shared memory,
+    and the blocks are yielded in the order of the file. Given an encoder,
+    the workers also encode the residues and parse the headers with the
+    builder, so iter_file yields records carrying their codes and only
+    the scoring is left to do. At most two
+    ranges per worker are parsed ahead of the one being used, so memory
+    stays bounded when the records are scored more slowly than they are
+    parsed.
+
+    :arg builder: the FastaBuilder of the records returned by iter_file
+    :arg workers: the number of worker processes
+    :arg encoder: the SequenceEncoder of the predictors, or None
+    """
+
+    def __init__(self, builder=None, workers=2, range_size=RANGE_SIZE,
+                 block_size=BLOCK_SIZE, encoder=None):
+        self.builder = builder
+        self.workers = workers
+        self.range_size = range_size
+        self.block_size = block_size
+        self.encoder = encoder
+
+    def ranges(self, filename, byte_range=None):
+        """Cut a file (or its byte_range) into ranges at record starts."""
+        from tappm.io import pathtools
+        from tappm.dataset_maker import FastaReader
+        if pathtools.compression(filename):
+            raise ValueError("%s is compressed; byte ranges need a plain "
+                             "file" % filename)
+        start, end = byte_range or (0, os.path.getsize(filename))
+        count = max(1, (end - start) // self.range_size)
+        index = FastaIndex.cached(filename)
+        reader = FastaReader(self.builder)
+        with open(filename, 'rb') as f:
+            bounds = [start]
+            for k in range(1, count):
+                offset = start + (end - start) * k // count
+                if index is not None:
+                    offset = index.align(offset)
+                else:
+                    offset = reader.align_to_record(f, offset)
+                bounds.append(max(bounds[-1], min(offset, end)))
+            bounds.append(end)
+        return [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if a < b]
+
+    def iter_blocks(self, filename, byte_range=None):
+        """Yield the FastaBlocks of the ranges of a file in order. A block
+        is valid until the next one is taken: then its residues are
+        released. With an encoder, the blocks have codes and columns."""
+        from tappm.hmm.hmm_mp import get_context
+        builder = table = None
+        if self.encoder is not None:
+            builder, table = self.builder, self.encoder.table
+        tasks = iter([(filename, r, self.block_size, builder, table)
+                      for r in self.ranges(filename, byte_range)])
+        pool = get_context().Pool(self.workers)
+        pending = collections.deque()
+        try:
+            for task in itertools.islice(tasks, 2 * self.workers + 1):
+                pending.append(pool.apply_async(parse_range, (task,)))
+            while pending:
+                name, data, headers, offsets, columns = \
+                    pending.popleft().get()
+                for task in itertools.islice(tasks, 1):
+                    pending.append(pool.apply_async(parse_range, (task,)))
+                if name is None:
+                    yield split_data(data, offsets, columns, headers)
+                    continue
+                memory = shared_memory.SharedMemory(name)
+                size = int(offsets[-1]) * (1 if table is None else 2)
+                block = split_data(
+                    np.ndarray(size, dtype=np.uint8, buffer=memory.buf),
+                    offsets, columns, headers)
+                try:
+                    yield block
+                finally:
+                    release(memory, block)
+        finally:
+            # Unlink the memory of the ranges parsed but not used.
+            pool.close()
+            for result in pending:
+                try:
+                    name = result.get()[0]
+                except Exception:
+                    continue
+                if name is not None:
+                    shared_memory.SharedMemory(name).unlink()
+            pool.join()
+
+    def parse_file(self, filename, byte_range=None):
+        """Parse a fasta file (or its byte_range) into one FastaBlock (of
+        the residues only)."""
+        return FastaBlock.concatenate(
+            FastaBlock(block.headers, block.residues.copy(), block.offsets)
+            for block in self.iter_blocks(filename, byte_range))
+
+    def iter_file(self, filename, byte_range=None):
+        """Yield the records of a fasta file as Fasta objects made by the
+        builder, in order, like FastaReader.iter_file. With an encoder they
+        are StoredSequences carrying their codes (see
+        MyHmmPredictor.encode_record)."""
+        for block in self.iter_blocks(filename, byte_range):
+            if block.codes is None:
+                for i in range(len(block)):
+                    yield block.record(i, self.builder)
+                continue
+            # The records outlive the block: their codes are views of a
+            # copy, not of the shared memory released with the block.
+            block.codes = block.codes.copy()
+            for i in range(len(block)):
+                yield block.stored_record(i, self.encoder.chars)
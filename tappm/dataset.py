@@ -4,6 +4,7 @@
 import random
 import copy
 from tappm import fasta
+from tappm.encoder import SequenceEncoder
 
 
 class DataSet(object):
@@ -312,9 +313,10 @@ class DataSet(object):
         return [self.get_label(id) for id in self.identifiers]
 
     def convert2num(self, charlist):
-        """文字列を数字にして返す。"""
-        char_dic = {charlist[i]: i for i in range(len(charlist))}
-        return [[char_dic[c] for c in seq] for seq in self]
+        """文字列を数字(uint8のarray)にして返す。
+        charlistにない文字があればValueError。"""
+        encoder = SequenceEncoder(charlist)
+        return [encoder.encode(seq.sequence, missing='error') for seq in self]
 
 
 class FastaDataSet(DataSet):
@@ -328,11 +330,13 @@ class FastaDataSet(DataSet):
         """seq_listから、新しいデータセットを作る。
         seq_listはリスト(あるいはタプルでもおk？)で、各要素は
         self.data_typeと一致していなければならない。"""
-        self.identifiers = [seq.identifier for seq in seq_list]
+        # seq_listはジェネレータでもよいので、一度だけ読む。
+        self.identifiers = []
         self.container = {}
         self.data_type = fasta.Fasta
         self.seqnum = 0
         for seq in seq_list:
+            self.identifiers.append(seq.identifier)
             self.container[seq.identifier] = seq
             self.seqnum += 1
         if name:
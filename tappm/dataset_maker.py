@@ -13,6 +13,8 @@ import re
 
 from tappm import dataset
 from tappm import fasta
+from tappm.fasta_index import FastaIndex
+from tappm.tappmdb import TappmDB, is_database
 
 
 class FastaReader(object):
@@ -21,63 +23,192 @@ class FastaReader(object):
     hogehoge
     """
 
-    def __init__(self, builder, protein=True):
+    def __init__(self, builder, protein=True, threaded=False):
         """Constructor.
+
+        threaded: decompress compressed files in a thread of their own.
         """
         self.builder = builder
+        self.threaded = threaded
 
-    def parse_file(self, filename, protein=True):
+    def parse_file(self, filename, protein=True, byte_range=None):
         """複数のfasta配列が入ってるファイルをパースして、
         Fastaオブジェクトのリストにして返す。とりあえず
-        アミノ酸配列だけ対応したよ。"""
-        if os.path.exists(filename):
-            f = open(filename, 'r')
-        else:
-            raise ValueError(filename + " not found.")
+        アミノ酸配列だけ対応したよ。
 
-        seq = ''
-        fasta_list = []
-        # seq_num = 0
-        for line in f:
-            if line == '' or line == "\n" or line[0] == '#':
-                continue
-            elif len(seq) > 0 and line[0] == '>':
-                # seq_num += 1
-                fasta_list.append(self.builder.create(seq))
-                seq = line
-            elif len(seq) == 0 and line[0] == '>':
-                seq = line
-            else:
-                seq += line.strip()
-        # Add the last line
-        fasta_list.append(self.builder.create(seq))
-        return fasta_list
+        byte_range (start, end) から shard_range で得た範囲だけを読む。
+        大きなファイルは iter_file で一件ずつ読むこと。"""
+        return list(self.iter_file(filename, byte_range=byte_range))
 
     def parse_string(self, s, protein=True):
+        """Parse the fasta records of a string into a list of Fasta objects.
         """
-        TODO: codes below are duplicated as parse_file(), so needs refactoring
-        """
-        seq = ''
-        fasta_list = []
-        line_no = 0
-        for line in s.splitlines():
-            line_no += 1
-            # print(line_no, line)
-            if line == '' or line == "\n" or line[0] == '#':
+        return list(self.iter_string(s))
+
+    def iter_file(self, filename, byte_range=None):
+        """Yield the Fasta objects of a file (or of its byte_range) one by
+        one, holding a single record in memory at a time. The file is closed
+        when the generator is exhausted or closed. '-' is the standard
+        input.
+
+        The records of a tappmdb file are StoredSequences, and its ranges
+        are record ranges (see shard_range)."""
+        from tappm.io import pathtools
+        if filename != pathtools.STDIO and not os.path.exists(filename):
+            raise ValueError(filename + " not found.")
+        if is_database(filename):
+            with TappmDB(filename) as db:
+                for record in db.iter_records(*(byte_range or ())):
+                    yield record
+            return
+        if byte_range is not None:
+            lines = self.iter_range(filename, byte_range)
+            try:
+                for record in self.iter_lines(lines):
+                    yield record
+            finally:
+                lines.close()
+            return
+        with self.open_file(filename) as f:
+            for record in self.iter_lines(f):
+                yield record
+
+    def iter_string(self, s):
+        """Yield the Fasta objects of the records of a string one by one."""
+        return self.iter_lines(s.splitlines())
+
+    def iter_lines(self, lines):
+        """Assemble fasta records from lines and yield them as Fasta objects.
+
+        The sequence lines of a record are collected in a list and joined
+        once, so that a long record takes linear time. Blank lines and
+        lines starting with '#' are skipped."""
+        header = None
+        parts = []
+        for line in lines:
+            if not line or line[0] == '#':
                 continue
-            elif len(seq) > 0 and line[0] == '>':
-                # seq_num += 1
-                # print(len(fasta_list), seq)
-                fasta_list.append(self.builder.create(seq))
-                seq = line + "\n"
-            elif line[0] == '>':
-                # the first line
-                seq += line + "\n"
+            if line[0] == '>':
+                if header is not None or parts:
+                    yield self.builder.create((header or '') + ''.join(parts))
+                header = line.rstrip('\r\n') + '\n'
+                parts = []
             else:
-                seq += line.strip()
-        # Add the last line
-        fasta_list.append(self.builder.create(seq))
-        return fasta_list
+                part = line.strip()
+                if part:
+                    parts.append(part)
+        if header is not None or parts:
+            yield self.builder.create((header or '') + ''.join(parts))
+
+    def index(self, filename, save=True):
+        """Return the FastaIndex of a fasta file, built (and saved next to
+        it if save) unless an up-to-date one has been saved."""
+        if is_database(filename):
+            raise ValueError("%s is a tappmdb file; it is not indexed"
+                             % filename)
+        return FastaIndex(filename, self.builder).open(save)
+
+    def count_records(self, filename, byte_range=None, scan=True):
+        """Count the records of a fasta file without parsing them; a saved
+        FastaIndex is used if it is up to date. Without one, the file is
+        read if scan, and None is returned otherwise."""
+        if is_database(filename):
+            with TappmDB(filename) as db:
+                return db.count(byte_range)
+        index = FastaIndex.cached(filename)
+        if index is not None:
+            return index.count(byte_range)
+        if not scan:
+            return None
+        count = 0
+        if byte_range is not None:
+            for line in self.iter_range(filename, byte_range):
+                if line[:1] == '>':
+                    count += 1
+            return count
+        with self.open_file(filename) as f:
+            for line in f:
+                if line[:1] == '>':
+                    count += 1
+        return count
+
+    def count_residues(self, filename, limit=None):
+        """Count the residues of a fasta file, stopping as soon as there are
+        more than limit."""
+        if is_database(filename):
+            with TappmDB(filename) as db:
+                return db.residues
+        residues = 0
+        with self.open_file(filename) as f:
+            for line in f:
+                if line[:1] in ('>', '#'):
+                    continue
+                residues += len(line.strip())
+                if limit is not None and residues > limit:
+                    break
+        return residues
+
+    def open_file(self, filename):
+        """Open a fasta file as text with a large buffer; a file compressed
+        by gzip, bzip2 or zip is decompressed while it is read."""
+        # tappm.io needs tappm.utils, which is imported after this module.
+        from tappm.io import pathtools
+        return pathtools.open_text(filename, threaded=self.threaded)
+
+    def shard_range(self, filename, index, total):
+        """Return the byte range (start, end) of the index-th of total
+        shards of a fasta file (index counts from 1).
+
+        The file is cut into total ranges of equal size, and each range is
+        moved to the start of the first record header at or after it, so
+        a shard has the records whose headers start in its range. A saved
+        FastaIndex is used if it is up to date. A tappmdb file is cut into
+        record ranges (first, last) of about as many residues instead."""
+        if not 1 <= index <= total:
+            raise ValueError("Invalid shard %d/%d" % (index, total))
+        if is_database(filename):
+            with TappmDB(filename) as db:
+                return db.shard_range(index, total)
+        from tappm.io import pathtools
+        if pathtools.compression(filename):
+            raise ValueError("%s is compressed; byte ranges need a plain "
+                             "file" % filename)
+        fasta_index = FastaIndex.cached(filename)
+        if fasta_index is not None:
+            return fasta_index.shard_range(index, total)
+        size = os.path.getsize(filename)
+        with open(filename, 'rb') as f:
+            start = self.align_to_record(f, size * (index - 1) // total)
+            end = self.align_to_record(f, size * index // total)
+        return start, end
+
+    def align_to_record(self, f, offset):
+        """Return the offset of the first header line starting at or after
+        offset in the binary file f (or the size of the file)."""
+        if offset > 0:
+            f.seek(offset - 1)
+            if f.read(1) != b'\n':
+                f.readline()   # skip the rest of a line
+        else:
+            f.seek(0)
+        while True:
+            position = f.tell()
+            line = f.readline()
+            if not line or line[:1] == b'>':
+                return position
+
+    def iter_range(self, filename, byte_range):
+        """Iterate over the lines in byte_range (start, end) of a file."""
+        start, end = byte_range
+        with open(filename, 'rb') as f:
+            f.seek(start)
+            position = start
+            while position < end:
+                line = f.readline()
+                if not line:
+                    break
+                position += len(line)
+                yield line.decode().replace('\r\n', '\n')
 
 
 class FastaBuilder(object):
@@ -214,14 +345,14 @@ class DataSetMaker(object):
         """
         if not name:
             name, ext = os.path.splitext(os.path.basename(filename))
-        data_list = self.reader.parse_file(filename)
+        data_list = self.reader.iter_file(filename)
         return self.data_type(data_list, name=name, origin=name, labels=label)
 
     def read_from_string(self, s, name='', label=None):
         """read sequences from a given string"""
         if not name:
             name = 'test'
-        data_list = self.reader.parse_string(s)
+        data_list = self.reader.iter_string(s)
         return self.data_type(data_list, name=name, origin=name, labels=label)
 
     def read_from_sqlite(self, dbname, query, name=""):
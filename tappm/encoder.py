@@ -0,0 +1,98 @@
+# -*- coding:utf-8 -*-
+"""encoder  is a module for converting sequences into symbol indices
+
+A SequenceEncoder maps the characters of an alphabet to their indices with
+a 256-entry lookup table, so a sequence is encoded by NumPy in one step
+instead of a dictionary lookup per residue. The characters outside the
+alphabet (X, U, ...) are dropped and counted; the counts are reported as
+one summary instead of a message per character.
+"""
+import logging
+import collections
+
+import numpy as np
+
+__all__ = ['SequenceEncoder', 'INVALID']
+
+logger = logging.getLogger(__name__)
+
+# The code of the bytes outside the alphabet in SequenceEncoder.table.
+INVALID = 255
+
+
+class SequenceEncoder(object):
+    """Encode sequences into uint8 arrays of the indices of their residues
+    in an alphabet.
+
+    :arg chars: the alphabet, at most 255 characters; the i-th one is
+        encoded as i
+    """
+
+    def __init__(self, chars):
+        if not 0 < len(chars) < INVALID:
+            raise ValueError("chars must contain 1 to %d characters."
+                             % (INVALID - 1))
+        self.chars = chars
+        self.table = np.full(256, INVALID, dtype=np.uint8)
+        for i, c in enumerate(chars):
+            self.table[ord(c)] = i
+        # The characters dropped since the last reset, and the number of
+        # sequences they were found in.
+        self.invalid = collections.Counter()
+        self.invalid_sequences = 0
+
+    def encode_bytes(self, data, reverse=False, missing='ignore'):
+        """Encode the residues of a bytes object (or a uint8 array).
+
+        :arg reverse: return the indices in reverse order (a view, not a
+            copy)
+        :arg missing: 'error' raises ValueError on a character outside the
+            alphabet; otherwise it is dropped and counted
+        """
+        if not isinstance(data, np.ndarray):
+            data = np.frombuffer(data, dtype=np.uint8)
+        codes = self.table.take(data)
+        bad = codes == INVALID
+        if bad.any():
+            found = data[bad]
+            if missing == 'error':
+                raise ValueError("Invalid character: " + chr(found[0]))
+            self.count_invalid(found)
+            codes = codes[~bad]
+        return codes[::-1] if reverse else codes
+
+    def encode(self, sequence, reverse=False, missing='ignore'):
+        """Encode a sequence (a str); see encode_bytes."""
+        # A character outside latin-1 becomes '?', which is invalid.
+        return self.encode_bytes(sequence.encode('latin-1', 'replace'),
+                                 reverse, missing)
+
+    def count_invalid(self, found, sequences=1):
+        """Count the invalid bytes (a uint8 array) found in a number of
+        sequences."""
+        values, counts = np.unique(found, return_counts=True)
+        for value, count in zip(values.tolist(), counts.tolist()):
+            self.invalid[chr(value)] += count
+        self.invalid_sequences += sequences
+
+    def summary(self):
+        """Describe the characters dropped since the last reset, or return
+        an empty string if there were none."""
+        if not self.invalid:
+            return ''
+        chars = ', '.join('%r: %d' % (c, n)
+                          for c, n in self.invalid.most_common())
+        return "%d invalid characters found in %d sequences (%s)." % (
+            sum(self.invalid.values()), self.invalid_sequences, chars)
+
+    def reset(self):
+        """Forget the characters dropped so far."""
+        self.invalid.clear()
+        self.invalid_sequences = 0
+
+    def report(self):
+        """Log the summary as a warning, if any, and reset."""
+        summary = self.summary()
+        if summary:
+            logger.warning("%s", summary)
+        self.reset()
@@ -0,0 +1,321 @@
+# -*- coding:utf-8 -*-
+"""fasta_index  is a module for random access to the records of a fasta file
+
+A FastaIndex records, for each record of a fasta file, the offset of its
+header line, the offset and the length of its sequence and the width of
+its sequence lines, like the .fai index of samtools faidx. The file itself
+is memory-mapped, so a record, a part of a sequence or the byte range of a
+run of records is fetched without reading the file from its start.
+
+The index is kept next to the file (xx.fasta.tfai) with the size and the
+modification time of the file, and is rebuilt when either has changed.
+"""
+import os
+import mmap
+
+import numpy as np
+
+__all__ = ['FastaIndex', 'INDEX_SUFFIX']
+
+INDEX_SUFFIX = '.tfai'
+
+# The first word of the first line of an index file.
+MAGIC = '#tappm-fai'
+
+# The columns of an index file after the name of a record.
+COLUMNS = ('length', 'header_offset', 'sequence_offset', 'linebases',
+           'linewidth')
+
+# The bytes removed from the sequence lines of a record.
+WHITESPACE = b'\r\n\t '
+
+
+def file_state(filename):
+    """Return the (size, mtime) of a file, as they are kept in its index."""
+    stat = os.stat(filename)
+    return stat.st_size, repr(stat.st_mtime)
+
+
+class FastaIndex(object):
+    """An index of the records of a fasta file, with the file mapped.
+
+    The records are numbered from 0 in the order of the file, and named by
+    the first word of their header lines. The arrays length, header_offset,
+    sequence_offset, linebases (the residues of a full line) and linewidth
+    (the bytes of a full line) hold their columns; linebases is 0 for a
+    record whose lines are not all as long (but the last), whose sequence
+    is then read whole.
+
+    :arg filename: a fasta file, not compressed
+    :arg builder: the FastaBuilder of the records returned by record()
+    """
+
+    def __init__(self, filename, builder=None):
+        self.filename = filename
+        self.builder = builder
+        self.path = filename + INDEX_SUFFIX
+        self.names = []
+        self.size = 0
+        self._ids = {}
+        self._map = None
+        self._file = None
+        for column in COLUMNS:
+            setattr(self, column, np.zeros(0, dtype=np.int64))
+
+    @classmethod
+    def cached(cls, filename, builder=None):
+        """Return the index of a file if an up-to-date one has been saved,
+        or None (the file is not read)."""
+        index = cls(filename, builder)
+        if not os.path.exists(index.path) or not index.load():
+            return None
+        return index
+
+    def open(self, save=True):
+        """Load the saved index, or build it (and save it if save) if there
+        is none or the file has changed since. Return self."""
+        if not (os.path.exists(self.path) and self.load()):
+            self.build()
+            if save:
+                try:
+                    self.save()
+                except (IOError, OSError):
+                    # A read-only directory: keep the index in memory.
+                    pass
+        return self
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+            self._map = self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._ids
+
+    @property
+    def map(self):
+        """The mapped file (opened on first use)."""
+        if self._map is None:
+            from tappm.io import pathtools
+            if pathtools.compression(self.filename):
+                raise ValueError("%s is compressed; it cannot be indexed"
+                                 % self.filename)
+            self._file = open(self.filename, 'rb')
+            # An empty file cannot be mapped.
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ) \
+                if os.path.getsize(self.filename) else b''
+        return self._map
+
+    # --- Building, saving and loading ---
+
+    def build(self):
+        """Index the records of the file."""
+        data = self.map
+        self.size = len(data)
+        # The header lines start the file or follow a newline.
+        headers = []
+        position = 0 if data[:1] == b'>' else data.find(b'\n>')
+        while position >= 0:
+            if data[position:position + 1] == b'\n':
+                position += 1
+            headers.append(position)
+            position = data.find(b'\n>', position)
+        columns = dict((column, []) for column in COLUMNS)
+        self.names = []
+        ends = headers[1:] + [self.size]
+        for start, end in zip(headers, ends):
+            line_end = data.find(b'\n', start, end)
+            if line_end < 0:
+                line_end = end
+            header = data[start + 1:line_end].decode().strip()
+            self.names.append(header.split(None, 1)[0] if header else '')
+            first = min(line_end + 1, end)
+            lines = data[first:end]
+            residues = len(lines) - sum(lines.count(c)
+                                        for c in (b'\n', b'\r', b'\t', b' '))
+            linewidth = lines.find(b'\n') + 1
+            linebases = len(lines[:linewidth].rstrip(WHITESPACE))
+            if linewidth <= 0 or not self.regular(lines, residues,
+                                                  linebases, linewidth):
+                linebases = linewidth = 0
+            columns['length'].append(residues)
+            columns['header_offset'].append(start)
+            columns['sequence_offset'].append(first)
+            columns['linebases'].append(linebases)
+            columns['linewidth'].append(linewidth)
+        for column in COLUMNS:
+            setattr(self, column, np.array(columns[column], dtype=np.int64))
+        self._ids = self.identifiers(self.names)
+
+    @staticmethod
+    def regular(lines, residues, linebases, linewidth):
+        """Return True if every line of a sequence but the last has
+        linebases residues in linewidth bytes, so that a part of it can be
+        located from its residue offsets."""
+        full = len(lines) // linewidth
+        ends = lines[linewidth - 1::linewidth]
+        tail = lines[full * linewidth:]
+        if ends.count(b'\n') != full or b'\n' in tail.rstrip(b'\r\n'):
+            return False
+        if lines.count(b'\n') != full + tail.count(b'\n'):
+            return False
+        tail = tail.rstrip(WHITESPACE)
+        return len(tail) <= linebases and \
+            residues == full * linebases + len(tail)
+
+    @staticmethod
+    def identifiers(names):
+        """Map the names to their record numbers; the first record of a
+        name wins."""
+        ids = {}
+        for i, name in enumerate(names):
+            ids.setdefault(name, i)
+        return ids
+
+    def save(self):
+        """Write the index next to the file."""
+        size, mtime = file_state(self.filename)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('{}\t{}\t{}\n'.format(MAGIC, size, mtime))
+            rows = zip(self.names, *[getattr(self, c) for c in COLUMNS])
+            for row in rows:
+                f.write('\t'.join(str(value) for value in row) + '\n')
+        os.rename(tmp, self.path)
+
+    def load(self):
+        """Read the saved index. Return False (and load nothing) if it is
+        broken or the file has changed since it was built."""
+        size, mtime = file_state(self.filename)
+        with open(self.path) as f:
+            first = f.readline().rstrip('\n').split('\t')
+            if first != [MAGIC, str(size), mtime]:
+                return False
+            names = []
+            rows = []
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != len(COLUMNS) + 1:
+                    return False
+                names.append(fields[0])
+                rows.append(fields[1:])
+        table = np.array(rows, dtype=np.int64).reshape(-1, len(COLUMNS))
+        for i, column in enumerate(COLUMNS):
+            setattr(self, column, table[:, i].copy())
+        self.names = names
+        self.size = size
+        self._ids = self.identifiers(names)
+        return True
+
+    # --- Access ---
+
+    def lookup(self, name):
+        """Return the number of the record named name."""
+        try:
+            return self._ids[name]
+        except KeyError:
+            raise KeyError("No record named %s in %s" % (name,
+                                                         self.filename))
+
+    def record_range(self, i):
+        """Return the byte range (start, end) of the i-th record."""
+        end = self.header_offset[i + 1] if i + 1 < len(self) else self.size
+        return int(self.header_offset[i]), int(end)
+
+    def header(self, i):
+        """Return the header line of the i-th record, without the newline.
+        """
+        start = int(self.header_offset[i])
+        end = int(self.sequence_offset[i])
+        return self.map[start:end].decode().rstrip('\r\n')
+
+    def raw(self, i):
+        """Return the sequence lines of the i-th record as a memoryview of
+        the mapped file (no copy)."""
+        start = int(self.sequence_offset[i])
+        return memoryview(self.map)[start:self.record_range(i)[1]]
+
+    def sequence_bytes(self, i, start=0, end=None):
+        """Return the residues start to end (from 0, end excluded) of the
+        i-th record as bytes. With regular lines only the lines of the part
+        are read."""
+        length = int(self.length[i])
+        end = length if end is None else min(end, length)
+        start = max(0, min(start, end))
+        linebases = int(self.linebases[i])
+        if not linebases:
+            return self.raw(i).tobytes().translate(None, WHITESPACE)[start:end]
+        linewidth = int(self.linewidth[i])
+        offset = int(self.sequence_offset[i])
+        first = offset + start // linebases * linewidth + start % linebases
+        last = offset + end // linebases * linewidth + end % linebases
+        return self.map[first:last].translate(None, WHITESPACE)
+
+    def sequence(self, i, start=0, end=None):
+        """Return the residues start to end of the i-th record as a str."""
+        return self.sequence_bytes(i, start, end).decode()
+
+    def record(self, i):
+        """Return the i-th record as a Fasta object made by the builder."""
+        return self.builder.create(self.header(i) + '\n' + self.sequence(i))
+
+    def fetch(self, name, start=0, end=None):
+        """Return the record named name, or its residues start to end if
+        they are given (as a str)."""
+        i = self.lookup(name)
+        if start or end is not None:
+            return self.sequence(i, start, end)
+        return self.record(i)
+
+    def iter_records(self, first=0, last=None):
+        """Yield the records first to last (excluded) as Fasta objects."""
+        last = len(self) if last is None else last
+        for i in range(first, last):
+            yield self.record(i)
+
+    def count(self, byte_range=None):
+        """Return the number of records whose headers start in byte_range
+        (start, end), by default in the file."""
+        if byte_range is None:
+            return len(self)
+        start, end = byte_range
+        offsets = self.header_offset
+        return int(np.searchsorted(offsets, end, 'left') -
+                   np.searchsorted(offsets, start, 'left'))
+
+    def align(self, offset):
+        """Return the offset of the first header at or after offset (or the
+        size of the file)."""
+        k = int(np.searchsorted(self.header_offset, offset, 'left'))
+        return int(self.header_offset[k]) if k < len(self) else self.size
+
+    def shard_range(self, index, total):
+        """Return the byte range of the index-th of total shards (from 1),
+        as FastaReader.shard_range does, without reading the file."""
+        return (self.align(self.size * (index - 1) // total),
+                self.align(self.size * index // total))
+
+    def residue_ranges(self, total):
+        """Cut the records into total runs of about as many residues.
+        Return their record ranges [(first, last), ...]; some may be empty.
+        """
+        cumulative = np.cumsum(self.length)
+        bounds = [0]
+        whole = int(cumulative[-1]) if len(self) else 0
+        for k in range(1, total):
+            bounds.append(max(bounds[-1], int(np.searchsorted(
+                cumulative, whole * k // total, 'right'))))
+        bounds.append(len(self))
+        return list(zip(bounds[:-1], bounds[1:]))
@@ -0,0 +1,109 @@
+# -*- coding:utf-8 -*-
+"""Placement of decoding workers on CPUs.
+
+A policy is one of
+    'compact'  fill the CPUs of one NUMA node (socket) before the next, so
+               workers share as few nodes as possible, also where the
+               nodes' CPUs are numbered alternately;
+    'spread'   take the CPUs of the NUMA nodes in turn, so workers are
+               distributed evenly over the nodes;
+    a list of CPUs, e.g. '0-3,8,10' or [0, 1, 2], used in this order.
+Only the CPUs this process is allowed to run on are used."""
+
+import os
+
+# Environment variables limiting the threads of BLAS/OpenMP libraries.
+BLAS_THREAD_ENV = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                   'MKL_NUM_THREADS', 'BLIS_NUM_THREADS',
+                   'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+NODE_PATH = '/sys/devices/system/node'
+
+
+def parse_cpulist(text):
+    """Parse a list of CPUs such as '0-3,8,10' into a list of integers."""
+    cpus = []
+    for item in text.strip().split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if '-' in item:
+            first, last = item.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(item))
+    return cpus
+
+
+def allowed_cpus():
+    """Return the sorted list of CPUs this process may run on."""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def numa_nodes():
+    """Return the lists of CPUs of the NUMA nodes, or one list if unknown."""
+    nodes = []
+    try:
+        names = sorted(n for n in os.listdir(NODE_PATH)
+                       if n.startswith('node') and n[4:].isdigit())
+    except OSError:
+        names = []
+    for name in names:
+        try:
+            with open(os.path.join(NODE_PATH, name, 'cpulist')) as f:
+                nodes.append(parse_cpulist(f.read()))
+        except (OSError, ValueError):
+            continue
+    return nodes or [allowed_cpus()]
+
+
+def plan(policy):
+    """Return the order in which workers take CPUs under a policy."""
+    allowed = allowed_cpus()
+    if isinstance(policy, str) and policy in ('compact', 'spread'):
+        nodes = [[c for c in node if c in allowed] for node in numa_nodes()]
+        nodes = [node for node in nodes if node]
+    if isinstance(policy, str) and policy == 'compact':
+        order = [c for node in nodes for c in node]
+        # CPUs of no known node come last.
+        placed = set(order)
+        return order + [c for c in allowed if c not in placed]
+    if isinstance(policy, str) and policy == 'spread':
+        order = []
+        for n in range(max(len(node) for node in nodes)):
+            order.extend(node[n] for node in nodes if n < len(node))
+        return order
+    cpus = parse_cpulist(policy) if isinstance(policy, str) else list(policy)
+    invalid = [c for c in cpus if c not in allowed]
+    if not cpus or invalid:
+        raise ValueError("Invalid CPU list %s (allowed: %s)" %
+                         (policy, allowed))
+    return cpus
+
+
+def pin(cpu):
+    """Bind the calling process (or thread) to a single CPU."""
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, [cpu])
+
+
+def blas_thread_limits():
+    """Return the variables limiting BLAS/OpenMP libraries to one thread.
+
+    Those already set by the user are left out."""
+    return dict((name, '1') for name in BLAS_THREAD_ENV
+                if name not in os.environ)
+
+
+def limit_blas_threads():
+    """Limit BLAS/OpenMP libraries loaded in this process to one thread.
+
+    This needs threadpoolctl; without it, nothing is done and the limits
+    must be set in the environment before the libraries are loaded."""
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(1)
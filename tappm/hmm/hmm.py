@@ -5,6 +5,28 @@ import numpy as np
 import logging
 import pickle
 
+# The logger of the HMM core. Nothing is configured here; the application
+# decides where the records go (see Console.capture), and calls on the hot
+# paths are skipped unless the level is enabled.
+logger = logging.getLogger(__name__)
+
+# The decoding work (see HMM.work) below which a pool of workers costs more
+# to start than it saves: about a third of a second of decoding in one
+# process.
+SERIAL_WORK = 5e7
+
+
+def clip_min(x, minval):
+    """Raise the values of x below minval to minval, in place if x is a
+    writable float array (or if nothing is below), and in a copy otherwise.
+    """
+    if not (x < minval).any():
+        return x
+    if x.flags.writeable and np.issubdtype(x.dtype, np.floating):
+        np.maximum(x, minval, out=x)
+        return x
+    return x.clip(min=minval)
+
 
 class HMM(object):
     """A simple implementation of hidden Markov model.
@@ -30,7 +52,7 @@ class HMM(object):
         self._K = len(initial)      # Number of classes
         self._M = len(emission)  # Number of symbols
         self._deleted = []   # Delete states
-        logging.basicConfig(format='[%(asctime)s] %(message)s')
+        self._compiled = None  # Log parameters used by viterbi
 
     def baum_welch(self,
                    observations,
@@ -43,21 +65,22 @@ class HMM(object):
         """Perform Baum-Welch algorithm.
 
         Requires a list of observations."""
+        do_logging = do_logging and logger.isEnabledFor(logging.INFO)
         # Make 1-of-K representation
         # This is used to update emission probs in maximization step
         if do_logging:
-            logging.info("Baum Welch Algorithm started.")
+            logger.info("Baum Welch Algorithm started.")
         x_digits = [np.array(
                 [[x[n] == i for i in range(self._M)]
                     for n in range(len(x))]
                 ).T
                 for x in observations]
-        if do_logging is True:
-            logging.info("1 of K representation has been made.")
+        if do_logging:
+            logger.info("1 of K representation has been made.")
         l_prev = 0
         for n in range(iter_limit):
             if do_logging:
-                logging.info("Estimation step began.")
+                logger.info("Estimation step began.")
             # gammas: array of R elements. Each element is also an array
             #        (matrix) of N x K (N is length)
             gammas, xisums, cs = np.array(
@@ -65,12 +88,12 @@ class HMM(object):
             if do_debug:
                 return gammas, xisums, cs, x_digits
             if do_logging:
-                logging.info("Estimation step ended.")
+                logger.info("Estimation step ended.")
             l = self.maximize(gammas, xisums, cs, x_digits)
             if np.isnan(l):
-                logging.error(
+                logger.error(
                     "Log Likelihood is nan. Here are some information:")
-                logging.error("Parameters are pickled into params.pickle")
+                logger.error("Parameters are pickled into params.pickle")
                 pickle.dump(
                     {'t': self._t,
                      'e': self._e,
@@ -84,9 +107,9 @@ class HMM(object):
                 self.add_pseudocounts(pseudocounts)
             dif = l - l_prev
             if do_logging:
-                logging.info("iter: " + str(n))
-                logging.info("Likelihood: " + str(l))
-                logging.info("Delta: " + str(dif))
+                logger.info("iter: %d", n)
+                logger.info("Likelihood: %s", l)
+                logger.info("Delta: %s", dif)
             l_prev = l
             pickle.dump({'t': self._t, 'e': self._e, 'i': self._i},
                         open('params.pickle', 'wb'))
@@ -131,8 +154,8 @@ class HMM(object):
 
         @param x_digits A matrix of 1-of-K representation. DxN dimension
         @del_state  a threshold for deletion of invalid states"""
-        if do_logging:
-            logging.info("Maximization step began.")
+        if do_logging and logger.isEnabledFor(logging.INFO):
+            logger.info("Maximization step began.")
         # log_likelihood = sum(np.log(c).sum() for c in cs)
         log_likelihood = sum([sum(np.log(c)) for c in cs])
         # R: number of sequences.
@@ -147,8 +170,8 @@ class HMM(object):
         self._t = (sumxisums.T / sumxisums.sum(1)).T
         self._e = sum(np.dot(x_digits[i], gammas[i]) for i in range(R))
         self._e /= sum(gammas[i].sum(0) for i in range(R))
-        if do_logging:
-            logging.info("Maximization step ended.")
+        if do_logging and logger.isEnabledFor(logging.INFO):
+            logger.info("Maximization step ended.")
         return log_likelihood
 
     def delete_invalid_states(self, sumxisums, gammas, threshold=0):
@@ -194,30 +217,27 @@ class HMM(object):
         return log_likelihood
 
     def viterbi(self, x, do_logging=True, return_omega=False,
-                minval=0.0000000001, **args):
+                minval=0.0000000001, max_memory=None, **args):
         """Decode observations.
 
-        @param x  is the sequence of observations"""
-        if do_logging:
-            logging.debug("Started calculating Viterbi path.")
+        @param x  is the sequence of observations
+        @param max_memory  is the number of bytes the decoding may use. If
+                           the estimate of viterbi_memory is larger, the
+                           decoding falls back to viterbi_lowmem."""
         N = len(x)
-        alpha, c = self.estimate(x, want_alpha=True)
-        # to prevent divide by zero
-        alpha = alpha.clip(min=minval)
-        c = c.clip(min=minval)
-
-        alpha, c = np.log(alpha), np.log(c)
-        alpha = np.array([alpha[n] + c[:n+1].sum() for n in range(N)])
-        # ^ log \alpha (Not \hat{\alpha})
-        # to prevent divide by zero
-        self._t = self._t.clip(min=minval)
-        self._e = self._e.clip(min=minval)
-        self._i = self._i.clip(min=minval)
-        logt, loge = np.log(self._t), np.log(self._e)
-        omega = np.log(self._i) + loge[x[0]]
+        if max_memory is not None and self.viterbi_memory(N) > max_memory:
+            return self.viterbi_lowmem(x, do_logging=do_logging,
+                                       return_omega=return_omega,
+                                       minval=minval)
+        do_logging = do_logging and logger.isEnabledFor(logging.DEBUG)
+        if do_logging:
+            logger.debug("Started calculating Viterbi path.")
+        logt, loge, logi = self.compile(minval)
+        omega = logi + loge[x[0]]
         omega_history = []
         # ^ omega: probability at current position (at position 0 here)
-        path = np.array([[i for i in range(self._K)] for n in range(N)])
+        path = np.empty((N, self._K), int)
+        path[0] = np.arange(self._K)
         # calculate the most probable path at each position of the observation
         for n in range(1, N):
             prob = loge[x[n]] + omega + logt.T
@@ -233,27 +253,129 @@ class HMM(object):
             route.append(path[n][route[-1]])
             omegas.append(omega_history[n][route[-1]])
         if do_logging:
-            logging.debug("Finished calculating Viterbi path.")
-            logging.debug(omega)
+            logger.debug("Finished calculating Viterbi path.")
+            logger.debug("%s", omega)
         if return_omega:
             return route[::-1], omega.max(), omegas[::-1]
         else:
             return route[::-1], omega.max()
 
+    def viterbi_lowmem(self, x, do_logging=True, return_omega=False,
+                       minval=0.0000000001, **args):
+        """Decode observations like viterbi, in O(sqrt(N) K) memory.
+
+        Only omega at every step-th position is kept in the forward pass;
+        the traceback recomputes the positions of one block at a time from
+        these checkpoints, which gives the same result at about twice the
+        cost of viterbi."""
+        do_logging = do_logging and logger.isEnabledFor(logging.DEBUG)
+        if do_logging:
+            logger.debug("Started calculating Viterbi path (low memory).")
+        N = len(x)
+        step = int(np.ceil(np.sqrt(N)))
+        logt, loge, logi = self.compile(minval)
+        omega = logi + loge[x[0]]
+        checkpoints = [omega]
+        # ^ omega at positions 0, step, 2 * step, ...
+        for n in range(1, N):
+            omega = np.max(loge[x[n]] + omega + logt.T, axis=1)
+            if n % step == 0:
+                checkpoints.append(omega)
+        route = [np.argmax(omega)]
+        omegas = [omega[route[0]]]
+        for j in range(len(checkpoints) - 1, -1, -1):
+            # Recompute omega and path at positions a .. last of the block
+            start = j * step
+            last = min(start + step + 1, N - 1)
+            block_omega = [checkpoints[j]]
+            block_path = [np.arange(self._K)]
+            # ^ The path at the start is only used at position 0
+            omega = checkpoints[j]
+            for n in range(start + 1, last + 1):
+                prob = loge[x[n]] + omega + logt.T
+                omega = np.max(prob, axis=1)
+                block_omega.append(omega)
+                block_path.append(np.argmax(prob, axis=1))
+            first = start + 1 if j > 0 else 0
+            for n in range(min(start + step, N - 2), first - 1, -1):
+                route.append(block_path[n - start][route[-1]])
+                omegas.append(block_omega[n + 1 - start][route[-1]])
+        if do_logging:
+            logger.debug("Finished calculating Viterbi path.")
+        if return_omega:
+            return route[::-1], omegas[0], omegas[::-1]
+        else:
+            return route[::-1], omegas[0]
+
+    def viterbi_memory(self, N, engine='full'):
+        """Estimate the bytes used by decoding N observations.
+
+        @param engine  is 'full' (viterbi) or 'lowmem' (viterbi_lowmem)."""
+        K = self._K
+        temporary = 3 * K * K * 8
+        if engine == 'lowmem':
+            step = int(np.ceil(np.sqrt(N)))
+            return (N // step + 2 * step + 2) * K * 8 * 2 + temporary
+        # path (N x K integers) and omega_history (N x K floats)
+        return 2 * N * K * 8 + temporary
+
+    def compile(self, minval=0.0000000001):
+        """Return the log parameters (logt, loge, logi) used by viterbi.
+
+        They are computed once and reused until the parameters are replaced
+        (e.g. by training), so the model may be shared read-only. The
+        parameters are clipped in place, so they keep their identity (see
+        MultiProcessHMM.start)."""
+        compiled = self._compiled
+        if compiled is not None and compiled[0] == minval and \
+           all(a is b for a, b in
+               zip(compiled[1], (self._t, self._e, self._i))):
+            return compiled[2]
+        # to prevent divide by zero
+        self._t = clip_min(self._t, minval)
+        self._e = clip_min(self._e, minval)
+        self._i = clip_min(self._i, minval)
+        logs = (np.log(self._t), np.log(self._e), np.log(self._i))
+        self._compiled = (minval, (self._t, self._e, self._i), logs)
+        return logs
+
+    def work(self, observations):
+        """Return the work of decoding observations: the sum of N * K * K
+        over the observations of length N."""
+        return sum(len(x) for x in observations) * self._K * self._K
+
+    def viterbi_all(self, observations, **args):
+        """Decode a list of observations one after another.
+
+        Subclasses may distribute the observations over workers; the
+        results are always returned in the order of the observations."""
+        return [self.viterbi(x, **args) for x in observations]
+
+    def start(self):
+        """Prepare resources needed for decoding. Nothing to do here."""
+        pass
+
+    def close(self):
+        """Release resources acquired by start(). Nothing to do here."""
+        pass
+
     def sample(self, length):
         """Sample the sequence for specified length"""
         pass
 
     def normalize_transition(self):
         """Normalize transition probabilities to 1."""
+        self._compiled = None
         self._t /= self._t.sum(1)[:, np.newaxis]
 
     def normalize_emission(self):
         """Normalize emission probabilities to 1."""
+        self._compiled = None
         self._e /= self._e.sum(0)
 
     def normalize_initial(self):
         """Normalize initial probabilities to 1."""
+        self._compiled = None
         self._i /= self._i.sum()
 
     def add_pseudocounts(self, pseudocounts):
@@ -263,7 +385,7 @@ class HMM(object):
                              pseudocounts in float or double for transition
                              probs, emission probs and initial probs.
         """
-        logging.info("Adding pseudocounts...")
+        logger.info("Adding pseudocounts...")
         if pseudocounts[0] > 0:
             self._t += pseudocounts[0]
             self.normalize_transition()
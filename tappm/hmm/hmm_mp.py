@@ -1,10 +1,26 @@
 # -*- coding:utf-8 -*-
 
+import os
+import time
+import threading
 import numpy as np
 # import ghmm   # not used now
 import multiprocessing
 from tappm.hmm import hmm
+from tappm.hmm import affinity as cpu_affinity
+from tappm.seqstore import resolve
 import logging
+from logging.handlers import QueueHandler, QueueListener
+
+logger = logging.getLogger(__name__)
+
+# Model files to be preloaded by the fork server, see start_forkserver.
+_PRELOAD_FILES = []
+# Estimated memory (bytes) of a worker process not shared with the fork
+# server, before it decodes anything.
+WORKER_BYTES = 16 << 20
+# The environment variable passing _PRELOAD_FILES to the fork server.
+PRELOAD_ENV = 'TAPPM_PRELOAD_MODELS'
 
 
 class MultiProcessHMM(hmm.HMM):
@@ -12,10 +28,134 @@ class MultiProcessHMM(hmm.HMM):
 
     Using multiprocessing module to fasten calculation of estimation
     step."""
-    def __init__(self, t, e, i, worker_num=2):
-        """Constructer."""
+    def __init__(self, t, e, i, worker_num=2, model_file=None,
+                 affinity=None, serial_work=hmm.SERIAL_WORK):
+        """Constructer.
+
+        @param model_file  is the XML file the parameters were loaded from.
+                           If given, the workers take the model preloaded
+                           by the fork server instead of a pickled copy.
+        @param affinity    is the policy binding each worker to a CPU,
+                           see tappm.hmm.affinity. None leaves them free.
+        @param serial_work is the work (see HMM.work) below which a call
+                           of viterbi_all decodes in this process, if the
+                           pool is not running."""
         hmm.HMM.__init__(self, t, e, i)
         self.worker_num = worker_num
+        self.model_file = model_file
+        self.affinity = affinity
+        self.serial_work = serial_work
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+        self._file_params = (t, e, i)
+        self._pool = None
+        self._pool_params = None
+        self._log_listener = None
+        if model_file and model_file not in _PRELOAD_FILES:
+            _PRELOAD_FILES.append(model_file)
+
+    def start(self):
+        """Start the pool of decoding workers if it is not running.
+
+        Each worker keeps its own copy of the model, so the pool is
+        restarted when the parameters have been replaced (e.g. by training).
+        """
+        params = (self._t, self._e, self._i)
+        if self._pool is not None and \
+           all(a is b for a, b in zip(params, self._pool_params)):
+            return self._pool
+        self.close()
+        context = get_context()
+        if self.model_file and context.get_start_method() == 'forkserver' \
+           and all(a is b for a, b in zip(params, self._file_params)):
+            # Unchanged since loading: only the name of the file is sent.
+            initargs = (None, None, None, self.model_file)
+        else:
+            initargs = params + (None,)
+        cpus = cpu_affinity.plan(self.affinity) if self.affinity else None
+        # Workers take the CPUs of the plan in turn; replacements of dead
+        # workers continue the rotation.
+        initargs += (cpus, context.Value('i', 0))
+        # Workers send their log records through a queue to a thread here,
+        # which hands them to the loggers of this process; they log at the
+        # level of the HMM core at the start of the pool.
+        log_queue = context.Queue()
+        self._log_listener = QueueListener(log_queue, RelayHandler())
+        self._log_listener.start()
+        initargs += (log_queue, hmm.logger.getEffectiveLevel())
+        self._stats = {}
+        self._pool = context.Pool(
+            self.worker_num, init_viterbi_worker, initargs)
+        self._pool_params = params
+        return self._pool
+
+    def close(self):
+        """Terminate the pool of decoding workers."""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+        if self._log_listener is not None:
+            self._log_listener.stop()
+        self._pool = None
+        self._pool_params = None
+        self._log_listener = None
+
+    def resize(self, worker_num):
+        """Change the number of decoding workers.
+
+        A running pool is replaced; with the fork server new workers start
+        almost immediately."""
+        if worker_num == self.worker_num:
+            return
+        running = self._pool is not None
+        self.close()
+        self.worker_num = worker_num
+        if running:
+            self.start()
+
+    def viterbi_all(self, observations, chunksize=None, **args):
+        """Decode a list of observations with the pool of workers.
+
+        The pool is kept alive between calls, so repeated calls only pay
+        for the decoding itself."""
+        if len(observations) == 0:
+            return []
+        if not self.uses_pool(sum(len(x) for x in observations)):
+            # Starting the pool would take longer than the decoding.
+            return hmm.HMM.viterbi_all(
+                self, [resolve(x) for x in observations], **args)
+        pool = self.start()
+        if chunksize is None:
+            chunksize = max(1, len(observations) // (self.worker_num * 4))
+        decoded = pool.map(
+            decode_one, [(x, args) for x in observations], chunksize)
+        with self._stats_lock:
+            for x, (pid, cpu, seconds, result) in zip(observations, decoded):
+                stats = self._stats.setdefault(
+                    pid, {'pid': pid, 'cpu': cpu, 'sequences': 0,
+                          'residues': 0, 'seconds': 0.0})
+                stats['sequences'] += 1
+                stats['residues'] += len(x)
+                stats['seconds'] += seconds
+        return [result for pid, cpu, seconds, result in decoded]
+
+    def uses_pool(self, residues):
+        """Return True if viterbi_all decodes observations of residues
+        residues in total with the pool rather than in this process."""
+        return self._pool is not None or \
+            residues * self._K * self._K >= self.serial_work
+
+    def worker_stats(self):
+        """Return the work done by each worker of the current pool.
+
+        A list of dictionaries with the keys pid, cpu (None if not bound),
+        sequences, residues, seconds (busy time) and residues/s."""
+        with self._stats_lock:
+            stats = [dict(s) for s in self._stats.values()]
+        for s in stats:
+            s['residues/s'] = s['residues'] / s['seconds'] \
+                if s['seconds'] > 0 else 0.0
+        return sorted(stats, key=lambda s: s['pid'])
 
     def baum_welch(self,
                    observations,
@@ -36,7 +176,7 @@ class MultiProcessHMM(hmm.HMM):
         workers = [Worker(i, tasks, results) for i in range(worker_num)]
         for w in workers:
             w.start()
-            logging.info("Starting process %d...", w.id_num)
+            logger.info("Starting process %d...", w.id_num)
         l_prev = 0
         for n in range(iter_limit):
             for i in range(len(observations)):
@@ -54,7 +194,7 @@ class MultiProcessHMM(hmm.HMM):
             if hmm.has_positive(pseudocounts):
                 self.add_pseudocounts(pseudocounts)
             dif = l - l_prev
-            logging.info("iter: %d, likelihood=%f, delta=%f", n, l, dif)
+            logger.info("iter: %d, likelihood=%f, delta=%f", n, l, dif)
             l_prev = l
             if n > 0 and dif < threshold:
                 break
@@ -145,6 +285,110 @@ class Estimator(object):
         # return {self.seq_number: [gamma, xi_sum, c]}
 
 
+# The model used by a decoding worker and the CPU it is bound to (if any),
+# set once by init_viterbi_worker.
+_WORKER_HMM = None
+_WORKER_CPU = None
+
+
+def get_context():
+    """Return the multiprocessing context of the decoding pools.
+
+    The fork server is used where available: it imports the HMM core and
+    loads the registered models once, and workers are forked from it."""
+    if not hasattr(multiprocessing, 'get_context') or \
+       'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing
+    context = multiprocessing.get_context('forkserver')
+    start_forkserver(context)
+    return context
+
+
+def start_forkserver(context):
+    """Start the fork server with the models of _PRELOAD_FILES preloaded.
+
+    The server is started once per process, so models registered after
+    that are loaded by each worker instead. BLAS/OpenMP libraries of the
+    server and its workers are limited to one thread, unless the user has
+    configured them, as the workers already run in parallel."""
+    from multiprocessing import forkserver
+    context.set_forkserver_preload(['tappm.hmm.preload'])
+    environ = cpu_affinity.blas_thread_limits()
+    environ[PRELOAD_ENV] = os.pathsep.join(_PRELOAD_FILES)
+    saved = dict((name, os.environ.get(name)) for name in environ)
+    os.environ.update(environ)
+    try:
+        forkserver.ensure_running()
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+
+
+class RelayHandler(logging.Handler):
+    """Hand a record received from a worker to the logger of its name in
+    this process."""
+
+    def emit(self, record):
+        target = logging.getLogger(record.name)
+        if target.isEnabledFor(record.levelno):
+            target.handle(record)
+
+
+def init_worker_logging(log_queue, level):
+    """Send the records of the tappm loggers of a worker to log_queue."""
+    root = logging.getLogger('tappm')
+    root.handlers = [QueueHandler(log_queue)]
+    root.propagate = False
+    root.setLevel(level)
+
+
+def init_viterbi_worker(t, e, i, model_file=None, cpus=None, slot=None,
+                        log_queue=None, log_level=logging.WARNING):
+    """Build the model of a decoding worker once, at its start-up.
+
+    If model_file is given instead of the parameters, the model preloaded
+    by the fork server is used (or loaded, if it is not there). If cpus is
+    given, the worker binds itself to the next CPU of the list (counted by
+    the shared value slot) before it allocates anything. Log records at
+    log_level or above are put into log_queue, if given."""
+    global _WORKER_HMM, _WORKER_CPU
+    if log_queue is not None:
+        init_worker_logging(log_queue, log_level)
+    cpu_affinity.limit_blas_threads()
+    if cpus:
+        with slot.get_lock():
+            n = slot.value
+            slot.value += 1
+        _WORKER_CPU = cpus[n % len(cpus)]
+        cpu_affinity.pin(_WORKER_CPU)
+    if model_file is None:
+        _WORKER_HMM = hmm.HMM(t, e, i)
+        return
+    from tappm.hmm import preload
+    model = preload.MODELS.get(model_file)
+    if model is None:
+        model = preload.load_model(model_file)
+    elif cpus:
+        # Copy the shared model into memory local to the CPU.
+        model = hmm.HMM(model._t.copy(), model._e.copy(), model._i.copy())
+        model.compile()
+    _WORKER_HMM = model
+
+
+def decode_one(task):
+    """Decode a single observation in a worker. task is (x, kwargs); x may
+    be a seqstore.SharedSlice, read in place.
+
+    Return (pid, cpu, seconds, result) for the statistics of the workers."""
+    x, args = task
+    start = time.time()
+    result = _WORKER_HMM.viterbi(resolve(x), **args)
+    return os.getpid(), _WORKER_CPU, time.time() - start, result
+
+
 def split_data(x, num):
     """Split the data set x into num subsets."""
     data_num = len(x)
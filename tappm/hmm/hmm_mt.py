@@ -0,0 +1,50 @@
+# -*- coding:utf-8 -*-
+
+from multiprocessing.pool import ThreadPool
+from tappm.hmm import hmm
+
+
+class MultiThreadHMM(hmm.HMM):
+    """Implementation of HMM decoding with a pool of threads.
+
+    Unlike MultiProcessHMM, the workers share this model and the list of
+    observations, so nothing is pickled or copied per worker. It pays off
+    where decoding is dominated by NumPy operations releasing the GIL."""
+    def __init__(self, t, e, i, worker_num=2, serial_work=hmm.SERIAL_WORK):
+        """Constructer.
+
+        @param serial_work is the work (see HMM.work) below which a call
+                           of viterbi_all decodes in the calling thread, if
+                           the pool is not running."""
+        hmm.HMM.__init__(self, t, e, i)
+        self.worker_num = worker_num
+        self.serial_work = serial_work
+        self._pool = None
+
+    def start(self):
+        """Compile the model and start the pool of threads."""
+        # Compile before the threads share the model, so that they
+        # only read it.
+        self.compile()
+        if self._pool is None:
+            self._pool = ThreadPool(self.worker_num)
+        return self._pool
+
+    def close(self):
+        """Stop the pool of threads."""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+        self._pool = None
+
+    def viterbi_all(self, observations, chunksize=None, **args):
+        """Decode a list of observations with the pool of threads."""
+        if len(observations) == 0:
+            return []
+        if self._pool is None and self.work(observations) < self.serial_work:
+            return hmm.HMM.viterbi_all(self, observations, **args)
+        pool = self.start()
+        if chunksize is None:
+            chunksize = max(1, len(observations) // (self.worker_num * 4))
+        return pool.map(lambda x: self.viterbi(x, **args),
+                        observations, chunksize)
@@ -0,0 +1,42 @@
+# -*- coding:utf-8 -*-
+"""Models preloaded by the fork server of the decoding pools.
+
+The fork server imports this module once, before it forks any worker. The
+models named in the environment variable hmm_mp.PRELOAD_ENV (separated by
+os.pathsep) are loaded and compiled here, so the workers find them in
+MODELS and share their pages with the server copy-on-write.
+
+Do not import this module elsewhere; use hmm_mp.MultiProcessHMM instead."""
+
+import os
+import warnings
+from tappm.hmm import hmm
+from tappm.hmm import util
+from tappm.hmm.hmm_mp import PRELOAD_ENV
+
+# Workers re-run the main module. Under "python -m tappm.apps.tappm_cli"
+# runpy warns in each of them that tappm.apps has imported it already.
+warnings.filterwarnings(
+    'ignore', message='.*found in sys.modules after import of package',
+    category=RuntimeWarning)
+
+# Compiled models by the name of their XML file.
+MODELS = {}
+
+
+def load_model(filename):
+    """Load and compile the model in an XML file of GHMM."""
+    (t, e, i) = util.load_ghmmxml(filename)
+    model = hmm.HMM(t, e, i)
+    model.compile()
+    return model
+
+
+for filename in os.environ.get(PRELOAD_ENV, '').split(os.pathsep):
+    if not filename:
+        continue
+    try:
+        MODELS[filename] = load_model(filename)
+    except Exception:
+        # The fork server must not die; the workers load it themselves.
+        pass
@@ -1,15 +1,22 @@
 # -*- coding: utf-8 -*-
 
+import io
 import os
 import sys
 import zipfile
 import os.path
 import platform
+import threading
 from os import sep as pathsep
 from os.path import isfile, isdir
 from os.path import getsize, isabs, exists, abspath
 from shutil import copy
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 PLATFORM = platform.system()
 
 __all__ = []
@@ -160,6 +167,168 @@ OPEN = {
     'zip': zipfile.ZipFile,
 }
 
+# The first bytes of the compressed files, by their key in OPEN.
+MAGIC = (
+    (b'\x1f\x8b', 'gz'),
+    (b'BZh', 'bz2'),
+    (b'PK\x03\x04', 'zip'),
+)
+
+# The size of the read buffers of open_text.
+READ_BUFFER = 1 << 20
+
+# The file name of the standard input (or output).
+STDIO = '-'
+
+
+def compression(filename):
+    """Return the key in OPEN of the compression of a file, detected by its
+    first bytes, or None if it is not compressed (or is STDIO)."""
+
+    if filename == STDIO:
+        return None
+    with open(filename, 'rb') as f:
+        return magic_kind(f.read(4))
+
+
+def magic_kind(head):
+    """Return the key in OPEN of the compression starting with the bytes
+    head, or None."""
+
+    for magic, kind in MAGIC:
+        if head.startswith(magic):
+            return kind
+    return None
+
+
+def open_compressed(filename, kind):
+    """Open a compressed file for reading its content as bytes.
+
+    A zip archive must hold a single file."""
+
+    if kind != 'zip':
+        return OPEN[kind](filename, 'rb')
+    archive = OPEN['zip'](filename)
+    names = [name for name in archive.namelist() if not name.endswith('/')]
+    if len(names) != 1:
+        archive.close()
+        raise ValueError('{0} holds {1} files; one is expected'.format(
+            filename, len(names)))
+    member = archive.open(names[0])
+    # The member keeps the file of the archive open until it is closed.
+    archive.close()
+    return member
+
+
+def open_text(filename, buffering=READ_BUFFER, threaded=False):
+    """Open a text file for reading. A file compressed by gzip, bzip2 or zip
+    (see MAGIC) is decompressed while it is read, whatever its name.
+
+    STDIO is the standard input, which may be compressed by gzip or bzip2.
+
+    :arg buffering: the size of the read buffers
+    :arg threaded: decompress in a thread of its own, ahead of the reader
+    """
+
+    if filename == STDIO:
+        return open_stdin(buffering, threaded)
+    kind = compression(filename)
+    if kind is None:
+        return open(filename, 'r', buffering=buffering)
+    stream = open_compressed(filename, kind)
+    if threaded:
+        stream = io.BufferedReader(PrefetchReader(stream, buffering),
+                                   buffering)
+    else:
+        stream = io.BufferedReader(stream, buffering)
+    return io.TextIOWrapper(stream)
+
+
+def open_stdin(buffering=READ_BUFFER, threaded=False):
+    """Open the standard input like open_text. Closing the returned file
+    leaves sys.stdin open."""
+
+    stream = io.open(os.dup(sys.stdin.fileno()), 'rb', buffering)
+    kind = magic_kind(stream.peek(4)[:4])
+    if kind is None:
+        return io.TextIOWrapper(stream)
+    if kind == 'zip':
+        stream.close()
+        raise ValueError('a zip archive cannot be read from the standard '
+                         'input')
+    if kind == 'gz':
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
+    else:
+        stream = bz2.BZ2File(stream, 'rb')
+    if threaded:
+        stream = PrefetchReader(stream, buffering)
+    return io.TextIOWrapper(io.BufferedReader(stream, buffering))
+
+
+class PrefetchReader(io.RawIOBase):
+    """Read a stream in a thread of its own, a few blocks ahead.
+
+    zlib and bz2 release the GIL, so a compressed file is decompressed
+    while the records already read are parsed and scored."""
+
+    def __init__(self, stream, blocksize=READ_BUFFER, depth=4):
+        io.RawIOBase.__init__(self)
+        self._stream = stream
+        self._blocksize = blocksize
+        self._queue = queue.Queue(depth)
+        self._stop = threading.Event()
+        self._block = b''
+        self._offset = 0
+        self._eof = False
+        self._thread = threading.Thread(target=self._fill)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _fill(self):
+        try:
+            while True:
+                block = self._stream.read(self._blocksize)
+                if not self._put(block) or not block:
+                    return
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self._offset >= len(self._block):
+            if self._eof:
+                return 0
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                raise item
+            if not item:
+                self._eof = True
+                return 0
+            self._block = item
+            self._offset = 0
+        n = min(len(b), len(self._block) - self._offset)
+        b[:n] = self._block[self._offset:self._offset + n]
+        self._offset += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            self._thread.join()
+            self._stream.close()
+        io.RawIOBase.close(self)
+
 
 def isExecutable(path):
     """Return true if *path* is an executable."""
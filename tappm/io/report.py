@@ -5,8 +5,11 @@
 # @Last Modified time: 2016-01-20 20:25:15
 
 import os
+import re
+import sys
 import numpy as np
 
+from contextlib import contextmanager
 from time import localtime, strftime
 from tappm import jinja2_ENV, VERSION
 from tappm.utils import wrapText
@@ -104,6 +107,25 @@ class ResultItems(object):
     def render(self, format='html'):
         return self.template.render(self.__get_elements__())
 
+    def as_dict(self):
+        """ Return the result as a dictionary of JSON serializable values """
+        return {
+            'name': self.identifier,
+            'description': self.description,
+            'seqLen': len(self.sequence),
+            'TAprotein': self.TAprotein,
+            'isTA': self.isTA,
+            'hasTMD': self.has_tmd,
+            'NumOfTMD': self.NumOfTMD,
+            'score': self.score,
+            'likelihood': self.likelihood,
+            'likelihood_mp': self.likelihood_mp,
+            'tmd_POS': self.tmd_position,
+            'CterTMDPos': self.CterTMDPos,
+            'threshold': self.threshold,
+            'path': self.vpath,
+        }
+
 
 def do_rollover(outfile, backupCount=5):
     """ Determine if rollover should occur """
@@ -120,25 +142,143 @@ def do_rollover(outfile, backupCount=5):
                 os.rename(sfn, dfn)
 
 
-def report(resultItemsList, outfile, fmt='html', backupCount=5,
-           ncpu=4, threshold=-0.0167222981, totalSeq=0):
+@contextmanager
+def open_report(outfile, backupCount=5):
+    """ Open outfile for writing a report after rolling over; '-' is the
+    standard output, which is flushed but not closed """
+    if outfile == '-':
+        yield sys.stdout
+        sys.stdout.flush()
+        return
+    do_rollover(outfile, backupCount=backupCount)
+    with open(outfile, 'w') as fout:
+        yield fout
+
+
+BODY_MARK = '\x00body_content\x00'
+
+
+def render_report_parts(fmt='html', ncpu=4, threshold=-0.0167222981,
+                        totalSeq=0, shard=None):
+    """ Render the report around its body; return (head, tail)
+
+    shard is the label ('i/N') of the part of the input the report covers,
+    if it covers one shard only """
     tplName = TPL_MAP[fmt]
     tpl = jinja2_ENV.get_template(tplName)
-    # do roll-over
-    do_rollover(outfile, backupCount=backupCount)
+    content = tpl.render({
+        'package': "TAPPM ver. " + VERSION,
+        'version': VERSION,
+        'rptTime': strftime("%d %b %Y %H:%M:%S", localtime()),
+        'threshold': threshold,
+        'ncpu': ncpu,
+        'totalSeq': totalSeq,
+        'shard': shard,
+        'body_content': BODY_MARK,
+    })
+    head, tail = content.split(BODY_MARK)
+    return head, tail
+
+
+def render_report(resultItemsList, fmt='html', ncpu=4,
+                  threshold=-0.0167222981, totalSeq=0, shard=None):
+    """ Render the whole report into a string """
+    head, tail = render_report_parts(fmt=fmt, ncpu=ncpu, threshold=threshold,
+                                     totalSeq=totalSeq, shard=shard)
     # Add resultItems
-    block = ''
-    for item in resultItemsList:
-        block += item.render()
+    block = ''.join(item.render() for item in resultItemsList)
+    return head + block + tail
 
-    with open(outfile, 'w') as fout:
-        fout.write(
-            tpl.render({
-                'package': "TAPPM ver. " + VERSION,
-                'version': VERSION,
-                'rptTime': strftime("%d %b %Y %H:%M:%S", localtime()),
-                'threshold': threshold,
-                'ncpu': ncpu,
-                'totalSeq': totalSeq,
-                'body_content': block,
-            }))
+
+SHARD_PATTERN = re.compile(r'^\s*(?:# Shard: |<shard>)(\d+)/(\d+)')
+TOTAL_PATTERN = re.compile(r'(?:<totalSeq>|^# Total input sequences: )(\d+)')
+
+
+def read_report_head(stream, fmt):
+    """ Read the head of a report in fmt from stream, leaving it at the
+    first item. Return a dictionary of 'shard' ((i, N) or None) and
+    'totalSeq' (None if the format does not show it) """
+    head, tail = render_report_parts(fmt=fmt)
+    lines = head.count('\n')
+    info = {'shard': None, 'totalSeq': None}
+    n = 0
+    while n < lines:
+        line = stream.readline()
+        if not line:
+            raise ValueError("The report ends in its head")
+        n += 1
+        match = SHARD_PATTERN.match(line)
+        if match:
+            info['shard'] = (int(match.group(1)), int(match.group(2)))
+            lines += 1
+        match = TOTAL_PATTERN.search(line)
+        if match:
+            info['totalSeq'] = int(match.group(1))
+    return info
+
+
+def copy_report_body(stream, out, fmt, blocksize=1 << 20):
+    """ Copy the items of a report in fmt from stream (read up to the body
+    by read_report_head) into out """
+    tail = render_report_parts(fmt=fmt)[1]
+    reserve = ''
+    while True:
+        block = stream.read(blocksize)
+        if not block:
+            break
+        reserve += block
+        if len(reserve) > len(tail):
+            cut = len(reserve) - len(tail)
+            out.write(reserve[:cut])
+            reserve = reserve[cut:]
+    if reserve != tail:
+        raise ValueError("The report does not end as a {} report".format(fmt))
+
+
+def merge_reports(filenames, outfile, fmt='tabular', backupCount=5):
+    """ Merge the reports of the shards 1/N .. N/N of an input, in any
+    order, into the report of the whole input. Return the total number of
+    sequences (None if the format does not show it) """
+    shards = []
+    for filename in filenames:
+        with open(filename, 'r') as f:
+            info = read_report_head(f, fmt)
+        if info['shard'] is None:
+            raise ValueError("{} is not the report of a shard"
+                             .format(filename))
+        shards.append((info['shard'], info['totalSeq'], filename))
+    # The shards are consecutive ranges of the input, so their items are
+    # merged by concatenating them in the order of the shards.
+    shards.sort()
+    found = [shard for shard, totalSeq, filename in shards]
+    total = found[0][1] if found else 0
+    if found != [(i, total) for i in range(1, total + 1)]:
+        raise ValueError("Expected the reports of the shards 1/N .. N/N, "
+                         "found {}".format(
+                             ', '.join('%d/%d' % shard for shard in found)))
+    totalSeq = None
+    if all(t is not None for shard, t, filename in shards):
+        totalSeq = sum(t for shard, t, filename in shards)
+    head, tail = render_report_parts(
+        fmt=fmt, totalSeq='NA' if totalSeq is None else totalSeq)
+    with open_report(outfile, backupCount=backupCount) as out:
+        out.write(head)
+        for shard, t, filename in shards:
+            with open(filename, 'r') as f:
+                read_report_head(f, fmt)
+                copy_report_body(f, out, fmt)
+        out.write(tail)
+    return totalSeq
+
+
+def write_report(content, outfile, backupCount=5):
+    """ Write a rendered report into outfile after rolling over """
+    with open_report(outfile, backupCount=backupCount) as fout:
+        fout.write(content)
+
+
+def report(resultItemsList, outfile, fmt='html', backupCount=5,
+           ncpu=4, threshold=-0.0167222981, totalSeq=0):
+    content = render_report(resultItemsList, fmt=fmt, ncpu=ncpu,
+                            threshold=threshold, totalSeq=totalSeq)
+    write_report(content, outfile, backupCount=backupCount)
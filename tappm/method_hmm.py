@@ -2,10 +2,17 @@
 
 import tappm.hmm.hmm as hmm
 import tappm.hmm.hmm_mp as hmm_mp
+import tappm.hmm.hmm_mt as hmm_mt
 import tappm.hmm.util as hmmutil
 import tappm.dataset
 import numpy as np
 import tappm.method as method
+from tappm.encoder import SequenceEncoder
+
+# Estimated bytes per residue of an encoded sequence (a uint8 array) and of
+# a converted result (the path, the route and the omegas).
+ENCODED_BYTES = 1
+RESULT_BYTES = 100
 
 
 class MyHmmPredictor(method.Method):
@@ -15,38 +22,174 @@ class MyHmmPredictor(method.Method):
     make the datasets into numerical form that suit my implementation."""
 
     def __init__(self, filename='', cpus=1,
-                 valid_chars="ACDEFGHIKLMNPQRSTVWY"):
-        '''Read an XML file of GHMM and convert it.'''
+                 valid_chars="ACDEFGHIKLMNPQRSTVWY", backend='process',
+                 affinity=None, serial_work=hmm.SERIAL_WORK):
+        '''Read an XML file of GHMM and convert it.
+
+        @param backend  is 'process' or 'thread', the kind of workers used
+                        for decoding when cpus > 1.
+        @param affinity is the policy binding the process workers to CPUs,
+                        see tappm.hmm.affinity.
+        @param serial_work  is the decoding work (see decoding_work) below
+                        which a prediction runs in this process, without
+                        starting the workers.'''
         self.method_name = 'hmm'
         self.model_file = filename
         self.method = None
+        self.backend = backend
+        self.affinity = affinity
+        self.serial_work = serial_work
         self.valid_chars = valid_chars
-        self.valid_char_dic = {
-            self.valid_chars[i]: i for i in range(len(self.valid_chars))}
+        self.encoder = SequenceEncoder(valid_chars)
         self.decoder = ""
         self.load(filename, cpus)
 
     def load(self, filename, cpus=1):
         """Read an XML file of GHMM."""
         (t, e, i) = hmmutil.load_ghmmxml(filename)
+        self.close()
         if cpus == 1:
             self.method = hmm.HMM(t, e, i)
+        elif cpus > 1 and self.backend == 'thread':
+            self.method = hmm_mt.MultiThreadHMM(
+                t, e, i, worker_num=cpus, serial_work=self.serial_work)
         elif cpus > 1:
-            self.method = hmm_mp.MultiProcessHMM(t, e, i, worker_num=cpus)
+            self.method = hmm_mp.MultiProcessHMM(
+                t, e, i, worker_num=cpus, model_file=filename,
+                affinity=self.affinity, serial_work=self.serial_work)
 
     def initialize(self, cpus=1):
         """Reload hmm files"""
         if self.model_file:
             self.load(self.model_file, cpus)
 
-    def predict(self, dataset, reverse=False, **args):
-        """Predict (or Decode) a sequence by Viterbi algorithm."""
-        dataset_tmp = self.convert_dataset(dataset, reverse)
-        # i: identifier
-        # d: (converted) data
-        result_tmp = {i: self.method.viterbi(d, return_omega=True)
-                      for i, d in list(dataset_tmp.items())}
-        return self.convert_result(result_tmp, reverse=reverse)
+    def start(self):
+        """Start the decoding workers ahead of the first prediction."""
+        if self.method is not None:
+            self.method.start()
+
+    def close(self):
+        """Stop the decoding workers, if any."""
+        if self.method is not None:
+            self.method.close()
+
+    def worker_stats(self):
+        """Return the work done by each decoding worker, if known."""
+        if hasattr(self.method, 'worker_stats'):
+            return self.method.worker_stats()
+        return []
+
+    def decoding_work(self, residues):
+        """Estimate the work of decoding sequences of residues in total,
+        in the unit of HMM.work (N * K * K summed over sequences)."""
+        return residues * self.method._K * self.method._K
+
+    def predict(self, dataset, reverse=False, max_memory=None, **args):
+        """Predict (or Decode) a sequence by Viterbi algorithm.
+
+        While the workers are not running, a dataset needing less work than
+        serial_work is decoded in this process, as it would take longer to
+        start them.
+
+        @param max_memory  is the number of bytes decoding may use, see
+                           decode_encoded."""
+        sequences = list(dataset)
+        decoded = self.predict_sequences(sequences, reverse=reverse,
+                                         max_memory=max_memory)
+        # Later sequences replace earlier ones with the same identifier,
+        # as convert_dataset does.
+        return {seq.identifier: result
+                for seq, result in zip(sequences, decoded)}
+
+    def predict_sequences(self, sequences, reverse=False, missing='ignore',
+                          max_memory=None):
+        """Decode a list of Fasta objects.
+
+        Unlike predict, the results are returned as a list in the order of
+        sequences, so identifiers need not be unique."""
+        encoded = [self.encode_record(seq, reverse, missing)
+                   for seq in sequences]
+        self.encoder.report()
+        return self.decode_encoded(encoded, reverse=reverse,
+                                   max_memory=max_memory)
+
+    def predict_store(self, store, reverse=False, max_memory=None):
+        """Decode the sequences of an EncodedSequenceStore (encoded with
+        self.encoder) and return the results in the order of the store.
+
+        The longest sequences are sent to the workers first, so that the
+        last ones to finish are short. If the store is shared (see
+        EncodedSequenceStore.share), process workers read the residues in
+        place instead of receiving copies. The residues of a packed store
+        are unpacked a block (see EncodedSequenceStore.batches) at a time.
+        """
+        order = store.length_order(descending=True)
+        # Only the workers read the shared memory: decoding in this process
+        # takes views of the store instead of attaching the memory again.
+        in_place = store.shared and \
+            isinstance(self.method, hmm_mp.MultiProcessHMM) and \
+            self.method.uses_pool(int(store.offsets[-1]))
+        if in_place:
+            # Send every batch to the workers, also one below serial_work.
+            self.method.start()
+        decoded = []
+        for part in store.batches(order):
+            if in_place:
+                encoded = store.slices(part, reverse)
+            else:
+                encoded = store.encoded(part, reverse)
+            decoded.extend(self.decode_encoded(encoded, reverse=reverse,
+                                               max_memory=max_memory))
+        results = [None] * len(store)
+        for i, result in zip(order.tolist(), decoded):
+            results[i] = result
+        return results
+
+    def decode_encoded(self, encoded, reverse=False, max_memory=None):
+        """Decode a list of sequences made by encode_sequence.
+
+        If max_memory (in bytes) is given, half of it is shared by the
+        dynamic programming of the workers decoding at the same time, and
+        a sequence that does not fit falls back to the low-memory engine
+        (see HMM.viterbi). The other half bounds the observations and
+        results of a batch sent to the workers at once."""
+        if max_memory is None:
+            return self._decode_batch(encoded, reverse)
+        workers = getattr(self.method, 'worker_num', 1)
+        dp_memory = max_memory // (2 * workers)
+        decoded = []
+        for batch in self.memory_batches(encoded, max_memory // 2):
+            decoded.extend(self._decode_batch(batch, reverse,
+                                              max_memory=dp_memory))
+        return decoded
+
+    def _decode_batch(self, encoded, reverse=False, **args):
+        decoded = self.method.viterbi_all(encoded, return_omega=True, **args)
+        return [self.convert_one(result, reverse=reverse)
+                for result in decoded]
+
+    def memory_batches(self, encoded, max_memory):
+        """Split encoded sequences into batches of at most max_memory bytes,
+        as estimated by sequence_memory. A batch has one sequence at least.
+        """
+        batch = []
+        size = 0
+        for x in encoded:
+            need = self.sequence_memory(len(x))
+            if batch and size + need > max_memory:
+                yield batch
+                batch = []
+                size = 0
+            batch.append(x)
+            size += need
+        if batch:
+            yield batch
+
+    def sequence_memory(self, length):
+        """Estimate the bytes held for a sequence of length residues from
+        encoding to the end of convert_one (excluding the decoding itself).
+        """
+        return length * (ENCODED_BYTES + RESULT_BYTES)
 
     def train(self, dataset, reverse=False, if_debug=False, **args):
         """Train sequences using Baum-Welch algorithm."""
@@ -64,44 +207,59 @@ class MyHmmPredictor(method.Method):
         @param reverse  is a boolean"""
         converted = {}
         for seq in dataset:
-            converted_tmp = []
-            for c in seq.sequence:
-                try:
-                    converted_tmp.append(self.valid_char_dic[c])
-                except KeyError:
-                    if missing == 'ignore':
-                        print("invalid character %s found." % c)
-                    elif missing == 'error':
-                        raise ValueError("Invalid character: " + c)
-            if reverse:
-                converted_tmp = converted_tmp[::-1]
-            converted[seq.identifier] = converted_tmp
+            converted[seq.identifier] = self.encode_sequence(
+                seq.sequence, reverse, missing)
+        self.encoder.report()
         return converted
 
+    def encode_sequence(self, sequence, reverse=False, missing='ignore'):
+        """Convert a sequence into a uint8 array of symbol indices.
+
+        Invalid characters raise ValueError if missing is 'error'; otherwise
+        they are dropped and counted by self.encoder, whose summary is
+        logged by predict and convert_dataset (see SequenceEncoder.report).
+        """
+        return self.encoder.encode(sequence, reverse, missing)
+
+    def encode_record(self, seq, reverse=False, missing='ignore'):
+        """Convert a Fasta object like encode_sequence. The codes of a
+        record of a tappmdb file are taken as they are, if they were made
+        with the valid characters of this predictor."""
+        codes = getattr(seq, 'codes', None)
+        if codes is not None and seq.alphabet == self.valid_chars:
+            return codes[::-1] if reverse else codes
+        return self.encode_sequence(seq.sequence, reverse, missing)
+
     def convert_result(self, results, reverse=False):
         """Convert numerical representation into more readable form."""
         converted = {}
         for i, result in list(results.items()):
-            converted_tmp = ""
-            for n in result[0]:  # result[1] is a likelihood
-                try:
-                    converted_tmp += self.decoder[int(n)]
-                except IndexError:
-                    print("%d is out of range (only %d states registered)." %
-                          (n, len(self.decoder)))
-            if reverse:
-                converted_tmp = converted_tmp[::-1]
-            converted[i] = {'path': converted_tmp,
-                            'pathnum': result[0],
-                            'likelihood': result[1]}
-            if len(result) > 2:
-                converted[i]['omega'] = result[2]
+            converted[i] = self.convert_one(result, reverse=reverse)
+        return converted
+
+    def convert_one(self, result, reverse=False):
+        """Convert a single result of viterbi into a dictionary."""
+        converted_tmp = ""
+        for n in result[0]:  # result[1] is a likelihood
+            try:
+                converted_tmp += self.decoder[int(n)]
+            except IndexError:
+                print("%d is out of range (only %d states registered)." %
+                      (n, len(self.decoder)))
+        if reverse:
+            converted_tmp = converted_tmp[::-1]
+        converted = {'path': converted_tmp,
+                     'pathnum': result[0],
+                     'likelihood': result[1]}
+        if len(result) > 2:
+            converted['omega'] = result[2]
         return converted
 
     def reset_valid_chars(self, chars=""):
         """Reset valid characters, which are used in convert_dataset method."""
         if len(chars) > 0:
             self.valid_chars = chars
+            self.encoder = SequenceEncoder(chars)
         else:
             raise ValueError("chars must contain at least one character.")
 
@@ -0,0 +1,470 @@
+# -*- coding:utf-8 -*-
+"""seqstore  is a module for keeping encoded sequences in flat arrays
+
+An EncodedSequenceStore keeps the encoded residues of all its sequences in
+one uint8 array, one byte a residue, and their bounds in an int64 array:
+
+    residues[offsets[i]:offsets[i + 1]]   the residues of the i-th sequence
+
+A sequence, a run of sequences or a reversed sequence is a view of the
+array, not a copy. The identifiers are interned and may carry labels. The
+residues can be moved into shared memory, so that decoding workers read
+them in place: a task then carries the name of the memory and a range
+(a SharedSlice) instead of a pickled copy of the sequence.
+
+The codes of an alphabet of up to 32 characters (such as the 20 amino
+acids) fit in 5 bits. A packed store (see EncodedSequenceStore.pack) keeps
+8 residues in 5 bytes, and unpacks the residues of a sequence when it is
+taken; MyHmmPredictor.predict_store unpacks a block of sequences at a time.
+"""
+import numpy as np
+
+from tappm.encoder import INVALID
+
+try:
+    from sys import intern
+except ImportError:
+    pass
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+__all__ = ['EncodedSequenceStore', 'PackedResidues', 'SharedSlice',
+           'resolve', 'pack5', 'unpack5', 'UNPACK_BLOCK']
+
+# The residues of a packed store unpacked at a time for decoding.
+UNPACK_BLOCK = 1 << 20
+
+# The bit offsets of the 8 codes of a packed group of 5 bytes.
+SHIFTS = np.arange(8, dtype=np.uint64) * np.uint64(5)
+
+# The groups of 8 codes packed or unpacked at a time; the work arrays take
+# 64 bytes a group.
+PACK_GROUPS = 1 << 16
+
+
+def pack5(codes):
+    """Pack a uint8 array of codes below 32 into 5 bits each: the codes
+    8k to 8k + 7 go into the bytes 5k to 5k + 4 (little-endian)."""
+    codes = np.asarray(codes, dtype=np.uint8)
+    if len(codes) and codes.max() >= 32:
+        raise ValueError("Codes of 32 or more cannot be packed in 5 bits")
+    groups = -(-len(codes) // 8)
+    packed = np.empty((groups, 5), dtype=np.uint8)
+    for first in range(0, groups, PACK_GROUPS):
+        last = min(groups, first + PACK_GROUPS)
+        work = np.zeros((last - first) * 8, dtype=np.uint64)
+        part = codes[first * 8:last * 8]
+        work[:len(part)] = part
+        words = np.bitwise_or.reduce(work.reshape(-1, 8) << SHIFTS, axis=1)
+        packed[first:last] = \
+            words.astype('<u8').view(np.uint8).reshape(-1, 8)[:, :5]
+    return packed.ravel()
+
+
+def unpack5(data, start, end):
+    """Return the codes start to end (end excluded) of packed data (see
+    pack5) as a uint8 array. Only their groups are read."""
+    first = start // 8
+    last = -(-end // 8)
+    codes = np.empty((last - first) * 8, dtype=np.uint8)
+    for a in range(first, last, PACK_GROUPS):
+        b = min(last, a + PACK_GROUPS)
+        words = np.zeros((b - a, 8), dtype=np.uint8)
+        words[:, :5] = data[a * 5:b * 5].reshape(-1, 5)
+        words = words.view('<u8')
+        codes[(a - first) * 8:(b - first) * 8] = \
+            ((words >> SHIFTS) & np.uint64(31)).ravel()
+    return codes[start - first * 8:end - first * 8]
+
+
+class PackedResidues(object):
+    """The residues start to end of codes packed by pack5. Indexing it
+    with a slice returns the unpacked codes.
+
+    :arg data: the packed bytes (a uint8 array)
+    """
+
+    def __init__(self, data, start, end):
+        self.data = data
+        self.start = start
+        self.end = end
+
+    @classmethod
+    def pack(cls, codes):
+        return cls(pack5(codes), 0, len(codes))
+
+    def __len__(self):
+        return self.end - self.start
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def __getitem__(self, key):
+        start, end, step = key.indices(len(self))
+        if step != 1:
+            raise ValueError("Packed residues are sliced with step 1 only")
+        return unpack5(self.data, self.start + start,
+                       self.start + max(start, end))
+
+    def part(self, start, end):
+        """Return the residues start to end, still packed (no copy)."""
+        return PackedResidues(self.data, self.start + start,
+                              self.start + end)
+
+
+# The shared residues last attached by this process: (name, memory, array).
+_ATTACHED = [None, None, None]
+
+
+def attached(name, size):
+    """Return the residues of the shared memory name as an array of size
+    bytes. A worker keeps the last one attached open."""
+    if _ATTACHED[0] != name:
+        memory = _ATTACHED[1]
+        _ATTACHED[:] = [None, None, None]
+        if memory is not None:
+            memory.close()
+        # The workers share the resource tracker of the process that made
+        # the memory, which unlinks it.
+        memory = shared_memory.SharedMemory(name)
+        _ATTACHED[:] = [name, memory, np.ndarray(size, dtype=np.uint8,
+                                                 buffer=memory.buf)]
+    return _ATTACHED[2]
+
+
+def detach(name):
+    """Close the shared memory name if this process keeps it attached."""
+    if _ATTACHED[0] == name:
+        memory = _ATTACHED[1]
+        _ATTACHED[:] = [None, None, None]
+        try:
+            memory.close()
+        except BufferError:
+            # A view of the residues is still used: the memory is
+            # unmapped when it goes.
+            pass
+
+
+class SharedSlice(object):
+    """The residues start to end of a store in shared memory, as they are
+    sent to a worker: a few numbers instead of the residues.
+
+    :arg name: the name of the shared memory
+    :arg size: the residues it holds
+    """
+
+    __slots__ = ('name', 'size', 'start', 'end', 'reverse', 'packed')
+
+    def __init__(self, name, size, start, end, reverse=False, packed=False):
+        self.name = name
+        self.size = size
+        self.start = start
+        self.end = end
+        self.reverse = reverse
+        self.packed = packed
+
+    def __getstate__(self):
+        return (self.name, self.size, self.start, self.end, self.reverse,
+                self.packed)
+
+    def __setstate__(self, state):
+        (self.name, self.size, self.start, self.end, self.reverse,
+         self.packed) = state
+
+    def __len__(self):
+        return self.end - self.start
+
+    def array(self):
+        """Return the residues as a view of the shared memory (a copy, if
+        they are packed)."""
+        data = attached(self.name, self.size)
+        if self.packed:
+            x = unpack5(data, self.start, self.end)
+        else:
+            x = data[self.start:self.end]
+        return x[::-1] if self.reverse else x
+
+
+def resolve(x):
+    """Return the residues of x, a SharedSlice or already an array."""
+    return x.array() if isinstance(x, SharedSlice) else x
+
+
+class EncodedSequenceStore(object):
+    """Encoded sequences in a flat residue array.
+
+    :arg residues: a uint8 array of the encoded residues of all sequences,
+        or PackedResidues
+    :arg offsets: an int64 array of len(identifiers) + 1 offsets in
+        residues
+    :arg identifiers: the identifiers of the sequences
+    :arg labels: the labels of the sequences, or None
+    """
+
+    def __init__(self, residues, offsets, identifiers, labels=None):
+        if len(offsets) != len(identifiers) + 1:
+            raise ValueError("%d offsets for %d sequences"
+                             % (len(offsets), len(identifiers)))
+        self.residues = residues
+        self.offsets = offsets
+        self.identifiers = [intern(str(name)) for name in identifiers]
+        self.labels = labels
+        self.memory = None
+        self._ids = None
+
+    # --- Making stores ---
+
+    @classmethod
+    def from_sequences(cls, sequences, encoder, missing='ignore',
+                       labels=None):
+        """Encode Fasta objects with a SequenceEncoder. The invalid
+        characters are dropped (and counted by the encoder) unless missing
+        is 'error'."""
+        identifiers = []
+        encoded = []
+        for seq in sequences:
+            identifiers.append(seq.identifier)
+            encoded.append(encoder.encode(seq.sequence, missing=missing))
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in encoded], out=offsets[1:])
+        residues = np.concatenate(encoded) if encoded else \
+            np.zeros(0, dtype=np.uint8)
+        return cls(residues, offsets, identifiers, labels)
+
+    @classmethod
+    def from_dataset(cls, dataset, encoder, missing='ignore'):
+        """Encode a FastaDataSet, in the order of its identifiers, with its
+        labels."""
+        sequences = [dataset.container[name] for name in dataset.identifiers]
+        labels = None
+        if getattr(dataset, 'labels', None):
+            labels = [dataset.labels.get(name)
+                      for name in dataset.identifiers]
+        return cls.from_sequences(sequences, encoder, missing, labels)
+
+    @classmethod
+    def from_block(cls, block, encoder, missing='ignore'):
+        """Encode a FastaBlock of bulk_reader (of bytes, not codes). The
+        identifiers are the first words of the headers."""
+        residues = block.residues
+        codes = encoder.table.take(residues)
+        offsets = block.offsets
+        bad = codes == INVALID
+        if bad.any():
+            if missing == 'error':
+                raise ValueError("Invalid character: " +
+                                 chr(residues[bad][0]))
+            kept = np.zeros(len(codes) + 1, dtype=np.int64)
+            np.cumsum(~bad, out=kept[1:])
+            codes = codes[~bad]
+            offsets, dropped = kept[offsets], offsets
+            encoder.count_invalid(residues[bad], np.count_nonzero(
+                np.diff(offsets) != np.diff(dropped)))
+        identifiers = [(header[1:].split(None, 1) or [''])[0]
+                       for header in block.headers]
+        return cls(codes, offsets, identifiers)
+
+    # --- Access ---
+
+    def __len__(self):
+        return len(self.identifiers)
+
+    @property
+    def lengths(self):
+        """The lengths of the sequences."""
+        return np.diff(self.offsets)
+
+    @property
+    def nbytes(self):
+        """The bytes of the residues and the offsets."""
+        return self.residues.nbytes + self.offsets.nbytes
+
+    @property
+    def packed(self):
+        """True if the residues are packed in 5 bits."""
+        return isinstance(self.residues, PackedResidues)
+
+    def pack(self):
+        """Return the store with its residues packed in 5 bits each (the
+        codes must be below 32)."""
+        if self.packed:
+            return self
+        return EncodedSequenceStore(PackedResidues.pack(self.residues),
+                                    self.offsets, self.identifiers,
+                                    self.labels)
+
+    def unpack(self):
+        """Return the store with its residues one byte each."""
+        if not self.packed:
+            return self
+        return EncodedSequenceStore(self.residues[:], self.offsets,
+                                    self.identifiers, self.labels)
+
+    def __getitem__(self, key):
+        """store[i] is the residues of the i-th sequence; store[a:b] is a
+        store of the sequences a to b. Neither copies the residues (but
+        packed residues are unpacked for store[i])."""
+        if isinstance(key, slice):
+            first, last, step = key.indices(len(self))
+            if step != 1:
+                raise ValueError("A store is sliced with step 1 only")
+            last = max(first, last)
+            base = self.offsets[first]
+            labels = self.labels[first:last] \
+                if self.labels is not None else None
+            end = self.offsets[last]
+            if self.packed:
+                residues = self.residues.part(base, end)
+            else:
+                residues = self.residues[base:end]
+            return EncodedSequenceStore(
+                residues, self.offsets[first:last + 1] - base,
+                self.identifiers[first:last], labels)
+        return self.sequence(key)
+
+    def sequence(self, i, reverse=False):
+        """Return the residues of the i-th sequence as a view (unpacked, if
+        they are packed), reversed if reverse."""
+        x = self.residues[self.offsets[i]:self.offsets[i + 1]]
+        return x[::-1] if reverse else x
+
+    def lookup(self, name):
+        """Return the number of the sequence name; the first one wins."""
+        if self._ids is None:
+            self._ids = {}
+            for i, identifier in enumerate(self.identifiers):
+                self._ids.setdefault(identifier, i)
+        try:
+            return self._ids[name]
+        except KeyError:
+            raise KeyError("No sequence named %s" % name)
+
+    def __contains__(self, name):
+        try:
+            self.lookup(name)
+        except KeyError:
+            return False
+        return True
+
+    def label(self, i):
+        """Return the label of the i-th sequence (None without labels)."""
+        return self.labels[i] if self.labels is not None else None
+
+    def encoded(self, order=None, reverse=False):
+        """Return the sequences as a list of views, in order (a
+        permutation, see length_order) if given."""
+        order = range(len(self)) if order is None else order
+        return [self.sequence(i, reverse) for i in order]
+
+    def batches(self, order=None, residues=None):
+        """Split order (by default the store) into runs of sequences of
+        about residues residues in total; by default UNPACK_BLOCK if the
+        store is packed, and all of them otherwise."""
+        order = np.arange(len(self)) if order is None else np.asarray(order)
+        if residues is None:
+            if not self.packed:
+                return [order]
+            residues = UNPACK_BLOCK
+        cumulative = np.cumsum(self.lengths[order])
+        cuts = np.searchsorted(
+            cumulative, np.arange(residues, cumulative[-1] if len(order)
+                                  else 0, residues), 'right')
+        return [part for part in np.split(order, np.unique(cuts))
+                if len(part)]
+
+    def length_order(self, descending=False):
+        """Return the permutation sorting the sequences by length; ties
+        keep their order."""
+        lengths = self.lengths
+        if descending:
+            lengths = -lengths
+        return np.argsort(lengths, kind='mergesort')
+
+    def take(self, order):
+        """Return a new store of the sequences in order (a permutation or
+        a subset), with the residues copied into place. Packed residues are
+        unpacked, gathered and packed again."""
+        if self.packed:
+            return self.unpack().take(order).pack()
+        order = np.asarray(order, dtype=np.int64)
+        starts = self.offsets[order]
+        lengths = self.offsets[order + 1] - starts
+        offsets = np.zeros(len(order) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        index = np.repeat(starts - offsets[:-1], lengths) + \
+            np.arange(offsets[-1])
+        labels = None
+        if self.labels is not None:
+            labels = [self.labels[i] for i in order.tolist()]
+        return EncodedSequenceStore(
+            self.residues[index], offsets,
+            [self.identifiers[i] for i in order.tolist()], labels)
+
+    # --- Sharing with workers ---
+
+    @property
+    def shared(self):
+        """True if the residues are in shared memory."""
+        return self.memory is not None
+
+    def share(self):
+        """Return a copy of the store with its residues in shared memory.
+        release() it once the workers are done."""
+        if shared_memory is None:
+            raise ValueError("Shared memory needs Python 3.8 or later")
+        source = self.residues.data if self.packed else self.residues
+        size = len(source)
+        memory = shared_memory.SharedMemory(create=True, size=max(1, size))
+        residues = np.ndarray(size, dtype=np.uint8, buffer=memory.buf)
+        residues[:] = source
+        if self.packed:
+            residues = PackedResidues(residues, self.residues.start,
+                                      self.residues.end)
+        store = EncodedSequenceStore(residues, self.offsets,
+                                     self.identifiers, self.labels)
+        store.memory = memory
+        return store
+
+    def slices(self, order=None, reverse=False):
+        """Return the sequences of a shared store as SharedSlices, in
+        order if given."""
+        if self.memory is None:
+            raise ValueError("The store is not shared; see share()")
+        name = self.memory.name
+        if self.packed:
+            size = len(self.residues.data)
+            offsets = (self.offsets + self.residues.start).tolist()
+        else:
+            size = len(self.residues)
+            offsets = self.offsets.tolist()
+        order = range(len(self)) if order is None else order
+        return [SharedSlice(name, size, offsets[i], offsets[i + 1], reverse,
+                            self.packed)
+                for i in order]
+
+    def release(self):
+        """Drop the shared residues and unlink the shared memory. This
+        process's own attachment of it (see SharedSlice.array) is closed
+        too."""
+        if self.memory is not None:
+            self.residues = np.zeros(0, dtype=np.uint8)
+            try:
+                self.memory.close()
+            except BufferError:
+                # A view of the residues is still used: the memory is
+                # unmapped when it goes.
+                pass
+            detach(self.memory.name)
+            self.memory.unlink()
+            self.memory = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
@@ -0,0 +1,360 @@
+# -*- coding:utf-8 -*-
+"""tappmdb  is a module for precompiled collections of sequences
+
+A collection scored again and again (after every change of the models or of
+the threshold) is converted once into a .tappmdb file, which keeps the
+encoded residues and the parsed header columns of its records. Opening it
+maps the file; nothing is parsed and the residues are not encoded again.
+
+The layout of a file (numbers little-endian, sections aligned to 8 bytes):
+
+    MAGIC
+    the sections: codes (uint8), offsets (int64, one more than the
+        records), invalid (int64), and for each column of TEXT_COLUMNS the
+        UTF-8 text of the records and its offsets (int64)
+    the footer: JSON describing the sections, the alphabet and the CRC-32
+        of the sections
+    the length of the footer (uint64), MAGIC
+
+The residues are coded by an alphabet starting with the valid characters
+of the models; the other characters found (X, U, ...) follow them, so the
+sequences are kept as they were read.
+"""
+import os
+import mmap
+import json
+import zlib
+import struct
+
+import numpy as np
+
+from tappm.encoder import INVALID
+
+__all__ = ['TappmDB', 'TappmDBWriter', 'StoredSequence', 'is_database',
+           'DB_SUFFIX']
+
+DB_SUFFIX = '.tappmdb'
+MAGIC = b'TAPPMDB1'
+VERSION = 1
+ALIGN = 8
+
+# The header columns of the records kept in a file.
+TEXT_COLUMNS = ('header', 'identifier', 'accession', 'organism')
+
+# The valid characters of the models (see MyHmmPredictor).
+VALID_CHARS = "ACDEFGHIKLMNPQRSTVWY"
+
+TRAILER = struct.Struct('<Q8s')
+
+
+def is_database(filename):
+    """Return True if filename is a tappmdb file (by its first bytes)."""
+    try:
+        with open(filename, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except (IOError, OSError):
+        return False
+
+
+class StoredSequence(object):
+    """A record of a TappmDB, in the place of a Fasta object.
+
+    codes holds the indices of the residues in alphabet (a view of the
+    mapped file) if they are all valid, and is None otherwise."""
+
+    __slots__ = ('header', 'identifier', 'accession', 'organism',
+                 'sequence', 'codes', 'alphabet')
+
+    def __init__(self, header, identifier, accession, organism, sequence,
+                 codes=None, alphabet=VALID_CHARS):
+        self.header = header
+        self.identifier = identifier
+        self.accession = accession
+        self.organism = organism
+        self.sequence = sequence
+        self.codes = codes
+        self.alphabet = alphabet
+
+    @property
+    def seqlen(self):
+        return len(self.sequence)
+
+    def __len__(self):
+        return len(self.sequence)
+
+    def __repr__(self):
+        return self.identifier
+
+    def __str__(self):
+        return self.header + "\n" + self.sequence
+
+
+class TappmDBWriter(object):
+    """Write records into a tappmdb file. The residues are written as they
+    are added; the other sections when the writer is closed. The file is
+    written under a temporary name and renamed when it is complete.
+
+    :arg filename: the file written
+    :arg alphabet: the valid characters, coded from 0
+    :arg meta: other items of the footer (e.g. source, dbformat)
+    """
+
+    def __init__(self, filename, alphabet=VALID_CHARS, **meta):
+        self.filename = filename
+        self.alphabet = alphabet
+        self.valid = len(alphabet)
+        self.meta = meta
+        self.table = np.full(256, INVALID, dtype=np.uint8)
+        for i, c in enumerate(alphabet):
+            self.table[ord(c)] = i
+        self.lengths = []
+        self.invalid = []
+        self.columns = dict((column, []) for column in TEXT_COLUMNS)
+        self.sections = {}
+        self.crc = 0
+        self._tmp = filename + '.tmp'
+        self._file = open(self._tmp, 'wb')
+        self._file.write(MAGIC)
+        self._position = len(MAGIC)
+        self._align()
+        self._codes = self._position
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    def _align(self):
+        pad = -self._position % ALIGN
+        self._file.write(b'\0' * pad)
+        self._position += pad
+
+    def _write(self, data):
+        self._file.write(data)
+        self.crc = zlib.crc32(data, self.crc)
+        self._position += len(data)
+
+    def _section(self, name, array):
+        self._align()
+        data = np.ascontiguousarray(array)
+        self.sections[name] = [self._position, len(data),
+                               data.dtype.newbyteorder('<').str]
+        self._write(data.astype(data.dtype.newbyteorder('<')).tobytes())
+
+    def add(self, record):
+        """Add a record (a Fasta object)."""
+        data = np.frombuffer(record.sequence.encode('latin-1', 'replace'),
+                             dtype=np.uint8)
+        codes = self.table.take(data)
+        bad = codes == INVALID
+        if bad.any():
+            # New characters go to the end of the alphabet.
+            for value in np.unique(data[bad]).tolist():
+                if len(self.alphabet) >= INVALID:
+                    raise ValueError("Too many distinct characters")
+                self.table[value] = len(self.alphabet)
+                self.alphabet += chr(value)
+            codes = self.table.take(data)
+        self.invalid.append(int(np.count_nonzero(codes >= self.valid)))
+        self.lengths.append(len(codes))
+        self._write(codes.tobytes())
+        for column in TEXT_COLUMNS:
+            self.columns[column].append(getattr(record, column, '') or '')
+
+    def close(self):
+        """Write the other sections and the footer, and rename the file."""
+        self.sections['codes'] = [self._codes, self._position - self._codes,
+                                  '|u1']
+        offsets = np.zeros(len(self.lengths) + 1, dtype=np.int64)
+        np.cumsum(self.lengths, out=offsets[1:])
+        self._section('offsets', offsets)
+        self._section('invalid', np.array(self.invalid, dtype=np.int64))
+        for column in TEXT_COLUMNS:
+            texts = [text.encode('utf-8') for text in self.columns[column]]
+            bounds = np.zeros(len(texts) + 1, dtype=np.int64)
+            np.cumsum([len(text) for text in texts], out=bounds[1:])
+            self._section(column + '.offsets', bounds)
+            self._section(column, np.frombuffer(b''.join(texts),
+                                                dtype=np.uint8))
+        footer = dict(self.meta)
+        footer.update({'version': VERSION, 'alphabet': self.alphabet,
+                       'valid': self.valid, 'count': len(self.lengths),
+                       'residues': int(offsets[-1]),
+                       'sections': self.sections, 'crc32': self.crc})
+        footer = json.dumps(footer, sort_keys=True).encode('utf-8')
+        self._file.write(footer)
+        self._file.write(TRAILER.pack(len(footer), MAGIC))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.rename(self._tmp, self.filename)
+        return len(self.lengths)
+
+    def abort(self):
+        """Drop the file being written."""
+        self._file.close()
+        if os.path.exists(self._tmp):
+            os.remove(self._tmp)
+
+
+class TappmDB(object):
+    """A tappmdb file, mapped.
+
+    The records are numbered from 0. codes, offsets and invalid (the
+    number of invalid residues of each record) are arrays over the mapped
+    file.
+
+    :arg filename: a tappmdb file
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except ValueError:
+            # An empty file cannot be mapped.
+            self._file.close()
+            raise ValueError("%s is not a tappmdb file" % filename)
+        try:
+            self.footer = self.read_footer()
+            self.alphabet = self.footer['alphabet']
+            self.valid = self.footer['valid']
+            self.arrays = dict((name, self.section(name))
+                               for name in self.footer['sections'])
+        except Exception:
+            self.close()
+            raise
+        self.codes = self.arrays['codes']
+        self.offsets = self.arrays['offsets']
+        self.invalid = self.arrays['invalid']
+        self._letters = np.frombuffer(self.alphabet.encode('latin-1'),
+                                      dtype=np.uint8)
+
+    def read_footer(self):
+        data = self._map
+        size = len(data)
+        if size < len(MAGIC) + TRAILER.size or \
+           data[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not a tappmdb file" % self.filename)
+        length, magic = TRAILER.unpack(data[size - TRAILER.size:])
+        start = size - TRAILER.size - length
+        if magic != MAGIC or start < len(MAGIC):
+            raise ValueError("%s is truncated" % self.filename)
+        footer = json.loads(data[start:start + length].decode('utf-8'))
+        if footer.get('version') != VERSION:
+            raise ValueError("%s is of version %s, not %d" % (
+                self.filename, footer.get('version'), VERSION))
+        for name, (offset, count, dtype) in footer['sections'].items():
+            if offset + count * np.dtype(dtype).itemsize > start:
+                raise ValueError("%s is truncated" % self.filename)
+        return footer
+
+    def section(self, name):
+        """Return a section as an array over the mapped file."""
+        offset, count, dtype = self.footer['sections'][name]
+        return np.frombuffer(self._map, dtype=dtype, count=count,
+                             offset=offset)
+
+    def close(self):
+        if self._map is not None:
+            self.arrays = {}
+            self.codes = self.offsets = self.invalid = None
+            try:
+                self._map.close()
+            except BufferError:
+                # Records still use the codes: the file is unmapped when
+                # they go.
+                pass
+            self._file.close()
+            self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def __len__(self):
+        return self.footer['count']
+
+    @property
+    def residues(self):
+        """The number of residues of all records."""
+        return self.footer['residues']
+
+    def verify(self):
+        """Return True if the CRC-32 of the sections is the one written."""
+        crc = 0
+        sections = sorted(self.footer['sections'].values())
+        for offset, count, dtype in sections:
+            end = offset + count * np.dtype(dtype).itemsize
+            for start in range(offset, end, 1 << 24):
+                crc = zlib.crc32(self._map[start:min(end, start + (1 << 24))],
+                                 crc)
+        return crc == self.footer['crc32']
+
+    # --- Records ---
+
+    def text(self, column, i):
+        """Return the text of a column of TEXT_COLUMNS of the i-th record.
+        """
+        bounds = self.arrays[column + '.offsets']
+        texts = self.arrays[column]
+        return texts[bounds[i]:bounds[i + 1]].tobytes().decode('utf-8')
+
+    def record(self, i):
+        """Return the i-th record as a StoredSequence."""
+        codes = self.codes[self.offsets[i]:self.offsets[i + 1]]
+        sequence = self._letters.take(codes).tobytes().decode('latin-1')
+        return StoredSequence(
+            self.text('header', i), self.text('identifier', i),
+            self.text('accession', i), self.text('organism', i), sequence,
+            codes if not self.invalid[i] else None,
+            self.alphabet[:self.valid])
+
+    def iter_records(self, first=0, last=None):
+        """Yield the records first to last (excluded)."""
+        last = len(self) if last is None else last
+        for i in range(first, last):
+            yield self.record(i)
+
+    def count(self, record_range=None):
+        """Return the number of records in record_range (first, last)."""
+        if record_range is None:
+            return len(self)
+        return max(0, record_range[1] - record_range[0])
+
+    def shard_range(self, index, total):
+        """Return the record range (first, last) of the index-th of total
+        shards (from 1), of about as many residues each."""
+        if not 1 <= index <= total:
+            raise ValueError("Invalid shard %d/%d" % (index, total))
+        bounds = [len(self) if k == total else int(np.searchsorted(
+                  self.offsets, self.residues * k // total, 'left'))
+                  for k in (index - 1, index)]
+        return min(bounds[0], len(self)), bounds[1]
+
+    def store(self, first=0, last=None):
+        """Return the records first to last as an EncodedSequenceStore of
+        their valid residues (a view of the file if they are all valid)."""
+        from tappm.seqstore import EncodedSequenceStore
+        last = len(self) if last is None else last
+        base = self.offsets[first]
+        codes = self.codes[base:self.offsets[last]]
+        offsets = self.offsets[first:last + 1] - base
+        bad = codes >= self.valid
+        if bad.any():
+            kept = np.zeros(len(codes) + 1, dtype=np.int64)
+            np.cumsum(~bad, out=kept[1:])
+            codes = codes[~bad]
+            offsets = kept[offsets]
+        identifiers = [self.text('identifier', i) for i in range(first, last)]
+        return EncodedSequenceStore(codes, offsets, identifiers)
@@ -4,11 +4,17 @@
 import sys
 import math
 import time
+import atexit
 import os.path
 import logging
 import datetime
 import logging.handlers
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 __all__ = ['LOGGING_LEVELS', 'Console']
 
 LOGGING_LEVELS = {'debug': logging.DEBUG,
@@ -67,6 +73,7 @@ class Console(object):
         self._prev = None
         self._line = None
         self._times = {}
+        self._listener = None
 
     # ====================
     # Attributes
@@ -192,6 +199,35 @@ class Console(object):
 
         self._logger.handlers.pop(index)
 
+    def capture(self, name, level='warning'):
+        """Write the records of the logger *name* (e.g. ``'tappm'``, which
+        includes the HMM core and its worker processes) with the handlers
+        of this console.
+
+        The records are put into a queue and written by a thread of their
+        own, so the code logging them never waits for the console or the
+        logfile. Start the logfile before capturing.
+
+        :arg level: the lowest level of the records captured"""
+
+        if self._listener is None:
+            self._queue = queue.Queue(-1)
+            self._listener = logging.handlers.QueueListener(
+                self._queue, *self.getHandlers(), respect_handler_level=True)
+            self._listener.start()
+            atexit.register(self.release)
+        logger = logging.getLogger(name)
+        logger.handlers = [logging.handlers.QueueHandler(self._queue)]
+        logger.propagate = False
+        logger.setLevel(LOGGING_LEVELS.get(level, logging.WARNING))
+
+    def release(self):
+        """Write the captured records still queued and stop capturing."""
+
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
     def start(self, filename, **kwargs):
         """Start a logfile.  If *filename* does not have an extension.
         :file:`.log` will be appended to it.
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from tappm.hmm import affinity
+
+INTERLEAVED = [[0, 2, 4, 6], [1, 3, 5, 7]]
+
+
+def fake(monkeypatch, nodes, allowed):
+    monkeypatch.setattr(affinity, 'numa_nodes', lambda: nodes)
+    monkeypatch.setattr(affinity, 'allowed_cpus', lambda: allowed)
+
+
+def test_compact_fills_one_node_first(monkeypatch):
+    fake(monkeypatch, INTERLEAVED, list(range(8)))
+    assert affinity.plan('compact') == [0, 2, 4, 6, 1, 3, 5, 7]
+
+
+def test_spread_takes_nodes_in_turn(monkeypatch):
+    fake(monkeypatch, INTERLEAVED, list(range(8)))
+    assert affinity.plan('spread') == [0, 1, 2, 3, 4, 5, 6, 7]
+
+
+def test_compact_keeps_allowed_cpus_only(monkeypatch):
+    fake(monkeypatch, INTERLEAVED + [[8]], [1, 2, 3, 6, 9])
+    assert affinity.plan('compact') == [2, 6, 1, 3, 9]
+
+
+def test_compact_without_numa_information(monkeypatch):
+    fake(monkeypatch, [[0, 1, 2, 3]], [0, 1, 2, 3])
+    assert affinity.plan('compact') == [0, 1, 2, 3]
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+from tappm.encoder import SequenceEncoder
+
+CHARS = "ACDEFGHIKLMNPQRSTVWY"
+
+
+def test_encode_indices():
+    encoder = SequenceEncoder(CHARS)
+    assert encoder.encode("ACY").tolist() == [0, 1, 19]
+    assert encoder.encode("").dtype == np.uint8
+    assert len(encoder.encode("")) == 0
+
+
+def test_encode_reversed():
+    encoder = SequenceEncoder(CHARS)
+    codes = encoder.encode("MKLV")
+    assert encoder.encode("MKLV", reverse=True).tolist() == \
+        codes[::-1].tolist()
+
+
+def test_encode_bytes_matches_encode():
+    encoder = SequenceEncoder(CHARS)
+    assert encoder.encode_bytes(b"MKXLV").tolist() == \
+        encoder.encode("MKXLV").tolist()
+
+
+def test_invalid_characters_dropped_and_counted():
+    encoder = SequenceEncoder(CHARS)
+    assert encoder.encode("MXKUX").tolist() == encoder.encode("MK").tolist()
+    assert encoder.encode("XA", reverse=True).tolist() == [0]
+    assert encoder.invalid == {'X': 3, 'U': 1}
+    assert encoder.invalid_sequences == 2
+    assert "4 invalid characters found in 2 sequences" in encoder.summary()
+    encoder.reset()
+    assert encoder.summary() == ''
+
+
+def test_non_latin1_character_is_invalid():
+    encoder = SequenceEncoder(CHARS)
+    assert encoder.encode(u"AαC").tolist() == [0, 1]
+    assert encoder.invalid == {'?': 1}
+
+
+def test_missing_error():
+    encoder = SequenceEncoder(CHARS)
+    with pytest.raises(ValueError):
+        encoder.encode("MKXL", missing='error')
+    assert encoder.encode("MKL", missing='error').tolist() == \
+        encoder.encode("MKL").tolist()
+    assert not encoder.invalid
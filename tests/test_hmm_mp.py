@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+from tappm.hmm import hmm_mp
+
+
+class FakePool(object):
+
+    def terminate(self):
+        pass
+
+    def join(self):
+        pass
+
+
+class FakeContext(object):
+    """Record the arguments of the pools started with the fork server."""
+
+    def __init__(self):
+        self.initargs = []
+
+    def get_start_method(self):
+        return 'forkserver'
+
+    def Queue(self):
+        return queue.Queue()
+
+    def Value(self, typecode, value):
+        return None
+
+    def Pool(self, processes, initializer, initargs):
+        self.initargs.append(initargs)
+        return FakePool()
+
+
+def make_model(monkeypatch):
+    monkeypatch.setattr(hmm_mp, '_PRELOAD_FILES', [])
+    context = FakeContext()
+    monkeypatch.setattr(hmm_mp, 'get_context', lambda: context)
+    t = np.array([[0.9, 0.1], [0.0, 1.0]])
+    e = np.array([[0.5, 0.0], [0.5, 1.0]])
+    i = np.array([1.0, 0.0])
+    return hmm_mp.MultiProcessHMM(t, e, i, model_file='model.xml'), context
+
+
+def test_compile_keeps_preloaded_model(monkeypatch):
+    model, context = make_model(monkeypatch)
+    params = (model._t, model._e, model._i)
+    model.compile()
+    assert all(a is b for a, b in zip(params, (model._t, model._e,
+                                                model._i)))
+    assert model._t.min() > 0
+    model.start()
+    model.close()
+    assert context.initargs[0][:4] == (None, None, None, 'model.xml')
+
+
+def test_replaced_parameters_are_sent(monkeypatch):
+    model, context = make_model(monkeypatch)
+    model._t = model._t.copy()
+    model.start()
+    model.close()
+    assert context.initargs[0][0] is model._t
+    assert context.initargs[0][3] is None
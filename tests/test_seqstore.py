@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+from tappm.bulk_reader import BulkFastaReader
+from tappm.encoder import SequenceEncoder
+from tappm.seqstore import EncodedSequenceStore, PackedResidues, \
+                           pack5, unpack5
+
+CHARS = "ACDEFGHIKLMNPQRSTVWY"
+
+
+def codes_of(length, seed=0):
+    return np.random.RandomState(seed).randint(0, 32, length) \
+        .astype(np.uint8)
+
+
+@pytest.mark.parametrize('length', [0, 1, 7, 8, 9, 15, 16, 17, 41])
+def test_pack5_round_trip(length):
+    codes = codes_of(length, length)
+    packed = pack5(codes)
+    assert packed.dtype == np.uint8
+    assert len(packed) == -(-length // 8) * 5
+    assert unpack5(packed, 0, length).tolist() == codes.tolist()
+
+
+def test_pack5_layout_is_little_endian():
+    # Code k of a group takes the bits 5k to 5k + 4.
+    assert pack5([1]).tolist() == [1, 0, 0, 0, 0]
+    assert pack5([0, 1]).tolist() == [32, 0, 0, 0, 0]
+    assert pack5([0] * 7 + [31]).tolist() == [0, 0, 0, 0, 248]
+
+
+def test_unpack5_ranges():
+    codes = codes_of(41)
+    packed = pack5(codes)
+    for start, end in [(0, 8), (8, 16), (7, 9), (8, 8), (3, 3), (16, 41),
+                       (40, 41), (5, 37)]:
+        assert unpack5(packed, start, end).tolist() == \
+            codes[start:end].tolist()
+
+
+def test_pack5_empty():
+    assert len(pack5(np.zeros(0, dtype=np.uint8))) == 0
+    assert len(unpack5(pack5([]), 0, 0)) == 0
+
+
+def test_pack5_rejects_large_codes():
+    with pytest.raises(ValueError):
+        pack5([3, 32])
+
+
+def test_packed_residues_part():
+    codes = codes_of(30)
+    residues = PackedResidues.pack(codes)
+    part = residues.part(5, 22)
+    assert len(part) == 17
+    assert part[:].tolist() == codes[5:22].tolist()
+    assert part[8:16].tolist() == codes[13:21].tolist()
+
+
+def test_packed_store_matches_unpacked():
+    offsets = np.array([0, 3, 3, 11, 20], dtype=np.int64)
+    store = EncodedSequenceStore(codes_of(20) % 20, offsets, 'abcd')
+    packed = store.pack()
+    for i in range(len(store)):
+        assert packed[i].tolist() == store[i].tolist()
+        assert packed.sequence(i, reverse=True).tolist() == \
+            store.sequence(i, reverse=True).tolist()
+    assert packed[1:3].unpack().residues.tolist() == \
+        store[1:3].residues.tolist()
+
+
+def test_from_block_drops_invalid_residues():
+    encoder = SequenceEncoder(CHARS)
+    block = BulkFastaReader().parse_bytes(
+        b">a one\nMKX\nL\n>b\nXX\n>c\nAC\n")
+    store = EncodedSequenceStore.from_block(block, encoder)
+    assert store.identifiers == ['a', 'b', 'c']
+    assert store.offsets.tolist() == [0, 3, 3, 5]
+    assert store[0].tolist() == encoder.encode("MKL").tolist()
+    assert len(store[1]) == 0
+    assert store[2].tolist() == encoder.encode("AC").tolist()
+    assert encoder.invalid == {'X': 3}
+    assert encoder.invalid_sequences == 2
+
+
+def test_from_block_missing_error():
+    encoder = SequenceEncoder(CHARS)
+    block = BulkFastaReader().parse_bytes(b">a\nMKX\n")
+    with pytest.raises(ValueError):
+        EncodedSequenceStore.from_block(block, encoder, missing='error')
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+import time
+
+import pytest
+
+from tappm.apps.workqueue import WorkQueue, LeaseKeeper, LeaseLost
+
+
+def test_empty_queue_is_finished(tmp_path):
+    queue = WorkQueue(str(tmp_path / 'q'))
+    assert not queue.finished()
+    assert queue.setup([], input='x')
+    assert queue.finished()
+    assert not queue.setup([('x', 0, 1)], input='x')
+    queue.close()
+
+
+def test_lost_lease_stops_the_records(tmp_path):
+    path = str(tmp_path / 'q')
+    queue = WorkQueue(path)
+    queue.setup([('x', 0, 10)], input='x')
+    unit = queue.lease('a', 0.3)[0]
+    keeper = LeaseKeeper(path, unit, 'a', 0.3)
+    keeper.start()
+    records = keeper.guard(iter(range(100)))
+    assert next(records) == 0
+    # Another worker takes the unit over.
+    queue.requeue_expired(now=time.time() + 1)
+    assert queue.lease('b', 60)[0] == unit
+    deadline = time.time() + 5
+    while not keeper.lost and time.time() < deadline:
+        time.sleep(0.05)
+    keeper.stop()
+    assert keeper.lost
+    with pytest.raises(LeaseLost):
+        next(records)
+    queue.close()